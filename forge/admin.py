@@ -1,5 +1,10 @@
 from django.contrib import admin
-from .models import Prompt, PromptMetadata, PromptEmbedding
+from django.contrib.postgres.search import SearchQuery
+from django.db import connection
+from django.db.models import Q
+
+from .hybrid_search import SEARCH_CONFIG, prompt_document
+from .models import EmbeddingModel, Prompt, PromptMetadata, PromptEmbedding
 
 
 @admin.register(Prompt)
@@ -9,6 +14,15 @@ class PromptAdmin(admin.ModelAdmin):
     search_fields = ['text', 'response', 'user__username']
     list_filter = ['created_at', 'user']
 
+    def get_search_results(self, request, queryset, search_term):
+        # On PostgreSQL use the GIN-indexed full-text search instead of an ILIKE scan
+        if not search_term or connection.vendor != 'postgresql':
+            return super().get_search_results(request, queryset, search_term)
+        query = SearchQuery(search_term, config=SEARCH_CONFIG, search_type='websearch')
+        queryset = queryset.annotate(document=prompt_document()).filter(
+            Q(document=query) | Q(user__username__iexact=search_term))
+        return queryset, False
+
 
 @admin.register(PromptMetadata)
 class PromptMetadataAdmin(admin.ModelAdmin):
@@ -24,3 +38,12 @@ class PromptEmbeddingAdmin(admin.ModelAdmin):
     ordering = ['-prompt__created_at', 'created_at']
     search_fields = ['prompt__text', 'model_name']
     list_filter = ['model_name', 'prompt__user__username']
+
+
+@admin.register(EmbeddingModel)
+class EmbeddingModelAdmin(admin.ModelAdmin):
+    list_display = ['name', 'is_active', 'activated_at', 'created_at']
+    ordering = ['-is_active', 'name']
+    # Switch with 'manage.py backfill_embeddings --model NAME --activate', which
+    # embeds every prompt and publishes the model's index first
+    readonly_fields = ['is_active', 'activated_at']
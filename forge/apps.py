@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class ForgeConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'forge'
+
+    def ready(self):
+        from . import signals  # noqa: F401
@@ -0,0 +1,95 @@
+"""
+Dynamic micro-batching of model calls across concurrent requests.
+
+A ``MicroBatcher`` collects items submitted by concurrent callers and runs
+them through the model together. The first item of a batch waits at most
+``max_wait_ms`` for others to arrive; the batch is run as soon as it holds
+``max_batch_size`` items or the wait is over. Each caller gets a future that
+resolves to its own output.
+
+One batch runs at a time per process, on a daemon thread started by the first
+submission. A process forked afterwards (e.g. a preloaded server worker)
+starts its own thread on its first submission.
+"""
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+from .metrics import BATCH_QUEUE_WAIT_SECONDS, BATCH_SIZE
+
+
+class MicroBatcher:
+    """
+    Runs ``run_batch(items)``, which must return one result per item in
+    order, on batches of items submitted from any thread.
+    """
+
+    def __init__(self, run_batch, max_batch_size, max_wait_ms, name='batch'):
+        self.run_batch = run_batch
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max(0, max_wait_ms) / 1000
+        self.name = name
+        self._lock = threading.Lock()
+        self._queue = None
+        self._pid = None
+
+    def submit(self, item):
+        """Queues ``item`` for the next batch and returns a future of its result."""
+        future = Future()
+        self._worker_queue().put((item, future, time.monotonic()))
+        return future
+
+    def __call__(self, item):
+        """Runs ``item`` in a batch and returns its result, raising its error."""
+        return self.submit(item).result()
+
+    def _worker_queue(self):
+        with self._lock:
+            if self._pid != os.getpid():
+                # Threads do not survive fork: each process serves its own queue
+                self._queue = queue.Queue()
+                self._pid = os.getpid()
+                threading.Thread(target=self._serve, args=(self._queue,), daemon=True,
+                                 name=f'{self.name}-batcher').start()
+            return self._queue
+
+    def _serve(self, pending):
+        while True:
+            self._run(self._collect(pending))
+
+    def _collect(self, pending):
+        """Blocks for the next item, then gathers a batch around it."""
+        batch = [pending.get()]
+        deadline = batch[0][2] + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                # Past the deadline, still take whatever is already queued
+                batch.append(pending.get(timeout=remaining) if remaining > 0 else pending.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self, batch):
+        # Skip callers that gave up on their result
+        batch = [entry for entry in batch if entry[1].set_running_or_notify_cancel()]
+        if not batch:
+            return
+
+        started = time.monotonic()
+        BATCH_SIZE.labels(batcher=self.name).observe(len(batch))
+        for _, _, queued in batch:
+            BATCH_QUEUE_WAIT_SECONDS.labels(batcher=self.name).observe(started - queued)
+
+        try:
+            results = self.run_batch([item for item, _, _ in batch])
+            if len(results) != len(batch):
+                raise RuntimeError(f'{self.name} batch returned {len(results)} results for {len(batch)} items')
+        except Exception as exc:
+            for _, future, _ in batch:
+                future.set_exception(exc)
+            return
+        for (_, future, _), result in zip(batch, results):
+            future.set_result(result)
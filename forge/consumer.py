@@ -29,3 +29,16 @@ class PromptConsumer(AsyncWebsocketConsumer):
     async def send_prompt(self, event):
         message = event['message']
         await self.send(text_data=json.dumps(message))
+
+    # Receive streamed generation events from group
+    async def prompt_chunk(self, event):
+        await self.send_event('chunk', event['message'])
+
+    async def prompt_done(self, event):
+        await self.send_event('done', event['message'])
+
+    async def prompt_error(self, event):
+        await self.send_event('error', event['message'])
+
+    async def send_event(self, name, message):
+        await self.send(text_data=json.dumps({'event': name, **message}))
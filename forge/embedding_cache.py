@@ -0,0 +1,236 @@
+"""
+Two-tier cache for text embeddings.
+
+Entries are keyed by a SHA-256 hash of the embedding model name, the inference
+backend it runs with and the text, as vectors differ slightly between backends.
+The first tier is a bounded in-process LRU; the second is a SQLite file shared
+by every worker on the host, so a text embedded by one worker is a hit for all
+of them. The shared tier is bounded in bytes and evicts the least recently
+used entries once it grows past its limit. Recency is tracked coarsely: a hit
+only writes to the store when the entry was last marked used more than
+``ACCESS_REFRESH_SECONDS`` ago, so most hits are plain reads.
+"""
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+from django.conf import settings
+
+from .fields import VECTOR_DTYPE
+from .metrics import EMBEDDING_CACHE_EVICTIONS, EMBEDDING_CACHE_REQUESTS
+
+# SQLite limits the number of bound parameters per statement
+SQLITE_BATCH_SIZE = 500
+
+# Shared store is trimmed to this fraction of its limit when it overflows
+EVICTION_TARGET = 0.9
+
+# Hits refresh the recency of an entry last marked used longer ago than this
+ACCESS_REFRESH_SECONDS = 60
+
+
+def cache_key(model_name, backend, text):
+    """Returns the cache key of ``text`` embedded with ``model_name`` on ``backend``."""
+    return hashlib.sha256(f'{model_name}\0{backend}\0{text}'.encode('utf-8')).digest()
+
+
+class EmbeddingCache:
+    """
+    Bounded in-process LRU in front of a shared on-disk SQLite store.
+    Either tier is disabled by setting its size (or path) to zero/empty.
+    """
+
+    def __init__(self, path=None, memory_items=None, disk_max_bytes=None):
+        self.path = settings.EMBEDDING_CACHE_PATH if path is None else path
+        self.memory_items = settings.EMBEDDING_CACHE_MEMORY_ITEMS if memory_items is None else memory_items
+        self.disk_max_bytes = settings.EMBEDDING_CACHE_MAX_BYTES if disk_max_bytes is None else disk_max_bytes
+
+        self.hits = {'memory': 0, 'disk': 0}
+        self.misses = 0
+        self._memory = OrderedDict()
+        self._memory_lock = threading.Lock()
+        self._local = threading.local()
+        self._disk_bytes = None
+
+    def get_many(self, model_name, backend, texts):
+        """
+        Returns a list with the cached vector of every text, or None for texts
+        that are not cached.
+        """
+        keys = [cache_key(model_name, backend, text) for text in texts]
+        vectors = [self._memory_get(key) for key in keys]
+
+        missing = [key for key, vector in zip(keys, vectors) if vector is None]
+        found = self._disk_get_many(missing) if missing else {}
+        for key, vector in found.items():
+            self._memory_set(key, vector)
+
+        for i, (key, vector) in enumerate(zip(keys, vectors)):
+            if vector is not None:
+                self._record('memory', 'hit')
+            elif key in found:
+                vectors[i] = found[key]
+                self._record('disk', 'hit')
+            else:
+                self._record(None, 'miss')
+        return vectors
+
+    def get(self, model_name, backend, text):
+        """Returns the cached vector of ``text``, or None."""
+        return self.get_many(model_name, backend, [text])[0]
+
+    def set_many(self, model_name, backend, texts, vectors):
+        """Stores the vectors of ``texts`` in both tiers."""
+        entries = []
+        for text, vector in zip(texts, vectors):
+            key = cache_key(model_name, backend, text)
+            vector = np.array(vector, dtype=VECTOR_DTYPE)
+            vector.flags.writeable = False
+            self._memory_set(key, vector)
+            entries.append((key, vector.tobytes()))
+        self._disk_set_many(entries)
+
+    def set(self, model_name, backend, text, vector):
+        self.set_many(model_name, backend, [text], [vector])
+
+    def clear(self):
+        """Empties both tiers and resets the counters."""
+        with self._memory_lock:
+            self._memory.clear()
+        connection = self._connection()
+        if connection is not None:
+            with connection:
+                connection.execute('DELETE FROM embeddings')
+            self._disk_bytes = 0
+        self.hits = {'memory': 0, 'disk': 0}
+        self.misses = 0
+
+    def stats(self):
+        return {
+            'memory_hits': self.hits['memory'],
+            'disk_hits': self.hits['disk'],
+            'misses': self.misses,
+            'memory_items': len(self._memory),
+        }
+
+    def _record(self, tier, result):
+        if result == 'hit':
+            self.hits[tier] += 1
+        else:
+            self.misses += 1
+        EMBEDDING_CACHE_REQUESTS.labels(tier=tier or 'none', result=result).inc()
+
+    # In-process tier
+
+    def _memory_get(self, key):
+        with self._memory_lock:
+            vector = self._memory.get(key)
+            if vector is not None:
+                self._memory.move_to_end(key)
+            return vector
+
+    def _memory_set(self, key, vector):
+        if self.memory_items <= 0:
+            return
+        with self._memory_lock:
+            self._memory[key] = vector
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.memory_items:
+                self._memory.popitem(last=False)
+                EMBEDDING_CACHE_EVICTIONS.labels(tier='memory').inc()
+
+    # Shared on-disk tier
+
+    def _connection(self):
+        """
+        Returns this thread's SQLite connection. Connections are not shared
+        across threads or inherited across forks.
+        """
+        if not self.path or self.disk_max_bytes <= 0:
+            return None
+        connection = getattr(self._local, 'connection', None)
+        if connection is not None and self._local.pid == os.getpid():
+            return connection
+
+        connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('PRAGMA synchronous=NORMAL')
+        connection.execute(
+            'CREATE TABLE IF NOT EXISTS embeddings ('
+            'key BLOB PRIMARY KEY, vector BLOB NOT NULL, accessed REAL NOT NULL)'
+        )
+        connection.execute('CREATE INDEX IF NOT EXISTS embeddings_accessed ON embeddings (accessed)')
+        self._local.connection = connection
+        self._local.pid = os.getpid()
+        return connection
+
+    def _disk_get_many(self, keys):
+        connection = self._connection()
+        if connection is None:
+            return {}
+
+        found = {}
+        stale = []
+        now = time.time()
+        for start in range(0, len(keys), SQLITE_BATCH_SIZE):
+            chunk = keys[start:start + SQLITE_BATCH_SIZE]
+            placeholders = ','.join('?' * len(chunk))
+            rows = connection.execute(
+                f'SELECT key, vector, accessed FROM embeddings WHERE key IN ({placeholders})', chunk)
+            for key, blob, accessed in rows:
+                found[key] = np.frombuffer(blob, dtype=VECTOR_DTYPE)
+                if accessed < now - ACCESS_REFRESH_SECONDS:
+                    stale.append(key)
+
+        if stale:
+            # Refresh recency so hot entries survive eviction
+            with connection:
+                connection.executemany(
+                    'UPDATE embeddings SET accessed = ? WHERE key = ?', [(now, key) for key in stale])
+        return found
+
+    def _disk_set_many(self, entries):
+        connection = self._connection()
+        if connection is None or not entries:
+            return
+
+        now = time.time()
+        with connection:
+            connection.executemany(
+                'INSERT OR REPLACE INTO embeddings (key, vector, accessed) VALUES (?, ?, ?)',
+                [(key, blob, now) for key, blob in entries])
+
+        if self._disk_bytes is None:
+            self._disk_bytes = self._disk_size(connection)
+        else:
+            self._disk_bytes += sum(len(blob) for _, blob in entries)
+        if self._disk_bytes > self.disk_max_bytes:
+            self._evict(connection)
+
+    def _disk_size(self, connection):
+        return connection.execute('SELECT COALESCE(SUM(LENGTH(vector)), 0) FROM embeddings').fetchone()[0]
+
+    def _evict(self, connection):
+        """Deletes least recently used entries until the store is below its target size."""
+        # Other workers write to the same store, so start from the real size
+        size = self._disk_size(connection)
+        target = self.disk_max_bytes * EVICTION_TARGET
+        if size > target:
+            excess = size - target
+            with connection:
+                # Oldest entries first, until the running total covers the excess
+                cursor = connection.execute(
+                    'DELETE FROM embeddings WHERE key IN ('
+                    ' SELECT key FROM ('
+                    '  SELECT key, LENGTH(vector) AS size,'
+                    '   SUM(LENGTH(vector)) OVER (ORDER BY accessed, key) AS running'
+                    '  FROM embeddings'
+                    ' ) WHERE running - size < ?'
+                    ')', (excess,))
+            EMBEDDING_CACHE_EVICTIONS.labels(tier='disk').inc(cursor.rowcount)
+            size = self._disk_size(connection)
+        self._disk_bytes = size
@@ -0,0 +1,805 @@
+"""
+FAISS index management for prompt similarity search.
+
+Vectors are keyed by prompt ID (``IndexIDMap2``), so the index no longer needs
+a parallel list of IDs. The ``PromptEmbedding`` table doubles as the delta
+log: its primary key only grows, so every row above the watermark recorded in
+the current snapshot is an embedding the snapshot has not seen yet.
+
+Ids are taken when a row is inserted but become visible when its transaction
+commits, so a lower id may commit after a higher one has been applied. The
+watermark is therefore held back to embeddings created at least
+``FAISS_DELTA_SETTLE_SECONDS`` before the delta log was read, by which time
+every lower id has committed or never will. Embeddings above the watermark
+that are already indexed are recorded with it, and skipped when the log is
+read again.
+
+Snapshots are immutable files published with write-temp-then-rename. A small
+JSON manifest, replaced the same way, points at the current snapshot and
+records its watermark, so readers always see a snapshot together with the
+watermark it was written with.
+
+The index type is chosen with ``FAISS_INDEX_TYPE``. Types that need training
+(IVF) are trained offline by ``manage.py train_prompt_index``, which stores an
+empty trained template next to the snapshots; until then the flat index is used.
+
+Workers open snapshots memory-mapped and read-only (``FAISS_MMAP``), so every
+worker on a host shares the same page-cache pages instead of holding a private
+copy. Embeddings above the snapshot watermark go to a small in-memory delta
+index searched together with the snapshot; publishing writes both as the next
+snapshot and maps it in place of the old one. Searches only apply the delta
+log: once enough of it has accumulated, the snapshot is published on a
+background thread, which does not hold up searches while it writes.
+
+Every embedding model has its own index. ``prompt_index`` serves searches
+from the index of the active model; the index of a model being backfilled is
+built and published next to it before the model is activated.
+"""
+import functools
+import json
+import logging
+import os
+import re
+import tempfile
+import threading
+
+import faiss
+import numpy as np
+from django.conf import settings
+from django.utils import timezone
+from filelock import FileLock, Timeout
+
+from .models import EmbeddingModel, PromptEmbedding
+
+logger = logging.getLogger(__name__)
+
+# Base path of the FAISS index of EMBEDDING_MODEL; snapshots and the manifest
+# are stored next to it, and the indexes of other models next to those
+INDEX_PATH = settings.FAISS_INDEX_PATH
+
+# Number of rows fetched from the delta log per batch
+DELTA_BATCH_SIZE = 10000
+
+# FAISS factory strings of the supported index types
+INDEX_FACTORY_STRINGS = {
+    'flat': 'IDMap2,Flat',
+    'ivf_flat': 'IVF{nlist},Flat',
+    'ivf_pq': 'IVF{nlist},PQ{pq_m}x{pq_nbits}',
+    'hnsw': 'IDMap2,HNSW{hnsw_m}',
+    # Compressed profiles: PCA to FAISS_PCA_DIM, then product or 8-bit scalar quantization
+    'pca_ivf_pq': 'PCA{pca_dim},IVF{nlist},PQ{pq_m}x{pq_nbits}',
+    'pca_ivf_sq8': 'PCA{pca_dim},IVF{nlist},SQ8',
+}
+
+# Index types storing lossy codes instead of the vectors; their results are re-ranked
+COMPRESSED_INDEX_TYPES = (
+    faiss.IndexIVFPQ, faiss.IndexIVFScalarQuantizer, faiss.IndexPQ, faiss.IndexScalarQuantizer,
+)
+
+
+# Times a filtered approximate search is widened before returning fewer than k results
+FILTER_WIDEN_ATTEMPTS = 3
+
+# Distance metrics; stored vectors are unit length, so both rank by cosine similarity
+METRICS = {
+    'l2': faiss.METRIC_L2,
+    'ip': faiss.METRIC_INNER_PRODUCT,
+}
+
+
+def build_index(dim, index_type=None):
+    """
+    Returns an empty, ID-mapped index of the given type (``FAISS_INDEX_TYPE``
+    by default). IVF types still have to be trained before use.
+    """
+    index_type = index_type or settings.FAISS_INDEX_TYPE
+    if index_type not in INDEX_FACTORY_STRINGS:
+        raise ValueError(f"Unknown FAISS index type '{index_type}'")
+
+    description = INDEX_FACTORY_STRINGS[index_type].format(
+        nlist=settings.FAISS_IVF_NLIST,
+        pq_m=settings.FAISS_PQ_M,
+        pq_nbits=settings.FAISS_PQ_NBITS,
+        hnsw_m=settings.FAISS_HNSW_M,
+        pca_dim=settings.FAISS_PCA_DIM,
+    )
+    return faiss.index_factory(dim, description, METRICS[settings.FAISS_METRIC])
+
+
+def base_index(index):
+    """
+    Returns the innermost index below any ID map or pre-transform wrapper. For
+    a snapshot with its delta (``IndexShards``) that of the snapshot is returned.
+    """
+    index = faiss.downcast_index(index)
+    while isinstance(index, (faiss.IndexIDMap, faiss.IndexIDMap2, faiss.IndexPreTransform, faiss.IndexShards)):
+        index = faiss.downcast_index(index.at(0) if isinstance(index, faiss.IndexShards) else index.index)
+    return index
+
+
+def read_snapshot(path, index_type=None, mmap=None):
+    """
+    Opens a snapshot written by ``PromptIndexManager.publish``. With ``mmap``
+    (``FAISS_MMAP`` by default) it is memory-mapped read-only: adding to it
+    aborts the process, so it must only ever be searched. ``index_type`` is
+    the class name recorded in the manifest.
+    """
+    if not (settings.FAISS_MMAP if mmap is None else mmap):
+        return faiss.read_index(path)
+    # IVF inverted lists are mapped by IO_FLAG_MMAP, flat and HNSW storage by IO_FLAG_MMAP_IFC
+    flag = faiss.IO_FLAG_MMAP if index_type and 'IVF' in index_type else faiss.IO_FLAG_MMAP_IFC
+    return faiss.read_index(path, flag | faiss.IO_FLAG_READ_ONLY)
+
+
+def process_memory():
+    """
+    Returns the resident memory of this process in bytes as a dict with the
+    total ('rss'), anonymous ('anon'), file-backed ('file') and shared memory
+    ('shmem') parts, the pages no other process maps ('private') and the
+    proportional set size ('pss') that splits shared pages between the
+    processes mapping them. File-backed pages of mapped snapshots are shared
+    by all workers on the host. Returns None where /proc is not available.
+    """
+    fields = {'VmRSS': 'rss', 'RssAnon': 'anon', 'RssFile': 'file', 'RssShmem': 'shmem', 'Pss': 'pss',
+              'Private_Clean': 'private', 'Private_Dirty': 'private'}
+    memory = {}
+    for path in ('/proc/self/status', '/proc/self/smaps_rollup'):
+        try:
+            with open(path) as fh:
+                lines = fh.readlines()
+        except OSError:
+            continue
+        for line in lines:
+            name, _, value = line.partition(':')
+            if name in fields:
+                key = fields[name]
+                memory[key] = memory.get(key, 0) + int(value.split()[0]) * 1024
+    return memory or None
+
+
+def format_memory(memory):
+    if not memory:
+        return 'unknown'
+    return 'RSS {:.1f} MB (private {:.1f} MB, file-backed {:.1f} MB)'.format(
+        *(memory.get(key, 0) / 2 ** 20 for key in ('rss', 'anon', 'file')))
+
+
+def search_parameters(index, nprobe=None, ef_search=None):
+    """
+    Builds per-request search parameters for ``index``: ``nprobe`` for IVF
+    indexes and ``efSearch`` for HNSW, falling back to the configured defaults.
+    Returns None for index types without tunable parameters.
+    """
+    inner = base_index(index)
+    if isinstance(inner, faiss.IndexIVF):
+        return faiss.SearchParametersIVF(nprobe=nprobe or settings.FAISS_NPROBE)
+    if isinstance(inner, faiss.IndexHNSW):
+        return faiss.SearchParametersHNSW(efSearch=ef_search or settings.FAISS_EF_SEARCH)
+    return None
+
+
+def load_vectors(queryset):
+    """
+    Returns ``(prompt_ids, vectors)`` for the embeddings in ``queryset`` as
+    NumPy arrays, skipping vectors whose dimension differs from the first one.
+    """
+    prompt_ids = []
+    vectors = []
+    for prompt_id, vector in queryset.values_list('prompt_id', 'vector').iterator(chunk_size=DELTA_BATCH_SIZE):
+        if vectors and len(vector) != len(vectors[0]):
+            continue
+        prompt_ids.append(prompt_id)
+        vectors.append(vector)
+    if not vectors:
+        return np.empty(0, dtype='int64'), np.empty((0, 0), dtype='float32')
+    return np.asarray(prompt_ids, dtype='int64'), np.vstack(vectors).astype('float32', copy=False)
+
+
+def _widen(params, index):
+    """
+    Makes an approximate search visit more of the index. Returns False if
+    ``params`` already cover the whole index.
+    """
+    inner = base_index(index)
+    if isinstance(inner, faiss.IndexIVF):
+        if params.nprobe >= inner.nlist:
+            return False
+        params.nprobe = min(params.nprobe * 4, inner.nlist)
+        return True
+    if isinstance(inner, faiss.IndexHNSW):
+        if params.efSearch >= index.ntotal:
+            return False
+        params.efSearch = min(params.efSearch * 4, index.ntotal)
+        return True
+    return False
+
+
+def rerank(vectors, labels, stored_ids, stored_vectors, k):
+    """
+    Re-ranks the candidate ``labels`` of each query in ``vectors`` by their
+    exact distance to the query and returns the top ``k`` as ``(distances,
+    labels)``, padded with -1 like a FAISS search. ``stored_ids`` and
+    ``stored_vectors`` hold the exact vector of each candidate label.
+    """
+    k = min(k, labels.shape[1])
+    inner_product = settings.FAISS_METRIC == 'ip'
+    distances = np.full((len(vectors), k), np.finfo('float32').max, dtype='float32')
+    if inner_product:
+        distances = -distances
+    ranked = np.full((len(vectors), k), -1, dtype='int64')
+
+    row_of = {label: row for row, label in enumerate(stored_ids.tolist())}
+    for i, (query, row_labels) in enumerate(zip(vectors, labels)):
+        # A prompt may appear twice until the next rebuild
+        found = list(dict.fromkeys(label for label in row_labels.tolist() if label in row_of))
+        if not found:
+            continue
+        candidates = stored_vectors[[row_of[label] for label in found]]
+        if inner_product:
+            scores = candidates @ query
+            order = np.argsort(-scores, kind='stable')[:k]
+        else:
+            scores = ((candidates - query) ** 2).sum(axis=1)
+            order = np.argsort(scores, kind='stable')[:k]
+        distances[i, :len(order)] = scores[order]
+        ranked[i, :len(order)] = np.asarray(found, dtype='int64')[order]
+    return distances, ranked
+
+
+def cosine_distance(distances, metric=None):
+    """
+    Converts distances reported by the index for unit-length vectors into
+    cosine distances: 0 for the same direction, up to 2 for opposite ones.
+    Squared L2 distances are halved, inner products subtracted from one.
+    """
+    distances = np.asarray(distances, dtype='float32')
+    if (metric or settings.FAISS_METRIC) == 'ip':
+        return 1.0 - distances
+    return distances / 2.0
+
+
+def recall_at_k(exact_labels, approx_labels):
+    """
+    Returns the mean fraction of the exact top-k neighbours that were also
+    found by the approximate search.
+    """
+    hits = 0
+    for exact, approx in zip(exact_labels, approx_labels):
+        hits += len(set(exact[exact != -1]) & set(approx[approx != -1]))
+    return hits / exact_labels.size
+
+
+def atomic_write(path, writer):
+    """
+    Calls ``writer`` with a temporary path in the same directory as ``path``
+    and renames the result over ``path`` once it has been fully written.
+    """
+    directory, name = os.path.split(path)
+    fd, tmp_path = tempfile.mkstemp(dir=directory or None, prefix=f'.{name}.', suffix='.tmp')
+    os.close(fd)
+    try:
+        writer(tmp_path)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+
+
+def settled_before():
+    """
+    Returns the timestamp before which every created embedding has committed,
+    to be taken before the delta log is read.
+    """
+    return timezone.now().timestamp() - settings.FAISS_DELTA_SETTLE_SECONDS
+
+
+def advance_watermark(watermark, recent, settled):
+    """
+    Returns ``(watermark, recent)`` moved up past the embeddings of ``recent``,
+    a dict of the creation timestamps of the embeddings above ``watermark``
+    already seen, created before the timestamp ``settled``.
+    """
+    settled_ids = [embedding_id for embedding_id, created in recent.items() if created <= settled]
+    if not settled_ids:
+        return watermark, recent
+    watermark = max(watermark, *settled_ids)
+    return watermark, {embedding_id: created for embedding_id, created in recent.items() if embedding_id > watermark}
+
+
+def model_slug(model_name):
+    """Returns ``model_name`` reduced to characters safe in a file name."""
+    return re.sub(r'[^A-Za-z0-9_-]+', '_', model_name)
+
+
+def index_path(model_name):
+    """Returns the base index path of the embedding model ``model_name``."""
+    if model_name == settings.EMBEDDING_MODEL:
+        return INDEX_PATH
+    root, ext = os.path.splitext(INDEX_PATH)
+    return f'{root}.{model_slug(model_name)}{ext}'
+
+
+class PromptIndexManager:
+    """
+    Loads, incrementally updates and publishes the prompt similarity index.
+
+    ``index`` is what searches run against: the mapped snapshot (``base``) and
+    the in-memory ``delta`` as shards of one ``IndexShards``, or only the delta
+    before anything has been published.
+
+    Re-embedded prompts may briefly appear twice until the next rebuild, and
+    deleted prompts stay in the index; both are dropped when the matching
+    prompts are fetched from the database.
+
+    With a ``model_name``, only the embeddings by that model are indexed.
+    """
+
+    def __init__(self, index_path=INDEX_PATH, snapshot_every=None, model_name=None):
+        root, ext = os.path.splitext(index_path)
+        self.index_path = index_path
+        self.model_name = model_name
+        self.snapshot_template = f'{root}.{{generation:06d}}{ext}'
+        self.manifest_path = f'{root}.json'
+        self.lock_path = f'{root}.lock'
+        self.trained_template = f'{root}.{{index_type}}.trained{ext}'
+        if snapshot_every is None:
+            snapshot_every = settings.FAISS_SNAPSHOT_EVERY
+        self.snapshot_every = snapshot_every
+
+        self.index = None
+        # Read-only snapshot and the index of the embeddings added on top of it
+        self.base = None
+        self.delta = None
+        # (prompt_ids, vectors) added to the delta, written with the snapshot on publish
+        self.delta_rows = []
+        self.generation = 0
+        self.watermark = 0
+        # Creation timestamps of the embeddings above the watermark already added
+        self.recent = {}
+        # Delta-log entries applied on top of the loaded snapshot
+        self.pending = 0
+        # Manifest stamp the in-memory index was loaded from
+        self.stamp = None
+        # Thread publishing a snapshot in the background, if any
+        self.publisher = None
+        self._lock = threading.RLock()
+
+    def snapshot_path(self, generation):
+        return self.snapshot_template.format(generation=generation)
+
+    def trained_path(self, index_type=None):
+        return self.trained_template.format(index_type=index_type or settings.FAISS_INDEX_TYPE)
+
+    def new_index(self, dim):
+        """
+        Returns an empty index of the configured type, copied from the trained
+        template when the type needs training. Falls back to a flat index if no
+        template has been trained for this dimension yet.
+        """
+        index = build_index(dim)
+        if index.is_trained:
+            return index
+
+        path = self.trained_path()
+        if os.path.exists(path):
+            trained = faiss.read_index(path)
+            if trained.d == dim:
+                return trained
+
+        logger.warning("No trained '%s' index for dimension %d; using a flat index until "
+                       "'manage.py train_prompt_index' has been run", settings.FAISS_INDEX_TYPE, dim)
+        return build_index(dim, 'flat')
+
+    def read_manifest(self):
+        """
+        Returns the manifest of the current snapshot, or None if nothing has
+        been published yet.
+        """
+        try:
+            with open(self.manifest_path) as fh:
+                return json.load(fh)
+        except FileNotFoundError:
+            return None
+        except ValueError:
+            logger.warning('Ignoring unreadable FAISS manifest %s', self.manifest_path)
+            return None
+
+    def manifest_stamp(self):
+        """
+        Returns a cheap version stamp of the manifest. Publishing renames a
+        new file into place, so the stamp changes with every new snapshot.
+        """
+        try:
+            stat = os.stat(self.manifest_path)
+        except FileNotFoundError:
+            return None
+        return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+    def load(self):
+        """
+        Loads the latest snapshot, applies the delta log on top of it and
+        publishes a new snapshot once enough deltas have accumulated.
+        Returns the index, or None if there are no embeddings yet.
+        """
+        with self._lock:
+            self._load_snapshot()
+            self.apply_deltas()
+            if self._publish_due():
+                self.publish()
+            return self.index
+
+    def get(self):
+        """
+        Returns the process-resident index. The snapshot is only re-read when
+        another process has published a new one; otherwise only embeddings
+        created since the last call are added. Once enough deltas have
+        accumulated, a new snapshot is published in the background.
+        """
+        with self._lock:
+            if self.index is None or self.manifest_stamp() != self.stamp:
+                self._load_snapshot()
+            self.apply_deltas()
+            if self._publish_due():
+                self._publish_in_background()
+            return self.index
+
+    def wait_for_publish(self, timeout=None):
+        """Waits until the snapshot being published in the background, if any, is written."""
+        publisher = self.publisher
+        if publisher is not None:
+            publisher.join(timeout)
+
+    def position(self):
+        """
+        Returns ``(watermark, recent)`` of the process-resident index brought
+        up to date: it holds every embedding up to the watermark and those of
+        ``recent``, a dict of creation timestamps, above it.
+        """
+        with self._lock:
+            self.get()
+            return self.watermark, dict(self.recent)
+
+    def search(self, vectors, k, nprobe=None, ef_search=None, candidates=None):
+        """
+        Searches the process-resident index for the ``k`` nearest prompts of
+        each row in ``vectors``. ``nprobe`` and ``ef_search`` tune IVF and
+        HNSW indexes for this call only. Returns ``(distances, prompt_ids)``,
+        or None if the index is empty.
+
+        ``candidates`` is an optional ``PromptEmbedding`` queryset restricting
+        which prompts may be returned. The restriction is applied inside the
+        search, so up to ``k`` matching prompts are returned however selective
+        it is.
+
+        Compressed indexes return ``k * FAISS_RERANK_FACTOR`` candidates, which
+        are re-ranked with the exact vectors stored in ``PromptEmbedding``.
+        """
+        if candidates is not None:
+            return self._filtered_search(vectors, k, candidates, nprobe, ef_search)
+
+        with self._lock:
+            index = self.get()
+            if index is None or index.ntotal == 0:
+                return None
+            params = search_parameters(index, nprobe=nprobe, ef_search=ef_search)
+            fetch_k = self._fetch_count(index, k)
+            distances, labels = index.search(vectors, min(fetch_k, index.ntotal), params=params)
+        return self._rerank(vectors, distances, labels, k)
+
+    @staticmethod
+    def _fetch_count(index, k):
+        """Returns how many candidates to fetch from ``index`` for ``k`` results."""
+        if isinstance(base_index(index), COMPRESSED_INDEX_TYPES):
+            return k * max(settings.FAISS_RERANK_FACTOR, 1)
+        return k
+
+    def _rerank(self, vectors, distances, labels, k):
+        """Re-ranks more than ``k`` candidates per query with the stored exact vectors."""
+        if labels.shape[1] <= k:
+            return distances, labels
+        prompt_ids, matrix = load_vectors(
+            self.embeddings().filter(prompt_id__in=np.unique(labels[labels != -1]).tolist()))
+        if not len(prompt_ids) or matrix.shape[1] != vectors.shape[1]:
+            return distances[:, :k], labels[:, :k]
+        return rerank(vectors, labels, prompt_ids, matrix, k)
+
+    def _filtered_search(self, vectors, k, candidates, nprobe, ef_search):
+        exact_max = settings.FAISS_EXACT_FILTER_MAX
+        if candidates.values('pk')[:exact_max + 1].count() <= exact_max:
+            # Few enough candidates to compare against all of them directly
+            prompt_ids, matrix = load_vectors(candidates)
+            if not len(prompt_ids) or matrix.shape[1] != vectors.shape[1]:
+                return None
+            k = min(k, len(prompt_ids))
+            distances, positions = faiss.knn(vectors, matrix, k, metric=METRICS[settings.FAISS_METRIC])
+            return distances, prompt_ids[positions]
+
+        selector = faiss.IDSelectorBatch(
+            np.fromiter(candidates.values_list('prompt_id', flat=True).iterator(), dtype='int64'))
+        with self._lock:
+            index = self.get()
+            if index is None or index.ntotal == 0:
+                return None
+            fetch_k = min(self._fetch_count(index, k), index.ntotal)
+            params = search_parameters(index, nprobe=nprobe, ef_search=ef_search) or faiss.SearchParameters()
+            params.sel = selector
+            distances, labels = index.search(vectors, fetch_k, params=params)
+
+            # Approximate indexes only visit part of the data and may find fewer than
+            # k matches under a selective filter; widen the search until they do
+            for _ in range(FILTER_WIDEN_ATTEMPTS):
+                if (labels != -1).sum(axis=1).min() >= min(k, fetch_k) or not _widen(params, index):
+                    break
+                distances, labels = index.search(vectors, fetch_k, params=params)
+        return self._rerank(vectors, distances, labels, k)
+
+    def _reset(self):
+        self.index = None
+        self.base = None
+        self.delta = None
+        self.delta_rows = []
+        self.generation = 0
+        self.watermark = 0
+        self.recent = {}
+        self.pending = 0
+
+    def _load_snapshot(self):
+        self.stamp = self.manifest_stamp()
+        manifest = self.read_manifest()
+        self._reset()
+
+        if manifest:
+            try:
+                self._map_snapshot(manifest)
+            except RuntimeError:
+                # The snapshot may have been pruned by a newer publish; retry with the new manifest
+                latest = self.read_manifest()
+                if not latest or latest['generation'] == manifest['generation']:
+                    raise
+                logger.info('Snapshot %s was replaced while loading, retrying', manifest['generation'])
+                return self._load_snapshot()
+
+    def _map_snapshot(self, manifest):
+        """
+        Makes the snapshot described by ``manifest`` the base of the index,
+        dropping the delta. The previous mapping is released once no search
+        uses it any more.
+        """
+        before = process_memory()
+        base = read_snapshot(self.snapshot_path(manifest['generation']), manifest.get('index_type'))
+        index = faiss.IndexShards(base.d, False, False)
+        index.add_shard(base)
+
+        self.base, self.index = base, index
+        self.delta = None
+        self.delta_rows = []
+        self.generation = manifest['generation']
+        self.watermark = manifest['watermark']
+        self.recent = {int(embedding_id): created for embedding_id, created in manifest.get('recent', ())}
+        self.pending = 0
+        logger.info('Loaded FAISS snapshot %d (%d vectors%s): %s, before %s',
+                    self.generation, base.ntotal, ', memory-mapped' if settings.FAISS_MMAP else '',
+                    format_memory(process_memory()), format_memory(before))
+
+    def _publish_due(self):
+        return self.index is not None and (self.generation == 0 or self.pending >= self.snapshot_every)
+
+    def _publish_in_background(self):
+        if self.publisher is not None and self.publisher.is_alive():
+            return
+        self.publisher = threading.Thread(target=self._run_publisher, name='faiss-publish', daemon=True)
+        self.publisher.start()
+
+    def _run_publisher(self):
+        try:
+            self.publish()
+        except Exception:
+            logger.exception('Publishing FAISS snapshot %s failed', self.index_path)
+
+    def embeddings(self):
+        """Returns the ``PromptEmbedding`` queryset this index is built from."""
+        if self.model_name is None:
+            return PromptEmbedding.objects.all()
+        return PromptEmbedding.objects.filter(model_name=self.model_name)
+
+    def fetch_deltas(self):
+        """
+        Yields ``(embedding_id, prompt_id, vector, created_at)`` for every
+        embedding above the current watermark not added yet, oldest first.
+        """
+        rows = self.embeddings().filter(id__gt=self.watermark).order_by('id')
+        fields = ('id', 'prompt_id', 'vector', 'created_at')
+        if not self.recent:
+            return rows.values_list(*fields).iterator(chunk_size=DELTA_BATCH_SIZE)
+
+        # Only the ids are read again for embeddings added before
+        ids = rows.values_list('id', flat=True).iterator(chunk_size=DELTA_BATCH_SIZE)
+        new_ids = [embedding_id for embedding_id in ids if embedding_id not in self.recent]
+        return (row for start in range(0, len(new_ids), DELTA_BATCH_SIZE)
+                for row in rows.filter(id__in=new_ids[start:start + DELTA_BATCH_SIZE]).values_list(*fields))
+
+    def apply_deltas(self):
+        """
+        Adds every embedding above the current watermark not added yet to the
+        index and returns the number of vectors added.
+        """
+        settled = settled_before()
+        added = 0
+        batch = []
+        for row in self.fetch_deltas():
+            batch.append(row)
+            if len(batch) >= DELTA_BATCH_SIZE:
+                added += self._add_batch(batch)
+                batch = []
+        if batch:
+            added += self._add_batch(batch)
+
+        self.watermark, self.recent = advance_watermark(self.watermark, self.recent, settled)
+        self.pending += added
+        return added
+
+    def _add_batch(self, rows):
+        embedding_ids, prompt_ids, vectors, created = zip(*rows)
+        self.recent.update(zip(embedding_ids, (created_at.timestamp() for created_at in created)))
+
+        if self.index is None:
+            # Nothing published yet: the delta is the whole index
+            self.index = self.delta = self.new_index(len(vectors[0]))
+        elif self.delta is None:
+            self.delta = self.new_index(self.base.d)
+            if (isinstance(base_index(self.delta), faiss.IndexIVF)
+                    and not isinstance(base_index(self.base), faiss.IndexIVF)):
+                # Search parameters follow the snapshot's type, which IVF indexes reject
+                self.delta = build_index(self.base.d, 'flat')
+            self.index.add_shard(self.delta)
+
+        dim = self.index.d
+        keep = [i for i, vector in enumerate(vectors) if len(vector) == dim]
+        if len(keep) != len(vectors):
+            logger.warning('Skipping %d embeddings whose dimension differs from %d',
+                           len(vectors) - len(keep), dim)
+        if not keep:
+            return 0
+
+        matrix = np.vstack([vectors[i] for i in keep]).astype('float32', copy=False)
+        labels = np.asarray([prompt_ids[i] for i in keep], dtype='int64')
+        self.delta.add_with_ids(matrix, labels)
+        # Publishing writes these rows into a copy, as the index stays in use meanwhile
+        self.delta_rows.append((labels, matrix))
+        if self.base is not None:
+            self.index.syncWithSubIndexes()
+        return len(keep)
+
+    def rebuild(self):
+        """
+        Builds the index from scratch out of every stored embedding and
+        publishes it. Returns the index, or None if there are no embeddings.
+        """
+        with self._lock:
+            self._reset()
+            self.apply_deltas()
+            if self.index is not None:
+                self.publish(force=True)
+            return self.index
+
+    def save_trained(self, index, index_type=None):
+        """Stores an empty trained index as the template for new indexes."""
+        atomic_write(self.trained_path(index_type), lambda path: faiss.write_index(index, path))
+
+    def publish(self, force=False):
+        """
+        Writes the in-memory index as a new snapshot and points the manifest
+        at it. Only one process publishes at a time; if another one holds the
+        lock, or has already published an equally recent snapshot, this is a
+        no-op. Returns True if a snapshot was written.
+
+        The snapshot is written without holding up searches: embeddings added
+        meanwhile are read from the delta log again on top of it.
+        """
+        lock = FileLock(self.lock_path, timeout=0)
+        try:
+            lock.acquire()
+        except Timeout:
+            return False
+
+        try:
+            with self._lock:
+                state = self._publish_state(force)
+            if state is None:
+                return False
+            base_generation, dim, rows, manifest = state
+
+            # The mapped snapshot is read-only: write a private copy with the delta added
+            index = faiss.read_index(self.snapshot_path(base_generation)) if base_generation else self.new_index(dim)
+            for labels, matrix in rows:
+                index.add_with_ids(matrix, labels)
+            generation = manifest['generation']
+            atomic_write(self.snapshot_path(generation), functools.partial(faiss.write_index, index))
+            manifest.update(ntotal=int(index.ntotal), dim=int(index.d), index_type=type(base_index(index)).__name__)
+            atomic_write(self.manifest_path,
+                         lambda path: _write_json(path, manifest))
+            del index
+
+            with self._lock:
+                # Unless another worker's snapshot was loaded meanwhile, map the one just written
+                if self.generation == base_generation:
+                    self._map_snapshot(manifest)
+                    self.stamp = self.manifest_stamp()
+            self._prune(generation)
+            logger.info('Published FAISS snapshot %d (%d vectors, watermark %d)',
+                        generation, manifest['ntotal'], manifest['watermark'])
+            return True
+        finally:
+            lock.release()
+
+    def _publish_state(self, force):
+        """
+        Returns ``(base_generation, dim, delta_rows, manifest)`` to publish the
+        in-memory index with, or None if there is nothing to publish.
+        """
+        if self.index is None:
+            return None
+        current = self.read_manifest()
+        if current and self._covered_by(current) and not force:
+            return None
+        if self.base is not None and (current is None or current['generation'] != self.generation):
+            # Another worker published since our snapshot was mapped and it may be
+            # pruned already; the next get() reloads the newer one instead
+            return None
+
+        manifest = {
+            'generation': (current['generation'] if current else 0) + 1,
+            'watermark': self.watermark,
+            'recent': sorted(self.recent.items()),
+        }
+        return self.generation, self.index.d, list(self.delta_rows), manifest
+
+    def _covered_by(self, manifest):
+        """Returns whether the snapshot of ``manifest`` holds every embedding added here."""
+        recent = {embedding_id for embedding_id, _ in manifest.get('recent', ())}
+        return manifest['watermark'] >= self.watermark and all(
+            embedding_id <= manifest['watermark'] or embedding_id in recent for embedding_id in self.recent)
+
+    def _prune(self, generation):
+        """
+        Removes snapshots older than the previous generation, leaving readers
+        that are still opening it a grace period.
+        """
+        for old in range(generation - 2, 0, -1):
+            path = self.snapshot_path(old)
+            if not os.path.exists(path):
+                break
+            os.unlink(path)
+
+
+def _write_json(path, data):
+    with open(path, 'w') as fh:
+        json.dump(data, fh)
+
+
+class ActivePromptIndex:
+    """
+    The ``PromptIndexManager`` of the active embedding model, to which every
+    attribute is delegated. Each model's manager is created on first use and
+    kept, so switching back and forth does not reload a snapshot twice.
+    """
+
+    def __init__(self):
+        self._managers = {}
+        self._lock = threading.Lock()
+
+    def manager(self, model_name=None):
+        """Returns the index manager of ``model_name`` (default: the active model)."""
+        model_name = model_name or EmbeddingModel.active_name()
+        with self._lock:
+            if model_name not in self._managers:
+                self._managers[model_name] = PromptIndexManager(index_path(model_name), model_name=model_name)
+            return self._managers[model_name]
+
+    def __getattr__(self, name):
+        return getattr(self.manager(), name)
+
+
+# Process-resident indexes shared by every request handled by this worker
+prompt_index = ActivePromptIndex()
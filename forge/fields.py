@@ -0,0 +1,83 @@
+import numpy as np
+from django.db import models
+
+# Storage dtype of Float32VectorField: little-endian float32
+VECTOR_DTYPE = np.dtype('<f4')
+
+
+def to_vector(value, normalize=False):
+    """
+    Converts a list, buffer or array to a 1-D float32 NumPy array, optionally
+    scaled to unit L2 norm. Zero vectors are returned unchanged.
+    """
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        vector = np.frombuffer(value, dtype=VECTOR_DTYPE)
+    else:
+        vector = np.asarray(value, dtype=VECTOR_DTYPE).reshape(-1)
+
+    if normalize and vector.size:
+        norm = np.linalg.norm(vector)
+        if norm > 0:
+            vector = vector / norm
+    return vector
+
+
+def normalize_rows(matrix):
+    """
+    Returns ``matrix`` as a C-contiguous float32 array whose rows are scaled to
+    unit L2 norm. Zero rows are returned unchanged.
+    """
+    matrix = np.array(matrix, dtype='float32', ndmin=2)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    np.divide(matrix, norms, out=matrix, where=norms > 0)
+    return matrix
+
+
+class Float32VectorField(models.BinaryField):
+    """
+    Stores a vector as packed little-endian float32 bytes, half the size of a
+    ``double precision[]`` column. Values read from the database are read-only
+    NumPy arrays that share memory with the fetched bytes, so no per-element
+    Python floats are created.
+
+    With ``normalize=True`` vectors are scaled to unit length when saved, which
+    makes L2 and inner-product search rank results by cosine similarity.
+    """
+    description = 'Vector of float32 values'
+
+    def __init__(self, *args, normalize=False, **kwargs):
+        self.normalize = normalize
+        super().__init__(*args, **kwargs)
+
+    def deconstruct(self):
+        name, path, args, kwargs = super().deconstruct()
+        if self.normalize:
+            kwargs['normalize'] = True
+        return name, path, args, kwargs
+
+    def from_db_value(self, value, expression, connection):
+        if value is None:
+            return value
+        return np.frombuffer(value, dtype=VECTOR_DTYPE)
+
+    def to_python(self, value):
+        if value is None or isinstance(value, np.ndarray):
+            return value
+        return to_vector(value)
+
+    def pre_save(self, model_instance, add):
+        value = getattr(model_instance, self.attname)
+        if value is not None:
+            value = to_vector(value, normalize=self.normalize)
+            setattr(model_instance, self.attname, value)
+        return value
+
+    def get_prep_value(self, value):
+        value = super().get_prep_value(value)
+        if value is None:
+            return value
+        return to_vector(value, normalize=self.normalize).tobytes()
+
+    def value_to_string(self, obj):
+        value = self.value_from_object(obj)
+        return None if value is None else to_vector(value).tolist()
@@ -0,0 +1,132 @@
+"""
+Hybrid lexical and vector search for prompts.
+
+The lexical side is a PostgreSQL full-text query on ``Prompt.text`` and
+``Prompt.response`` served by the GIN index of migration 0003; it finds exact
+identifiers and rare tokens that embeddings blur. Both rankings are combined
+with reciprocal-rank fusion (RRF), which only needs ranks, so FAISS distances
+and ``ts_rank`` scores never have to be put on a common scale.
+
+On PostgreSQL the lexical query runs in a worker thread alongside the vector
+search, under a ``statement_timeout`` derived from the request's latency budget.
+If it does not finish in time, the vector results are returned on their own.
+"""
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+
+from django.conf import settings
+from django.contrib.postgres.search import SearchQuery, SearchRank, SearchVector
+from django.db import DatabaseError, close_old_connections, connection, transaction
+from django.db.models import F, Q
+
+from .models import Prompt
+
+logger = logging.getLogger(__name__)
+
+# Text search configuration of the GIN index
+SEARCH_CONFIG = 'english'
+
+# RRF damping constant: larger values flatten the weight of the top ranks
+RRF_K = 60
+
+_executor = ThreadPoolExecutor(max_workers=settings.SIMILAR_HYBRID_WORKERS, thread_name_prefix='lexical')
+
+
+def prompt_document():
+    """
+    Full-text document of a prompt. Must compile to the same expression as
+    the index of migration 0003, or PostgreSQL cannot use the index.
+    """
+    return SearchVector('text', 'response', config=SEARCH_CONFIG)
+
+
+def lexical_search(query, limit, candidates=None, timeout_ms=None):
+    """
+    Returns the ids of up to ``limit`` prompts matching ``query``, best first.
+    ``candidates`` is an optional ``PromptEmbedding`` queryset restricting the
+    prompts searched. On PostgreSQL this is an indexed full-text query
+    cancelled after ``timeout_ms``; elsewhere a substring match ordered by
+    recency.
+    """
+    prompts = Prompt.objects.filter(status=Prompt.STATUS_COMPLETED)
+    if candidates is not None:
+        prompts = prompts.filter(id__in=candidates.values('prompt_id'))
+
+    if connection.vendor != 'postgresql':
+        prompts = prompts.filter(Q(text__icontains=query) | Q(response__icontains=query)).order_by('-created_at')
+        return list(prompts.values_list('id', flat=True)[:limit])
+
+    search_query = SearchQuery(query, config=SEARCH_CONFIG, search_type='websearch')
+    prompts = (
+        prompts
+        .annotate(document=prompt_document())
+        .filter(document=search_query)
+        .annotate(rank=SearchRank(F('document'), search_query))
+        .order_by('-rank', '-id')
+        .values_list('id', flat=True)
+    )
+    with transaction.atomic():
+        if timeout_ms:
+            with connection.cursor() as cursor:
+                cursor.execute('SET LOCAL statement_timeout = %s', [int(timeout_ms)])
+        return list(prompts[:limit])
+
+
+def reciprocal_rank_fusion(rankings, rrf_k=RRF_K):
+    """
+    Merges several rankings of ids into one. Each id scores the sum of
+    ``1 / (rrf_k + rank)`` over the rankings it appears in; ties keep the
+    order in which ids were first seen.
+    """
+    scores = {}
+    for ranking in rankings:
+        for rank, item in enumerate(ranking, start=1):
+            scores[item] = scores.get(item, 0.0) + 1.0 / (rrf_k + rank)
+    return sorted(scores, key=scores.get, reverse=True)
+
+
+def _lexical_task(query, limit, candidates, timeout_ms):
+    # Runs in a pool thread, which manages its own connection like a request would
+    close_old_connections()
+    try:
+        return lexical_search(query, limit, candidates, timeout_ms)
+    finally:
+        close_old_connections()
+
+
+def candidate_limit(k):
+    """Returns how many prompts each side of a hybrid search for ``k`` results ranks."""
+    return k * settings.SIMILAR_HYBRID_CANDIDATE_FACTOR
+
+
+def hybrid_search(query, k, vector_search, candidates=None):
+    """
+    Returns the ids of the ``k`` best prompts for ``query`` by fusing the
+    full-text ranking with ``vector_search(limit)``, a callable returning
+    ranked prompt ids. ``candidates`` is the ``PromptEmbedding`` queryset the
+    vector search is restricted to, if any; the full-text search is restricted
+    to the same prompts. Both run within ``SIMILAR_HYBRID_BUDGET_MS``.
+    """
+    budget = settings.SIMILAR_HYBRID_BUDGET_MS / 1000
+    deadline = time.monotonic() + budget
+    limit = candidate_limit(k)
+
+    future = None
+    lexical_ids = []
+    if connection.vendor == 'postgresql':
+        future = _executor.submit(_lexical_task, query, limit, candidates, budget * 1000)
+    else:
+        # Without a server to run it concurrently on, the fallback runs inline
+        lexical_ids = lexical_search(query, limit, candidates)
+
+    vector_ids = vector_search(limit)
+
+    if future is not None:
+        try:
+            lexical_ids = future.result(timeout=max(deadline - time.monotonic(), 0))
+        except (TimeoutError, DatabaseError):
+            logger.warning('Full-text search for a hybrid query exceeded %d ms; using vector results only',
+                           settings.SIMILAR_HYBRID_BUDGET_MS)
+
+    return reciprocal_rank_fusion([vector_ids, lexical_ids])[:k]
@@ -0,0 +1,242 @@
+"""
+Out-of-process inference over a Unix domain socket.
+
+``manage.py run_inference_server`` loads the generation and embedding models
+once and serves every web worker on the host through an ``InferenceServer``.
+Web workers then hold no model: with ``INFERENCE_SERVER_SOCKET`` set,
+``forge.utils`` sends its model calls through an ``InferenceClient`` instead,
+and concurrent prompts from all workers are micro-batched by the server.
+
+Messages are length-prefixed binary frames: a one-byte kind and a four-byte
+payload length, followed by the payload. Strings are UTF-8, lists of strings
+are prefixed with their count and each string with its length. Texts to embed
+are preceded by the name of the embedding model, and embeddings are returned
+as their shape followed by the raw little-endian float32 matrix.
+A streamed generation is answered with one ``CHUNK`` frame per piece of text,
+then the ``RESULT`` frame; failures are answered with an ``ERROR`` frame.
+"""
+import json
+import logging
+import os
+import socket
+import socketserver
+import struct
+import threading
+import time
+
+import numpy as np
+
+from .metrics import INFERENCE_CLIENT_SECONDS
+
+logger = logging.getLogger(__name__)
+
+# Frame header: kind, payload length
+HEADER = struct.Struct('!BI')
+LENGTH = struct.Struct('!I')
+SHAPE = struct.Struct('!II')
+
+# Largest payload accepted, to fail fast on a corrupt stream
+MAX_PAYLOAD_BYTES = 64 * 2 ** 20
+
+# Request kinds
+GENERATE = 1
+STREAM = 2
+EMBED = 3
+
+# Reply kinds
+RESULT = 0x80
+CHUNK = 0x81
+ERROR = 0x82
+
+VECTOR_WIRE_DTYPE = np.dtype('<f4')
+
+
+class InferenceError(Exception):
+    """Raised when the inference server fails a request or cannot be reached."""
+
+
+def pack_strings(strings):
+    parts = [LENGTH.pack(len(strings))]
+    for string in strings:
+        data = string.encode('utf-8')
+        parts += [LENGTH.pack(len(data)), data]
+    return b''.join(parts)
+
+
+def unpack_strings(payload):
+    view = memoryview(payload)
+    (count,), offset = LENGTH.unpack_from(view), LENGTH.size
+    strings = []
+    for _ in range(count):
+        (length,), offset = LENGTH.unpack_from(view, offset), offset + LENGTH.size
+        strings.append(str(view[offset:offset + length], 'utf-8'))
+        offset += length
+    return strings
+
+
+def pack_vectors(vectors):
+    vectors = np.ascontiguousarray(vectors, dtype=VECTOR_WIRE_DTYPE)
+    return SHAPE.pack(*vectors.shape) + vectors.tobytes()
+
+
+def unpack_vectors(payload):
+    rows, dim = SHAPE.unpack_from(payload)
+    return np.frombuffer(payload, dtype=VECTOR_WIRE_DTYPE, offset=SHAPE.size).reshape(rows, dim).astype('float32')
+
+
+def send_frame(sock, kind, payload=b''):
+    sock.sendall(HEADER.pack(kind, len(payload)) + payload)
+
+
+def recv_frame(sock):
+    """Returns the ``(kind, payload)`` of the next frame on ``sock``."""
+    kind, length = HEADER.unpack(_recv_exactly(sock, HEADER.size))
+    if length > MAX_PAYLOAD_BYTES:
+        raise ConnectionError(f'Frame of {length} bytes exceeds the {MAX_PAYLOAD_BYTES} byte limit')
+    return kind, _recv_exactly(sock, length)
+
+
+def _recv_exactly(sock, size):
+    buffer = bytearray(size)
+    view = memoryview(buffer)
+    received = 0
+    while received < size:
+        count = sock.recv_into(view[received:])
+        if not count:
+            raise ConnectionError('Connection closed by peer')
+        received += count
+    return bytes(buffer)
+
+
+class InferenceClient:
+    """
+    Sends model calls to the inference server listening on ``path``. Each
+    thread keeps its own connection open between requests; a connection the
+    server has closed (e.g. after a restart) is replaced once. Every socket
+    operation gives up after ``timeout`` seconds.
+    """
+
+    def __init__(self, path, timeout):
+        self.path = path
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def generate(self, prompt, params):
+        """Returns the completion of ``prompt`` generated with the sampling ``params``."""
+        payload = pack_strings([prompt, json.dumps(params, sort_keys=True)])
+        return self._request(GENERATE, payload).decode('utf-8')
+
+    def stream(self, prompt, on_text, params):
+        """Like ``generate``, calling ``on_text`` with each piece of text as it is generated."""
+        payload = pack_strings([prompt, json.dumps(params, sort_keys=True)])
+        return self._request(STREAM, payload, on_text).decode('utf-8')
+
+    def embed(self, texts, model_name):
+        """Returns the float32 embedding matrix of ``texts`` by ``model_name``, one row per text."""
+        return unpack_vectors(self._request(EMBED, pack_strings([model_name, *texts])))
+
+    def close(self):
+        """Closes the connection of the calling thread."""
+        sock = getattr(self._local, 'sock', None)
+        self._local.sock = None
+        if sock is not None:
+            sock.close()
+
+    def _connection(self):
+        if getattr(self._local, 'pid', None) != os.getpid():
+            # Never share a connection inherited from the parent of a forked process
+            self._local.sock, self._local.pid = None, os.getpid()
+        if self._local.sock is None:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(self.timeout)
+            try:
+                sock.connect(self.path)
+            except OSError:
+                sock.close()
+                raise
+            self._local.sock = sock
+        return self._local.sock
+
+    def _request(self, kind, payload, on_chunk=None):
+        op = {GENERATE: 'generate', STREAM: 'stream', EMBED: 'embed'}[kind]
+        started = time.perf_counter()
+        streamed = False
+        for attempt in range(2):
+            try:
+                sock = self._connection()
+                send_frame(sock, kind, payload)
+                reply, body = recv_frame(sock)
+                while reply == CHUNK:
+                    streamed = True
+                    on_chunk(body.decode('utf-8'))
+                    reply, body = recv_frame(sock)
+            except OSError as exc:
+                self.close()
+                # Retry stale connections, but never repeat a request that timed
+                # out or has already delivered part of its response
+                if attempt or streamed or isinstance(exc, TimeoutError):
+                    raise InferenceError(f'Inference server at {self.path} failed: {exc}') from exc
+                continue
+            break
+        INFERENCE_CLIENT_SECONDS.labels(op=op).observe(time.perf_counter() - started)
+        if reply == ERROR:
+            raise InferenceError(body.decode('utf-8'))
+        if reply != RESULT:
+            self.close()
+            raise InferenceError(f'Unexpected reply kind {reply:#x} from the inference server')
+        return body
+
+
+class InferenceServer(socketserver.ThreadingUnixStreamServer):
+    """
+    Serves model calls on the Unix socket ``path``, one thread per
+    connection. ``generate(prompt, params)``, ``stream(prompt, on_text,
+    params)`` and ``embed(texts, model_name)`` run the calls in this process.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, path, generate, stream, embed):
+        self.handlers = {GENERATE: generate, STREAM: stream, EMBED: embed}
+        super().__init__(path, _RequestHandler)
+
+    def dispatch(self, kind, payload, send_chunk):
+        """Runs the request of ``kind`` and returns its reply payload."""
+        if kind == EMBED:
+            model_name, *texts = unpack_strings(payload)
+            return pack_vectors(self.handlers[EMBED](texts, model_name))
+        if kind in (GENERATE, STREAM):
+            prompt, params = unpack_strings(payload)
+            params = json.loads(params)
+            if kind == STREAM:
+                return self.handlers[STREAM](prompt, send_chunk, params).encode('utf-8')
+            return self.handlers[GENERATE](prompt, params).encode('utf-8')
+        raise ValueError(f'Unknown request kind {kind:#x}')
+
+
+class _RequestHandler(socketserver.BaseRequestHandler):
+
+    def handle(self):
+        sock = self.request
+
+        def send_chunk(text):
+            send_frame(sock, CHUNK, text.encode('utf-8'))
+
+        try:
+            while True:
+                try:
+                    kind, payload = recv_frame(sock)
+                except ConnectionError:
+                    # The client closed its connection
+                    return
+                try:
+                    reply = self.server.dispatch(kind, payload, send_chunk)
+                except OSError:
+                    raise
+                except Exception as exc:
+                    logger.exception('Inference request of kind %#x failed', kind)
+                    send_frame(sock, ERROR, str(exc).encode('utf-8'))
+                else:
+                    send_frame(sock, RESULT, reply)
+        except OSError as exc:
+            logger.info('Inference client connection lost: %s', exc)
@@ -0,0 +1,199 @@
+import json
+import os
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Exists, OuterRef
+from prometheus_client import start_http_server
+
+from forge.faiss_index import atomic_write, model_slug, prompt_index
+from forge.metrics import REEMBEDDED_PROMPTS, REEMBEDDING_REMAINING_PROMPTS
+from forge.models import EmbeddingModel, Prompt, PromptEmbedding
+from forge.search_cache import similar_results
+from forge.utils import encode_texts
+
+
+class Command(BaseCommand):
+    help = (
+        "Embeds every prompt that has no embedding by an embedding model (default: "
+        "the active one), e.g. failed or bulk-loaded prompts, or every prompt "
+        "when re-embedding with a new model. Prompts are read in pages of "
+        "increasing id, encoded in batches of texts of similar length and stored "
+        "with bulk inserts. Progress is checkpointed after every page, so an "
+        "interrupted run resumes where it stopped. The new embeddings are then "
+        "added to the model's similarity index and published as a new snapshot. "
+        "With --activate the model then replaces the active one: the index of "
+        "the previous model serves searches until the switch."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--model', default=None,
+                            help='Embedding model to embed prompts with (default: the active model).')
+        parser.add_argument('--activate', action='store_true',
+                            help='Once every prompt is embedded, make --model the active embedding model.')
+        parser.add_argument('--batch-size', type=int, default=128,
+                            help='Texts encoded together in one forward pass.')
+        parser.add_argument('--page-size', type=int, default=4096,
+                            help='Prompts read, embedded and stored per page.')
+        parser.add_argument('--limit', type=int, default=None,
+                            help='Stop after embedding this many prompts.')
+        parser.add_argument('--checkpoint', default=None,
+                            help='File recording the last prompt id processed '
+                                 '(default: backfill_embeddings.<model>.json in the project directory).')
+        parser.add_argument('--restart', action='store_true',
+                            help='Ignore the checkpoint and start from the first prompt.')
+        parser.add_argument('--skip-index', action='store_true',
+                            help='Do not update the similarity index afterwards.')
+        parser.add_argument('--metrics-port', type=int, default=None,
+                            help='Serve the progress metrics for Prometheus on this port while running.')
+
+    def handle(self, *args, **options):
+        batch_size, page_size, limit = options['batch_size'], options['page_size'], options['limit']
+        if batch_size < 1 or page_size < 1 or (limit is not None and limit < 1):
+            raise CommandError('--batch-size, --page-size and --limit must be at least 1.')
+        if options['activate'] and (limit is not None or options['skip_index']):
+            raise CommandError('--activate embeds every prompt and publishes the index; '
+                               'it cannot be combined with --limit or --skip-index.')
+        model_name = options['model'] or EmbeddingModel.active_name()
+        checkpoint = options['checkpoint'] or os.path.join(
+            settings.BASE_DIR, f'backfill_embeddings.{model_slug(model_name)}.json')
+        if options['metrics_port']:
+            start_http_server(options['metrics_port'])
+
+        last_id = 0 if options['restart'] else self.read_checkpoint(checkpoint, model_name)
+        if last_id:
+            self.stdout.write(f'Resuming after prompt {last_id}')
+
+        embedded, finished = self.embed_missing(model_name, last_id, batch_size, page_size, limit, checkpoint)
+        if finished:
+            # The next run scans every prompt again
+            if os.path.exists(checkpoint):
+                os.unlink(checkpoint)
+        else:
+            self.stdout.write(f'Stopped after --limit {limit}, run again to resume')
+
+        if options['activate']:
+            self.activate(model_name, batch_size, page_size)
+        elif embedded and not options['skip_index']:
+            self.update_index(model_name)
+
+    def missing_prompts(self, model_name):
+        """Returns the prompts without an embedding by ``model_name``, in id order."""
+        # Prompts being processed get their embedding from their job
+        return (Prompt.objects
+                .filter(~Exists(PromptEmbedding.objects.filter(prompt=OuterRef('pk'), model_name=model_name)))
+                .exclude(status__in=[Prompt.STATUS_PENDING, Prompt.STATUS_RUNNING])
+                .order_by('id'))
+
+    def embed_missing(self, model_name, last_id, batch_size, page_size, limit=None, checkpoint=None):
+        """
+        Embeds the prompts after ``last_id`` missing an embedding by
+        ``model_name``, recording progress in ``checkpoint`` if given.
+        Returns ``(embedded, finished)``: how many prompts were embedded, and
+        whether no prompt is left.
+        """
+        missing = self.missing_prompts(model_name)
+        remaining = REEMBEDDING_REMAINING_PROMPTS.labels(model=model_name)
+        remaining.set(missing.filter(id__gt=last_id).count())
+
+        embedded = 0
+        finished = False
+        started = time.perf_counter()
+        while limit is None or embedded < limit:
+            size = page_size if limit is None else min(page_size, limit - embedded)
+            # Keyset pagination: each page starts after the last prompt of the previous one
+            page = list(missing.filter(id__gt=last_id).values_list('id', 'text')[:size])
+            if not page:
+                finished = True
+                break
+
+            stored = self.embed_page(page, batch_size, model_name)
+            embedded += stored
+            REEMBEDDED_PROMPTS.labels(model=model_name).inc(stored)
+            remaining.dec(len(page))
+            last_id = page[-1][0]
+            if checkpoint:
+                self.write_checkpoint(checkpoint, last_id, model_name)
+            self.stdout.write(f'{embedded} prompts embedded (up to prompt {last_id}), '
+                              f'{embedded / (time.perf_counter() - started):.1f} prompts/s')
+
+        seconds = time.perf_counter() - started
+        summary = (f'Embedded {embedded} prompts with {model_name} in {seconds:.1f}s '
+                   f'({embedded / seconds:.1f} prompts/s)')
+        self.stdout.write(self.style.SUCCESS(summary) if finished else summary)
+        return embedded, finished
+
+    def embed_page(self, page, batch_size, model_name):
+        """Embeds and stores the ``(prompt_id, text)`` rows of ``page``, returning how many were stored."""
+        # Sorted by length, each batch holds texts of similar length and pads little
+        page = sorted(page, key=lambda row: len(row[1]))
+        embeddings = []
+        for start in range(0, len(page), batch_size):
+            batch = page[start:start + batch_size]
+            vectors = encode_texts([text for _, text in batch], batch_size=batch_size, model_name=model_name)
+            embeddings += [
+                PromptEmbedding(prompt_id=prompt_id, vector=vector, model_name=model_name)
+                for (prompt_id, _), vector in zip(batch, vectors)
+            ]
+        # A prompt embedded meanwhile (e.g. by a retried job) keeps its embedding
+        PromptEmbedding.objects.bulk_create(embeddings, batch_size=1000, ignore_conflicts=True)
+        return len(embeddings)
+
+    def activate(self, model_name, batch_size, page_size):
+        """
+        Publishes the index of ``model_name`` and makes it the active model.
+        Prompts completed with the previous model until every worker has
+        switched are embedded afterwards.
+        """
+        previous = EmbeddingModel.active_name()
+        # The new index is complete before any worker searches it
+        self.update_index(model_name)
+        EmbeddingModel.activate(model_name)
+        if previous == model_name:
+            self.stdout.write(f'{model_name} is the active embedding model')
+            return
+        # Cached results were ranked in the previous model's index
+        similar_results.invalidate()
+        self.stdout.write(f'Activated {model_name} in place of {previous}; waiting '
+                          f'{settings.EMBEDDING_MODEL_REFRESH_SECONDS:g}s for every worker to switch')
+        time.sleep(settings.EMBEDDING_MODEL_REFRESH_SECONDS)
+
+        caught_up, _ = self.embed_missing(model_name, 0, batch_size, page_size)
+        if caught_up:
+            self.update_index(model_name)
+        self.stdout.write(self.style.SUCCESS(
+            f'{model_name} is the active embedding model; the embeddings by {previous} are kept '
+            f'for switching back until deleted'))
+
+    def update_index(self, model_name):
+        # The new embeddings are above the index watermark: they are added on
+        # top of the current snapshot, which is then republished
+        index = prompt_index.manager(model_name)
+        index.load()
+        index.publish()
+        manifest = index.read_manifest()
+        if manifest:
+            self.stdout.write(f"Similarity index snapshot {manifest['generation']} of {model_name} "
+                              f"holds {manifest['ntotal']} vectors")
+
+    @staticmethod
+    def read_checkpoint(path, model_name):
+        try:
+            with open(path) as fh:
+                data = json.load(fh)
+        except FileNotFoundError:
+            return 0
+        if data.get('model_name') != model_name:
+            raise CommandError(f'{path} was written for another embedding model; pass --restart.')
+        return data['last_prompt_id']
+
+    @staticmethod
+    def write_checkpoint(path, last_id, model_name):
+        data = {'last_prompt_id': last_id, 'model_name': model_name}
+
+        def writer(tmp_path):
+            with open(tmp_path, 'w') as fh:
+                json.dump(data, fh)
+
+        atomic_write(path, writer)
@@ -0,0 +1,99 @@
+import time
+
+import numpy as np
+from django.core.management.base import BaseCommand, CommandError
+
+from forge.fields import normalize_rows
+from forge.management.commands.generation_throughput import PROMPTS
+from forge.models import Prompt
+from forge.utils import GENERATION_MAX_LENGTH, INFERENCE_BACKENDS, bf16_supported, load_backend_models
+
+
+class Command(BaseCommand):
+    help = (
+        "Compares the latency and accuracy of the quantized inference backends "
+        "with the fp32 models: embedding latency and cosine agreement of the "
+        "embeddings, and greedy generation latency and the share of identical "
+        "responses. Fails if the mean cosine agreement of a backend is below "
+        "--min-cosine."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--backends', nargs='+', default=['int8', 'bf16'],
+                            choices=[backend for backend in INFERENCE_BACKENDS if backend != 'fp32'],
+                            help='Backends compared with fp32.')
+        parser.add_argument('--texts', type=int, default=256,
+                            help='Stored prompts embedded (built-in samples if there are none).')
+        parser.add_argument('--generate', type=int, default=4,
+                            help='Prompts generated greedily with each backend.')
+        parser.add_argument('--repeat', type=int, default=3,
+                            help='Timed runs per measurement; the fastest is reported.')
+        parser.add_argument('--min-cosine', type=float, default=0.98,
+                            help='Lowest acceptable mean cosine similarity to the fp32 embeddings.')
+
+    def handle(self, *args, **options):
+        if options['texts'] < 1 or options['generate'] < 0 or options['repeat'] < 1:
+            raise CommandError('--texts and --repeat must be at least 1, --generate at least 0.')
+        texts = list(Prompt.objects.order_by('-id').values_list('text', flat=True)[:options['texts']])
+        texts = texts or PROMPTS
+        prompts = [PROMPTS[i % len(PROMPTS)] for i in range(options['generate'])]
+
+        reference = self.measure('fp32', texts, prompts, options['repeat'])
+        self.stdout.write(f"fp32: embedding {reference['embed_seconds'] * 1000:.1f} ms, "
+                          f"generation {reference['generate_seconds'] * 1000:.1f} ms")
+
+        failed = []
+        for backend in options['backends']:
+            if backend == 'bf16' and not bf16_supported():
+                self.stdout.write(self.style.WARNING('bf16: skipped, this CPU has no native bfloat16 support'))
+                continue
+            result = self.measure(backend, texts, prompts, options['repeat'])
+            cosine = np.einsum('ij,ij->i', normalize_rows(reference['vectors']), normalize_rows(result['vectors']))
+            identical = sum(a == b for a, b in zip(reference['responses'], result['responses']))
+
+            line = (f"{backend}: embedding {result['embed_seconds'] * 1000:.1f} ms "
+                    f"({_speedup(reference['embed_seconds'], result['embed_seconds'])}), "
+                    f"cosine to fp32 mean {cosine.mean():.4f} min {cosine.min():.4f}; "
+                    f"generation {result['generate_seconds'] * 1000:.1f} ms "
+                    f"({_speedup(reference['generate_seconds'], result['generate_seconds'])}), "
+                    f"{identical}/{len(prompts)} responses identical")
+            if cosine.mean() < options['min_cosine']:
+                failed.append(backend)
+                self.stdout.write(self.style.ERROR(line))
+            else:
+                self.stdout.write(self.style.SUCCESS(line))
+
+        if failed:
+            raise CommandError(f"Mean cosine agreement below {options['min_cosine']}: {', '.join(failed)}")
+
+    def measure(self, backend, texts, prompts, repeat):
+        """Loads the models with ``backend`` and times embedding ``texts`` and generating ``prompts``."""
+        generator, embedding_model = load_backend_models(backend)
+
+        def embed():
+            return np.asarray(embedding_model.encode(texts), dtype='float32')
+
+        def generate():
+            results = [generator(prompt, max_length=GENERATION_MAX_LENGTH, do_sample=False,
+                                 pad_token_id=generator.tokenizer.pad_token_id) for prompt in prompts]
+            return [result[0]['generated_text'] for result in results]
+
+        vectors, embed_seconds = _best_of(embed, repeat)
+        responses, generate_seconds = _best_of(generate, repeat) if prompts else ([], 0.0)
+        return {'vectors': vectors, 'embed_seconds': embed_seconds,
+                'responses': responses, 'generate_seconds': generate_seconds}
+
+
+def _best_of(run, repeat):
+    """Returns the result of ``run`` after a warm-up call, and its fastest time."""
+    result = run()
+    fastest = float('inf')
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = run()
+        fastest = min(fastest, time.perf_counter() - started)
+    return result, fastest
+
+
+def _speedup(reference_seconds, seconds):
+    return f'{reference_seconds / seconds:.2f}x' if seconds else 'n/a'
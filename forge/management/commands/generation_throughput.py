@@ -0,0 +1,81 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from forge.batching import MicroBatcher
+from forge.utils import generate_responses, get_generator
+
+PROMPTS = [
+    'Explain how a hash map works',
+    'Write a haiku about the sea',
+    'What causes the seasons on Earth?',
+    'Summarize the plot of Hamlet',
+    'Give three tips for writing clean code',
+    'Why is the sky blue?',
+    'Describe a good morning routine',
+    'How do vaccines train the immune system?',
+]
+
+
+class Command(BaseCommand):
+    help = (
+        "Measures text generation throughput with one prompt per forward pass "
+        "and with concurrent prompts micro-batched together. Both modes decode "
+        "greedily, so they generate the same completions."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--prompts', type=int, default=32,
+                            help='Number of prompts generated in each mode.')
+        parser.add_argument('--concurrency', type=int, default=8,
+                            help='Threads submitting prompts at the same time in batched mode.')
+        parser.add_argument('--max-batch-size', type=int, default=settings.GENERATION_BATCH_MAX_SIZE,
+                            help='Largest batch (default: GENERATION_BATCH_MAX_SIZE).')
+        parser.add_argument('--max-wait-ms', type=int, default=settings.GENERATION_BATCH_MAX_WAIT_MS,
+                            help='Longest wait for a batch to fill (default: GENERATION_BATCH_MAX_WAIT_MS).')
+
+    def handle(self, *args, **options):
+        count = options['prompts']
+        if count < 1:
+            raise CommandError('--prompts must be at least 1.')
+        prompts = [PROMPTS[i % len(PROMPTS)] for i in range(count)]
+
+        # Warm up the model so neither mode pays for lazy initialization
+        generate_responses(prompts[:1], do_sample=False)
+
+        started = time.perf_counter()
+        single = [generate_responses([prompt], do_sample=False)[0] for prompt in prompts]
+        single_seconds = time.perf_counter() - started
+
+        batch_sizes = []
+
+        def run_batch(items):
+            batch_sizes.append(len(items))
+            return generate_responses(items, do_sample=False)
+
+        batcher = MicroBatcher(run_batch, options['max_batch_size'], options['max_wait_ms'], name='benchmark')
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=options['concurrency']) as pool:
+            batched = list(pool.map(batcher, prompts))
+        batched_seconds = time.perf_counter() - started
+
+        single_tokens, batched_tokens = self.new_tokens(prompts, single), self.new_tokens(prompts, batched)
+        self.stdout.write(f'Batch of one: {count / single_seconds:.2f} prompts/s, '
+                          f'{single_tokens / single_seconds:.1f} tokens/s')
+        self.stdout.write(f'Micro-batched: {count / batched_seconds:.2f} prompts/s, '
+                          f'{batched_tokens / batched_seconds:.1f} tokens/s '
+                          f'(mean batch size {sum(batch_sizes) / len(batch_sizes):.1f})')
+        if batched_tokens != single_tokens:
+            self.stdout.write(self.style.WARNING(
+                f'Generated {single_tokens} tokens one at a time and {batched_tokens} micro-batched'))
+        self.stdout.write(self.style.SUCCESS(
+            f'Speed-up: {(batched_tokens / batched_seconds) / (single_tokens / single_seconds):.2f}x'))
+
+    @staticmethod
+    def new_tokens(prompts, responses):
+        """Returns the number of tokens generated after ``prompts``."""
+        tokenizer = get_generator().tokenizer
+        return sum(len(tokenizer(response)['input_ids']) - len(tokenizer(prompt)['input_ids'])
+                   for prompt, response in zip(prompts, responses))
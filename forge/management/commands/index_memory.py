@@ -0,0 +1,79 @@
+import multiprocessing
+
+import numpy as np
+from django.core.management.base import BaseCommand, CommandError
+
+from forge.faiss_index import process_memory, prompt_index, read_snapshot, search_parameters
+
+MB = 2 ** 20
+
+
+class Command(BaseCommand):
+    help = (
+        "Reports per-worker memory of the current FAISS snapshot loaded as a "
+        "private copy and memory-mapped. Worker processes are forked side by "
+        "side, open the snapshot, run a few searches and report their RSS "
+        "before and after."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=4,
+                            help='Number of worker processes loading the snapshot at the same time.')
+        parser.add_argument('--queries', type=int, default=100,
+                            help='Random searches run by each worker after loading.')
+
+    def handle(self, *args, **options):
+        manifest = prompt_index.read_manifest()
+        if not manifest:
+            raise CommandError('No FAISS snapshot has been published yet.')
+        if process_memory() is None:
+            raise CommandError('Process memory can only be measured where /proc is available.')
+
+        path = prompt_index.snapshot_path(manifest['generation'])
+        self.stdout.write(
+            f"Snapshot {manifest['generation']}: {manifest['ntotal']} vectors of dimension {manifest['dim']}")
+
+        for mmap in (False, True):
+            reports = _measure(path, manifest, mmap, options['workers'], options['queries'])
+            self.stdout.write(f"\n{'Memory-mapped' if mmap else 'Private copy'}:")
+            for number, (before, after) in enumerate(reports, start=1):
+                self.stdout.write(
+                    f"  worker {number}: RSS {before['rss'] / MB:.1f} -> {after['rss'] / MB:.1f} MB, "
+                    f"private +{(after['anon'] - before['anon']) / MB:.1f} MB, "
+                    f"shared +{(after['file'] - before['file']) / MB:.1f} MB")
+            if all('pss' in after for _, after in reports):
+                total = sum(after['pss'] - before['pss'] for before, after in reports)
+                self.stdout.write(f'  host memory added by all workers (PSS): {total / MB:.1f} MB')
+
+
+def _measure(path, manifest, mmap, workers, queries):
+    """Forks ``workers`` processes that open the snapshot together and returns their reports."""
+    context = multiprocessing.get_context('fork')
+    barrier = context.Barrier(workers)
+    results = context.Queue()
+    processes = [
+        context.Process(target=_worker, args=(path, manifest, mmap, queries, barrier, results))
+        for _ in range(workers)
+    ]
+    for process in processes:
+        process.start()
+    reports = [results.get() for _ in processes]
+    for process in processes:
+        process.join()
+    return reports
+
+
+def _worker(path, manifest, mmap, queries, barrier, results):
+    barrier.wait()
+    before = process_memory()
+    index = read_snapshot(path, manifest.get('index_type'), mmap=mmap)
+
+    rng = np.random.default_rng()
+    vectors = rng.standard_normal((queries, index.d)).astype('float32')
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    index.search(vectors, 10, params=search_parameters(index))
+
+    # Measure while every worker holds the snapshot, so shared pages are split between them
+    barrier.wait()
+    results.put((before, process_memory()))
+    barrier.wait()
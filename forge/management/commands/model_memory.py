@@ -0,0 +1,83 @@
+import gc
+import multiprocessing
+
+from django.core.management.base import BaseCommand, CommandError
+
+from forge.faiss_index import process_memory
+from forge.utils import (
+    configure_worker_threads, generate_responses, generation_params, get_embedding_model, load_models,
+    preload_models,
+)
+
+MB = 2 ** 20
+
+
+class Command(BaseCommand):
+    help = (
+        "Reports per-worker memory of the generation and embedding models "
+        "loaded by every worker and preloaded once before forking, as gunicorn "
+        "does with GUNICORN_PRELOAD. Worker processes are forked side by side, "
+        "run one embedding and one generation and report their memory. With "
+        "preloading, private memory per worker stays flat as workers are added."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=4,
+                            help='Number of worker processes running at the same time.')
+
+    def handle(self, *args, **options):
+        workers = options['workers']
+        if workers < 1:
+            raise CommandError('--workers must be at least 1.')
+        if process_memory() is None:
+            raise CommandError('Process memory can only be measured where /proc is available.')
+
+        # Loading in every worker first: the models are not loaded in this process yet
+        for preloaded in (False, True):
+            if preloaded:
+                preload_models()
+                gc.collect()
+                gc.freeze()
+            reports = _measure(workers, preloaded)
+            self.stdout.write(f"\n{'Preloaded before fork' if preloaded else 'Loaded by each worker'}:")
+            for number, (before, after) in enumerate(reports, start=1):
+                self.stdout.write(
+                    f"  worker {number}: RSS {after['rss'] / MB:.1f} MB, "
+                    f"private {after.get('private', 0) / MB:.1f} MB "
+                    f"(+{(after.get('private', 0) - before.get('private', 0)) / MB:.1f} MB after fork), "
+                    f"shared memory {after.get('shmem', 0) / MB:.1f} MB")
+            if all('pss' in after for _, after in reports):
+                total = sum(after['pss'] for _, after in reports)
+                self.stdout.write(f'  host memory used by all workers (PSS): {total / MB:.1f} MB')
+
+
+def _measure(workers, preloaded):
+    """Forks ``workers`` processes that use the models together and returns their reports."""
+    context = multiprocessing.get_context('fork')
+    barrier = context.Barrier(workers)
+    results = context.Queue()
+    processes = [
+        context.Process(target=_worker, args=(workers, preloaded, barrier, results))
+        for _ in range(workers)
+    ]
+    for process in processes:
+        process.start()
+    reports = [results.get() for _ in processes]
+    for process in processes:
+        process.join()
+    return reports
+
+
+def _worker(workers, preloaded, barrier, results):
+    configure_worker_threads(workers)
+    before = process_memory()
+    if not preloaded:
+        load_models()
+    # Run the models themselves, bypassing the embedding cache
+    get_embedding_model().encode(['How much memory does a worker use?'])
+    generate_responses(['How much memory does a worker use?'], **generation_params(deterministic=True))
+
+    # Measure while every worker holds the models, so shared pages are split between them
+    barrier.wait()
+    results.put((before, process_memory()))
+    barrier.wait()
@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from forge.prompt_jobs import reap_stale_jobs
+
+
+class Command(BaseCommand):
+    help = (
+        "Marks prompts still pending or running --max-age seconds (default: "
+        "PROMPT_JOB_STALE_SECONDS) after they were created failed. Their jobs "
+        "only lived in the process that accepted them and were lost when it "
+        "stopped, so they would otherwise stay in progress forever. Run it at "
+        "startup, before workers accept new jobs."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--max-age', type=int, default=None,
+                            help='Seconds after which a pending or running prompt counts as interrupted.')
+
+    def handle(self, *args, **options):
+        max_age = options['max_age']
+        if max_age is not None and max_age < 0:
+            raise CommandError('--max-age must not be negative.')
+        reaped = reap_stale_jobs(max_age)
+        self.stdout.write(f'Marked {reaped} interrupted prompt job(s) failed.')
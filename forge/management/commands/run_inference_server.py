@@ -0,0 +1,89 @@
+import functools
+import os
+import socket
+import stat
+import threading
+
+import numpy as np
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from forge.batching import MicroBatcher
+from forge.inference import InferenceServer
+from forge.utils import configure_worker_threads, encode_texts, generate_local, load_models, stream_local
+
+
+class Command(BaseCommand):
+    help = (
+        "Runs the inference server: loads the generation and embedding models "
+        "once and serves model calls of every web worker on a Unix socket. Set "
+        "INFERENCE_SERVER_SOCKET for the web workers to use it. Concurrent "
+        "prompts and texts from all workers are micro-batched together."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--socket', default=settings.INFERENCE_SERVER_SOCKET,
+                            help='Unix socket path to listen on (default: INFERENCE_SERVER_SOCKET).')
+        parser.add_argument('--embedding-batch-size', type=int, default=64,
+                            help='Most texts encoded together in one batch.')
+
+    def handle(self, *args, **options):
+        path = options['socket']
+        if not path:
+            raise CommandError('Set INFERENCE_SERVER_SOCKET or pass --socket.')
+        _remove_stale_socket(path)
+
+        # The server is the only process running the models: use every core
+        threads = configure_worker_threads(1)
+        load_models()
+
+        # Texts are batched with concurrent texts for the same embedding model:
+        # during a re-embedding, texts for the new model arrive as well
+        batchers = {}
+        batchers_lock = threading.Lock()
+
+        def embedding_batcher(model_name):
+            with batchers_lock:
+                if model_name not in batchers:
+                    batchers[model_name] = MicroBatcher(
+                        functools.partial(encode_texts, batch_size=options['embedding_batch_size'],
+                                          model_name=model_name),
+                        max_batch_size=options['embedding_batch_size'],
+                        max_wait_ms=settings.GENERATION_BATCH_MAX_WAIT_MS,
+                        name='embedding',
+                    )
+                return batchers[model_name]
+
+        def embed(texts, model_name):
+            if not texts:
+                return encode_texts([], model_name=model_name)
+            batcher = embedding_batcher(model_name)
+            futures = [batcher.submit(text) for text in texts]
+            return np.vstack([future.result() for future in futures])
+
+        server = InferenceServer(path, generate=generate_local, stream=stream_local, embed=embed)
+        self.stdout.write(self.style.SUCCESS(f'Inference server listening on {path} with {threads} torch threads'))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            os.unlink(path)
+
+
+def _remove_stale_socket(path):
+    """Removes a socket file left behind by a server that is no longer running."""
+    try:
+        mode = os.stat(path).st_mode
+    except FileNotFoundError:
+        return
+    if not stat.S_ISSOCK(mode):
+        raise CommandError(f'{path} exists and is not a socket.')
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+        try:
+            probe.connect(path)
+        except OSError:
+            os.unlink(path)
+            return
+    raise CommandError(f'An inference server is already listening on {path}.')
@@ -0,0 +1,120 @@
+import time
+
+import faiss
+import numpy as np
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from forge.faiss_index import (
+    COMPRESSED_INDEX_TYPES, INDEX_FACTORY_STRINGS, base_index, build_index, load_vectors, prompt_index,
+    recall_at_k, rerank, search_parameters,
+)
+
+
+class Command(BaseCommand):
+    help = (
+        "Trains an approximate FAISS index on a sample of stored embeddings, "
+        "reports its recall@k, latency and memory per vector against the exact "
+        "index, and optionally publishes a full index of the trained type."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--index-type', default=settings.FAISS_INDEX_TYPE,
+                            choices=sorted(INDEX_FACTORY_STRINGS),
+                            help='Index type to train (default: FAISS_INDEX_TYPE).')
+        parser.add_argument('--sample', type=int, default=100000,
+                            help='Number of embeddings used for training and evaluation.')
+        parser.add_argument('--queries', type=int, default=200,
+                            help='Number of held-out embeddings used as evaluation queries.')
+        parser.add_argument('--k', type=int, default=10,
+                            help='Number of neighbours used for recall@k.')
+        parser.add_argument('--nprobe', type=int, default=None,
+                            help='IVF lists probed during evaluation (default: FAISS_NPROBE).')
+        parser.add_argument('--ef-search', type=int, default=None,
+                            help='HNSW efSearch used during evaluation (default: FAISS_EF_SEARCH).')
+        parser.add_argument('--rerank-factor', type=int, default=settings.FAISS_RERANK_FACTOR,
+                            help='Candidates per result re-ranked with exact vectors for compressed '
+                                 'index types (default: FAISS_RERANK_FACTOR).')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--publish', action='store_true',
+                            help='Rebuild the index from all embeddings and publish it as a new snapshot.')
+
+    def handle(self, *args, **options):
+        index_type = options['index_type']
+        k = options['k']
+        rng = np.random.default_rng(options['seed'])
+
+        embedding_ids = np.fromiter(
+            prompt_index.embeddings().values_list('id', flat=True).iterator(), dtype='int64')
+        if len(embedding_ids) < 2:
+            raise CommandError('At least two embeddings are needed to train an index.')
+
+        sample_size = min(options['sample'] + options['queries'], len(embedding_ids))
+        sampled = rng.choice(embedding_ids, size=sample_size, replace=False)
+        _, vectors = load_vectors(prompt_index.embeddings().filter(id__in=sampled.tolist()))
+        rng.shuffle(vectors)
+
+        n_queries = min(options['queries'], len(vectors) // 2)
+        queries, database = vectors[:n_queries], vectors[n_queries:]
+        dim = vectors.shape[1]
+        self.stdout.write(f'Training {index_type} index on {len(database)} vectors of dimension {dim}')
+
+        index = build_index(dim, index_type)
+        started = time.perf_counter()
+        if not index.is_trained:
+            index.train(database)
+            prompt_index.save_trained(index, index_type)
+        self.stdout.write(f'Training took {time.perf_counter() - started:.2f}s')
+
+        exact = build_index(dim, 'flat')
+        labels = np.arange(len(database), dtype='int64')
+        exact.add_with_ids(database, labels)
+        index.add_with_ids(database, labels)
+
+        k = min(k, len(database))
+        exact_seconds, (_, exact_labels) = _timed(exact.search, queries, k)
+        params = search_parameters(index, nprobe=options['nprobe'], ef_search=options['ef_search'])
+        approx_seconds, (_, approx_labels) = _timed(index.search, queries, k, params=params)
+
+        self.stdout.write(f'recall@{k}: {recall_at_k(exact_labels, approx_labels):.4f}')
+        self.stdout.write(f'Exact search:  {exact_seconds * 1000 / len(queries):.3f} ms/query')
+        self.stdout.write(f'{index_type} search: {approx_seconds * 1000 / len(queries):.3f} ms/query')
+
+        if isinstance(base_index(index), COMPRESSED_INDEX_TYPES) and options['rerank_factor'] > 1:
+            # Re-rank like PromptIndexManager.search, with the sample standing in for PromptEmbedding
+            fetch_k = min(k * options['rerank_factor'], len(database))
+            rerank_seconds, (_, reranked) = _timed(
+                _search_reranked, index, queries, database, labels, fetch_k, k, params)
+            self.stdout.write(
+                f'recall@{k} re-ranked from {fetch_k}: {recall_at_k(exact_labels, reranked):.4f}')
+            self.stdout.write(
+                f'{index_type} re-ranked search: {rerank_seconds * 1000 / len(queries):.3f} ms/query')
+
+        self.stdout.write(f'Memory: {_bytes_per_vector(index):.1f} bytes/vector '
+                          f'(exact: {_bytes_per_vector(exact):.1f} bytes/vector)')
+
+        if options['publish']:
+            if index_type != settings.FAISS_INDEX_TYPE:
+                raise CommandError(
+                    f"Set FAISS_INDEX_TYPE={index_type} before publishing a {index_type} index.")
+            rebuilt = prompt_index.rebuild()
+            self.stdout.write(self.style.SUCCESS(
+                f'Published snapshot {prompt_index.generation} with {rebuilt.ntotal} vectors'))
+        else:
+            self.stdout.write(self.style.SUCCESS('Training finished'))
+
+
+def _search_reranked(index, queries, database, labels, fetch_k, k, params):
+    _, candidates = index.search(queries, fetch_k, params=params)
+    return rerank(queries, candidates, labels, database, k)
+
+
+def _bytes_per_vector(index):
+    """Returns the serialized size of ``index`` per stored vector, IDs included."""
+    return faiss.serialize_index(index).nbytes / max(index.ntotal, 1)
+
+
+def _timed(func, *args, **kwargs):
+    started = time.perf_counter()
+    result = func(*args, **kwargs)
+    return time.perf_counter() - started, result
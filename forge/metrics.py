@@ -0,0 +1,90 @@
+"""
+Application metrics exported on the django_prometheus /metrics endpoint.
+"""
+from prometheus_client import Counter, Gauge, Histogram
+
+EMBEDDING_CACHE_REQUESTS = Counter(
+    'forge_embedding_cache_requests_total',
+    'Embedding cache lookups by tier and result.',
+    ['tier', 'result'],
+)
+
+EMBEDDING_CACHE_EVICTIONS = Counter(
+    'forge_embedding_cache_evictions_total',
+    'Embeddings evicted from the cache by tier.',
+    ['tier'],
+)
+
+SIMILAR_CACHE_REQUESTS = Counter(
+    'forge_similar_cache_requests_total',
+    'Similarity search result cache lookups by result (hit, refresh or miss).',
+    ['result'],
+)
+
+RESPONSE_CACHE_REQUESTS = Counter(
+    'forge_response_cache_requests_total',
+    'Semantic response cache lookups by result (hit or miss).',
+    ['result'],
+)
+
+RESPONSE_CACHE_SAVED_SECONDS = Counter(
+    'forge_response_cache_saved_seconds_total',
+    'Response generation time saved by semantic response cache hits.',
+)
+
+BATCH_SIZE = Histogram(
+    'forge_batch_size',
+    'Items per batch run through a model by the micro-batcher.',
+    ['batcher'],
+    buckets=(1, 2, 4, 8, 16, 32, 64),
+)
+
+BATCH_QUEUE_WAIT_SECONDS = Histogram(
+    'forge_batch_queue_wait_seconds',
+    'Time items wait in the micro-batcher queue before their batch runs.',
+    ['batcher'],
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5),
+)
+
+RESPONSE_MEMO_REQUESTS = Counter(
+    'forge_response_memo_requests_total',
+    'Deterministic response memo lookups by result (hit or miss).',
+    ['result'],
+)
+
+INFERENCE_CLIENT_SECONDS = Histogram(
+    'forge_inference_client_seconds',
+    'Time spent waiting for the inference server by operation.',
+    ['op'],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0),
+)
+
+REEMBEDDED_PROMPTS = Counter(
+    'forge_reembedded_prompts_total',
+    'Prompts embedded by backfill_embeddings, by embedding model.',
+    ['model'],
+)
+
+REEMBEDDING_REMAINING_PROMPTS = Gauge(
+    'forge_reembedding_remaining_prompts',
+    'Prompts left for backfill_embeddings to embed, by embedding model.',
+    ['model'],
+)
+
+PREFIX_CACHE_REQUESTS = Counter(
+    'forge_prefix_cache_requests_total',
+    'Prompt prefix key/value cache lookups by result (hit or miss).',
+    ['result'],
+)
+
+PREFIX_CACHE_REUSED_TOKENS = Counter(
+    'forge_prefix_cache_reused_tokens_total',
+    'Prompt tokens served from the prefix key/value cache instead of running the model.',
+)
+
+PROMPT_STAGE_SECONDS = Histogram(
+    'forge_prompt_stage_seconds',
+    'Time spent in each stage of creating a prompt.',
+    ['stage'],
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0),
+)
@@ -0,0 +1,70 @@
+# Converts PromptEmbedding.vector from double precision[] to packed float32 bytes
+
+import django.contrib.postgres.fields
+from django.db import migrations, models
+
+import forge.fields
+
+BATCH_SIZE = 2000
+
+
+def copy_to_float32(apps, schema_editor):
+    PromptEmbedding = apps.get_model('forge', 'PromptEmbedding')
+    batch = []
+    for embedding in PromptEmbedding.objects.only('id', 'vector').iterator(chunk_size=BATCH_SIZE):
+        embedding.vector_f32 = forge.fields.to_vector(embedding.vector, normalize=True)
+        batch.append(embedding)
+        if len(batch) >= BATCH_SIZE:
+            PromptEmbedding.objects.bulk_update(batch, ['vector_f32'])
+            batch = []
+    if batch:
+        PromptEmbedding.objects.bulk_update(batch, ['vector_f32'])
+
+
+def copy_to_array(apps, schema_editor):
+    PromptEmbedding = apps.get_model('forge', 'PromptEmbedding')
+    batch = []
+    for embedding in PromptEmbedding.objects.only('id', 'vector_f32').iterator(chunk_size=BATCH_SIZE):
+        embedding.vector = forge.fields.to_vector(embedding.vector_f32).tolist()
+        batch.append(embedding)
+        if len(batch) >= BATCH_SIZE:
+            PromptEmbedding.objects.bulk_update(batch, ['vector'])
+            batch = []
+    if batch:
+        PromptEmbedding.objects.bulk_update(batch, ['vector'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('forge', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='promptembedding',
+            name='vector_f32',
+            field=forge.fields.Float32VectorField(normalize=True, null=True),
+        ),
+        # Nullable so that reversing the migration can re-add the column before copying back
+        migrations.AlterField(
+            model_name='promptembedding',
+            name='vector',
+            field=django.contrib.postgres.fields.ArrayField(base_field=models.FloatField(), null=True, size=None),
+        ),
+        migrations.RunPython(copy_to_float32, copy_to_array),
+        migrations.RemoveField(
+            model_name='promptembedding',
+            name='vector',
+        ),
+        migrations.RenameField(
+            model_name='promptembedding',
+            old_name='vector_f32',
+            new_name='vector',
+        ),
+        migrations.AlterField(
+            model_name='promptembedding',
+            name='vector',
+            field=forge.fields.Float32VectorField(normalize=True),
+        ),
+    ]
@@ -0,0 +1,36 @@
+# GIN index for full-text search of prompts (hybrid similarity search and the admin).
+# PostgreSQL only; other databases fall back to substring matching without an index.
+
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.search import SearchVector
+from django.db import migrations
+
+INDEX_NAME = 'forge_prompt_search_gin'
+
+
+def search_index():
+    # Must compile to the same expression as forge.hybrid_search.prompt_document()
+    return GinIndex(SearchVector('text', 'response', config='english'), name=INDEX_NAME)
+
+
+def create_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.add_index(apps.get_model('forge', 'Prompt'), search_index(), concurrently=True)
+
+
+def drop_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.remove_index(apps.get_model('forge', 'Prompt'), search_index(), concurrently=True)
+
+
+class Migration(migrations.Migration):
+    # CREATE INDEX CONCURRENTLY cannot run inside a transaction
+    atomic = False
+
+    dependencies = [
+        ('forge', '0002_float32_embedding_vector'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
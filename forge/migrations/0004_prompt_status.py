@@ -0,0 +1,23 @@
+# Generated by Django 5.2.7 on 2026-10-18 05:32
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('forge', '0003_prompt_search_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='prompt',
+            name='error',
+            field=models.TextField(blank=True, default=''),
+        ),
+        migrations.AddField(
+            model_name='prompt',
+            name='status',
+            field=models.CharField(choices=[('pending', 'Pending'), ('running', 'Running'), ('completed', 'Completed'), ('failed', 'Failed')], default='completed', max_length=16),
+        ),
+    ]
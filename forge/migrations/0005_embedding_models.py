@@ -0,0 +1,43 @@
+# Generated by Django 5.2.7 on 2026-10-18 06:12
+
+import django.db.models.deletion
+import forge.models
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('forge', '0004_prompt_status'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EmbeddingModel',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100, unique=True)),
+                ('is_active', models.BooleanField(default=False)),
+                ('activated_at', models.DateTimeField(blank=True, null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AlterField(
+            model_name='promptembedding',
+            name='model_name',
+            field=models.CharField(default=forge.models.active_embedding_model, max_length=100),
+        ),
+        migrations.AlterField(
+            model_name='promptembedding',
+            name='prompt',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='embeddings', to='forge.prompt'),
+        ),
+        migrations.AddConstraint(
+            model_name='promptembedding',
+            constraint=models.UniqueConstraint(fields=('prompt', 'model_name'), name='unique_prompt_embedding_model'),
+        ),
+        migrations.AddConstraint(
+            model_name='embeddingmodel',
+            constraint=models.UniqueConstraint(condition=models.Q(('is_active', True)), fields=('is_active',), name='single_active_embedding_model'),
+        ),
+    ]
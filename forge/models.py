@@ -1,35 +1,139 @@
-from django.db import models
+import time
+
+from django.conf import settings
+from django.db import models, transaction
+from django.db.models import FilteredRelation, Q
 from django.contrib.auth.models import User
-from django.contrib.postgres.fields import ArrayField
+from django.utils import timezone
+
+from .fields import Float32VectorField
+
+
+class EmbeddingModel(models.Model):
+    """
+    A sentence embedding model prompts are embedded with. The active model
+    embeds new prompts and queries, and its index serves similarity searches;
+    the others hold vectors being backfilled for a switch, or kept to switch
+    back. Until a model is activated, ``EMBEDDING_MODEL`` is the active one.
+    """
+    name = models.CharField(max_length=100, unique=True)
+    is_active = models.BooleanField(default=False)
+    activated_at = models.DateTimeField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    # (name, monotonic expiry) of the active model, cached per process
+    _active = None
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['is_active'], condition=Q(is_active=True),
+                                    name='single_active_embedding_model'),
+        ]
+
+    def __str__(self):
+        return self.name
+
+    @classmethod
+    def active_name(cls):
+        """
+        Returns the name of the active model. It is re-read at most every
+        ``EMBEDDING_MODEL_REFRESH_SECONDS``, so every worker follows a switch
+        within that time.
+        """
+        cached = cls._active
+        if cached is None or cached[1] <= time.monotonic():
+            name = cls.objects.filter(is_active=True).values_list('name', flat=True).first()
+            cached = cls._active = (name or settings.EMBEDDING_MODEL,
+                                    time.monotonic() + settings.EMBEDDING_MODEL_REFRESH_SECONDS)
+        return cached[0]
+
+    @classmethod
+    def activate(cls, name):
+        """Makes ``name`` the active model in one transaction."""
+        with transaction.atomic():
+            cls.objects.filter(is_active=True).exclude(name=name).update(is_active=False)
+            cls.objects.update_or_create(name=name, defaults={'is_active': True, 'activated_at': timezone.now()})
+        cls._active = None
+
+
+def active_embedding_model():
+    """Default ``PromptEmbedding.model_name``: the active embedding model."""
+    return EmbeddingModel.active_name()
+
+
+class PromptQuerySet(models.QuerySet):
+
+    def with_embedding(self, include_vector=True):
+        """
+        Joins each prompt's embedding by the active model into the query, as
+        read by ``Prompt.embedding``. The vector is only loaded with
+        ``include_vector``.
+        """
+        prompts = self.annotate(active_embedding=FilteredRelation(
+            'embeddings', condition=Q(embeddings__model_name=EmbeddingModel.active_name()),
+        )).select_related('active_embedding')
+        if not include_vector:
+            prompts = prompts.defer('active_embedding__vector')
+        return prompts
 
 
 class Prompt(models.Model):
     """
     Represents a user-submitted prompt along with the generated response.
+    Prompts submitted asynchronously are stored pending and completed by a
+    background job; ``status`` tracks its progress.
     """
+    STATUS_PENDING = 'pending'
+    STATUS_RUNNING = 'running'
+    STATUS_COMPLETED = 'completed'
+    STATUS_FAILED = 'failed'
+    STATUS_CHOICES = [
+        (STATUS_PENDING, 'Pending'),
+        (STATUS_RUNNING, 'Running'),
+        (STATUS_COMPLETED, 'Completed'),
+        (STATUS_FAILED, 'Failed'),
+    ]
+
     user = models.ForeignKey(
         User, on_delete=models.CASCADE, related_name='prompts')
     text = models.TextField()  # The original user prompt
     response = models.TextField()  # The model-generated response
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=STATUS_COMPLETED)
+    error = models.TextField(blank=True, default='')  # Why a background job failed
     created_at = models.DateTimeField(auto_now_add=True)
 
+    objects = PromptQuerySet.as_manager()
+
     def __str__(self):
         return f"Prompt {self.id} by {self.user.username}"
 
+    @property
+    def embedding(self):
+        """The embedding of this prompt by the active embedding model, or None."""
+        if 'active_embedding' not in self.__dict__:
+            self.active_embedding = self.embeddings.filter(model_name=EmbeddingModel.active_name()).first()
+        return self.active_embedding
+
 
 class PromptEmbedding(models.Model):
     """
-    Represents the embedding (vector representation) associated with a prompt.
+    Represents the embedding (vector representation) of a prompt by one
+    embedding model. A prompt has at most one embedding per model.
     """
-    prompt = models.OneToOneField(
-        Prompt, on_delete=models.CASCADE, related_name='embedding'
+    prompt = models.ForeignKey(
+        Prompt, on_delete=models.CASCADE, related_name='embeddings'
     )
     model_name = models.CharField(
-        max_length=100, default='text-embedding-3-small')
-    # Numerical embedding (list of floats)
-    vector = ArrayField(models.FloatField())
+        max_length=100, default=active_embedding_model)
+    # Numerical embedding, stored as unit-length little-endian float32 bytes
+    vector = Float32VectorField(normalize=True)
     created_at = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['prompt', 'model_name'], name='unique_prompt_embedding_model'),
+        ]
+
     def __str__(self):
         return f"Embedding for Prompt {self.prompt.id}"
 
@@ -0,0 +1,132 @@
+"""
+Attention key/value cache of shared prompt prefixes.
+
+Much generation traffic wraps the user's text in the same long preamble.
+Running a prompt through the model first computes the attention keys and
+values of every prompt token, which for a shared preamble are the same every
+time. ``PrefixCache`` keeps them for a bounded number of prefixes, so
+generation starts from the cached prefix and only the rest of the prompt is
+run through the model.
+
+Prefixes are either registered (``GENERATION_PREFIXES_PATH``) or detected:
+every line boundary of a prompt is a candidate, and a candidate seen in
+``GENERATION_PREFIX_FREQUENT_AFTER`` prompts is cached. The longest matching
+prefix wins. Prefixes shorter than ``GENERATION_PREFIX_MIN_TOKENS`` tokens
+are not worth caching.
+"""
+import json
+import threading
+from collections import OrderedDict, namedtuple
+
+from django.conf import settings
+
+from .metrics import PREFIX_CACHE_REQUESTS
+
+# Candidate prefixes whose occurrences are counted, least recently seen dropped first
+TRACKED_CANDIDATES = 4096
+
+# Line boundaries of a prompt considered as candidate prefixes
+MAX_CANDIDATES_PER_PROMPT = 32
+
+# Token ids of a prefix and the attention key/value cache computed from them
+PrefixEntry = namedtuple('PrefixEntry', ['input_ids', 'past_key_values'])
+
+
+def load_prefixes(path):
+    """Returns the registered prefixes listed in the JSON file ``path``, if any."""
+    if not path:
+        return []
+    with open(path, encoding='utf-8') as fh:
+        prefixes = json.load(fh)
+    if not isinstance(prefixes, list) or not all(isinstance(prefix, str) for prefix in prefixes):
+        raise ValueError(f'{path} must contain a JSON list of strings')
+    return prefixes
+
+
+class PrefixCache:
+    """
+    Bounded LRU of ``PrefixEntry`` by prefix text. Entries are built by the
+    ``build(prefix)`` function given to ``get``, which returns None for a
+    prefix that should not be cached. A size of zero disables the cache.
+    """
+
+    def __init__(self, max_entries=None, frequent_after=None, prefixes=()):
+        self.max_entries = settings.GENERATION_PREFIX_CACHE_SIZE if max_entries is None else max_entries
+        self.frequent_after = (settings.GENERATION_PREFIX_FREQUENT_AFTER
+                               if frequent_after is None else frequent_after)
+        self.registered = set(prefixes)
+        self._counts = OrderedDict()
+        self._entries = OrderedDict()
+        # Prefixes too short to cache, not tokenized again
+        self._skipped = set()
+        self._lock = threading.Lock()
+
+    def register(self, prefix):
+        """Caches ``prefix`` from the first prompt starting with it."""
+        with self._lock:
+            self.registered.add(prefix)
+
+    def find_prefix(self, prompt):
+        """
+        Returns the longest registered or frequent prefix of ``prompt`` that
+        leaves some text after it and was not found unworthy of caching, or
+        None. Counts the line boundaries of ``prompt`` towards detecting
+        frequent prefixes.
+        """
+        if not self.max_entries:
+            return None
+        with self._lock:
+            found = max((prefix for prefix in self.registered
+                         if len(prefix) < len(prompt) and prompt.startswith(prefix) and prefix not in self._skipped),
+                        key=len, default=None)
+            if self.frequent_after:
+                for candidate in self._candidates(prompt):
+                    count = self._counts.pop(candidate, 0) + 1
+                    self._counts[candidate] = count
+                    if (count >= self.frequent_after and len(candidate) > len(found or '')
+                            and candidate not in self._skipped):
+                        found = candidate
+                while len(self._counts) > TRACKED_CANDIDATES:
+                    self._counts.popitem(last=False)
+            return found
+
+    @staticmethod
+    def _candidates(prompt):
+        end = prompt.find('\n')
+        for _ in range(MAX_CANDIDATES_PER_PROMPT):
+            if end == -1 or end + 1 >= len(prompt):
+                return
+            yield prompt[:end + 1]
+            end = prompt.find('\n', end + 1)
+
+    def get(self, prefix, build):
+        """
+        Returns the entry of ``prefix``, building it with ``build`` on a miss,
+        or None if ``prefix`` is not worth caching.
+        """
+        with self._lock:
+            entry = self._entries.get(prefix)
+            if entry is not None:
+                self._entries.move_to_end(prefix)
+        if entry is not None:
+            PREFIX_CACHE_REQUESTS.labels(result='hit').inc()
+            return entry
+
+        PREFIX_CACHE_REQUESTS.labels(result='miss').inc()
+        entry = build(prefix)
+        with self._lock:
+            if entry is None:
+                if len(self._skipped) >= TRACKED_CANDIDATES:
+                    self._skipped.clear()
+                self._skipped.add(prefix)
+                return None
+            self._entries[prefix] = entry
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return entry
+
+    def clear(self):
+        """Drops every cached entry, e.g. after the model changed."""
+        with self._lock:
+            self._entries.clear()
+            self._skipped.clear()
@@ -0,0 +1,314 @@
+"""
+Prompt processing, inline or as background jobs.
+
+``generate_prompt_result`` runs the expensive part of creating a prompt:
+embedding it, looking up a cached response and generating one otherwise. The
+embedding only depends on the text, so it is computed on the inference
+executor while the response is generated. Synchronous requests call it
+directly; async views await ``agenerate_prompt_result``, which runs every
+model call on the inference executor rather than on the thread serving
+database access. Requests with ``"async": true`` store a pending ``Prompt``
+and hand its id to ``submit``, which runs the job in a bounded thread pool
+of ``PROMPT_JOB_WORKERS`` threads per process.
+
+At most ``PROMPT_JOB_QUEUE_SIZE`` jobs may wait for a thread; beyond that
+``submit`` raises ``JobQueueFull`` so the request can be rejected instead of
+piling up work the process cannot finish.
+
+Jobs only live in the process that accepted them, so a prompt whose process
+stopped stays pending or running. ``reap_stale_jobs``, run by the
+``reap_prompt_jobs`` command at startup, marks prompts left like that for
+longer than ``PROMPT_JOB_STALE_SECONDS`` failed.
+
+``complete_prompt`` fills in a stored prompt and pushes a ``done`` or
+``error`` event to the user's WebSocket group when it finishes. With
+``stream`` the response is generated on its own instead of batched, and each
+piece of text is pushed as a ``chunk`` event as soon as it is generated.
+"""
+import asyncio
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from time import perf_counter
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.utils import timezone
+
+from .metrics import PROMPT_STAGE_SECONDS
+from .models import EmbeddingModel, Prompt, PromptEmbedding, PromptMetadata
+from .response_cache import EXTRA_INFO_KEY, find_cached_response, record_hit, record_miss
+from .response_memo import response_memo
+from .utils import (
+    generate_embedding, generate_response, generation_params, inference_executor, is_deterministic,
+    run_inference, stream_response,
+)
+from .websocket_utils import send_prompt_event
+
+logger = logging.getLogger(__name__)
+
+_executor = ThreadPoolExecutor(max_workers=settings.PROMPT_JOB_WORKERS, thread_name_prefix='prompt-job')
+# Running plus queued jobs
+_slots = threading.BoundedSemaphore(settings.PROMPT_JOB_WORKERS + settings.PROMPT_JOB_QUEUE_SIZE)
+
+
+INTERRUPTED_JOB_ERROR = 'The job was interrupted before it finished; submit the prompt again.'
+
+
+class JobQueueFull(Exception):
+    """Raised when no more prompt jobs can be accepted."""
+
+
+def generate_prompt_result(text, user, use_cache=False, on_text=None, params=None, embedding_model=None):
+    """
+    Returns ``(response_text, embedding_vector, extra_info)`` for the prompt
+    ``text`` of ``user``, generated with the sampling ``params`` of
+    ``generation_params``. The prompt is embedded by ``embedding_model``
+    (default: the active embedding model). Deterministic requests are answered from the
+    response memo when the same prompt was generated before. With
+    ``use_cache`` the response of a near-duplicate stored prompt is reused
+    instead of generating one. ``on_text``, if given, is called with each
+    piece of the response as it is generated. The time of each stage is
+    recorded in ``forge_prompt_stage_seconds``.
+    """
+    params = params or generation_params()
+    embedding_model = embedding_model or EmbeddingModel.active_name()
+
+    # The embedding is computed while the response is generated; only a
+    # cached response lookup has to wait for it
+    embedding = inference_executor.submit(_timed_stage, 'embedding', generate_embedding, text, embedding_model)
+
+    response_text, extra_info = _reuse_response(
+        text, user, params, embedding_model, embedding if use_cache else None)
+    if response_text is not None:
+        if on_text is not None:
+            on_text(response_text)
+    else:
+        # Generate model response (e.g. from OpenAI or internal LLM)
+        started = perf_counter()
+        if on_text is not None:
+            response_text = stream_response(text, on_text, params)
+        else:
+            response_text = generate_response(text, params)
+        _record_generation(text, params, response_text, perf_counter() - started, use_cache, extra_info)
+
+    return response_text, embedding.result(), extra_info or None
+
+
+async def agenerate_prompt_result(text, user, use_cache=False, on_text=None, params=None, embedding_model=None):
+    """
+    Async counterpart of ``generate_prompt_result`` for async views. The
+    embedding and the response are computed on the inference executor and
+    awaited, and the memo, cache and database are accessed through
+    ``sync_to_async``, so the event loop serves other requests meanwhile.
+    """
+    params = params or generation_params()
+    embedding_model = embedding_model or await sync_to_async(EmbeddingModel.active_name)()
+
+    embedding = asyncio.ensure_future(
+        run_inference(_timed_stage, 'embedding', generate_embedding, text, embedding_model))
+    try:
+        if use_cache:
+            # The cached response lookup needs the embedding
+            await embedding
+        response_text, extra_info = await sync_to_async(_reuse_response)(
+            text, user, params, embedding_model, embedding if use_cache else None)
+        if response_text is not None:
+            if on_text is not None:
+                # on_text may block, e.g. on the channel layer
+                await sync_to_async(on_text, thread_sensitive=False)(response_text)
+        else:
+            started = perf_counter()
+            if on_text is not None:
+                response_text = await run_inference(stream_response, text, on_text, params)
+            else:
+                response_text = await run_inference(generate_response, text, params)
+            await sync_to_async(_record_generation)(
+                text, params, response_text, perf_counter() - started, use_cache, extra_info)
+        return response_text, await embedding, extra_info or None
+    except BaseException:
+        embedding.cancel()
+        raise
+
+
+def _reuse_response(text, user, params, embedding_model, embedding=None):
+    """
+    Returns ``(response_text, extra_info)``, where ``response_text`` is the
+    memoized response to ``text``, or with the future ``embedding`` of
+    ``text`` the response of a near-duplicate stored prompt, or None.
+    """
+    extra_info = {}
+    if is_deterministic(params):
+        extra_info['generation'] = dict(params)
+
+    memoized = response_memo.get(text, params)
+    if memoized is not None:
+        # The same prompt was generated deterministically before
+        extra_info['generation']['memoized'] = True
+        return memoized, extra_info
+
+    if embedding is not None:
+        cached = _timed_stage('cache_lookup', find_cached_response, embedding.result(), embedding_model, user)
+        if cached is not None:
+            # Reuse the response of a near-duplicate prompt
+            source, distance = cached
+            extra_info[EXTRA_INFO_KEY] = record_hit(source, distance)
+            return source.response, extra_info
+    return None, extra_info
+
+
+def _record_generation(text, params, response_text, seconds, use_cache, extra_info):
+    PROMPT_STAGE_SECONDS.labels(stage='generation').observe(seconds)
+    if use_cache:
+        extra_info[EXTRA_INFO_KEY] = record_miss(seconds)
+    response_memo.set(text, params, response_text)
+
+
+def _timed_stage(stage, function, *args):
+    with PROMPT_STAGE_SECONDS.labels(stage=stage).time():
+        return function(*args)
+
+
+def job_message(prompt):
+    """Returns the WebSocket message announcing the outcome of a prompt."""
+    message = {'prompt_id': prompt.id, 'status': prompt.status, 'prompt': prompt.text}
+    if prompt.status == Prompt.STATUS_COMPLETED:
+        message['response'] = prompt.response
+    elif prompt.status == Prompt.STATUS_FAILED:
+        message['error'] = prompt.error
+    return message
+
+
+def submit(prompt, use_cache=False, params=None):
+    """
+    Schedules the pending ``prompt`` for processing in the background. The
+    prompt must be committed, as the job reads it on its own connection.
+    Raises JobQueueFull when the pool and its queue are full.
+    """
+    if not _slots.acquire(blocking=False):
+        raise JobQueueFull()
+    try:
+        _executor.submit(_run_job, prompt.id, use_cache, params)
+    except Exception:
+        _slots.release()
+        raise
+
+
+def _run_job(prompt_id, use_cache, params):
+    # Runs in a pool thread, which manages its own connection like a request would
+    close_old_connections()
+    try:
+        process_prompt(prompt_id, use_cache, params)
+    except Exception:
+        logger.exception('Prompt job %s failed', prompt_id)
+    finally:
+        _slots.release()
+        close_old_connections()
+
+
+def reap_stale_jobs(max_age=None):
+    """
+    Marks prompts still pending or running ``max_age`` seconds (default:
+    ``PROMPT_JOB_STALE_SECONDS``) after they were created failed, and pushes
+    an ``error`` event for each. Their jobs were lost when the process running
+    them stopped. Returns the number of prompts marked failed.
+    """
+    if max_age is None:
+        max_age = settings.PROMPT_JOB_STALE_SECONDS
+    cutoff = timezone.now() - timedelta(seconds=max_age)
+    stale = Prompt.objects.filter(
+        status__in=[Prompt.STATUS_PENDING, Prompt.STATUS_RUNNING], created_at__lt=cutoff)
+
+    reaped = 0
+    for prompt in stale.select_related('user'):
+        # Only prompts no job finished meanwhile
+        failed = Prompt.objects.filter(
+            id=prompt.id, status__in=[Prompt.STATUS_PENDING, Prompt.STATUS_RUNNING]).update(
+            status=Prompt.STATUS_FAILED, error=INTERRUPTED_JOB_ERROR)
+        if failed:
+            prompt.status, prompt.error = Prompt.STATUS_FAILED, INTERRUPTED_JOB_ERROR
+            send_prompt_event(prompt.user, 'error', job_message(prompt))
+            reaped += 1
+    return reaped
+
+
+def process_prompt(prompt_id, use_cache=False, params=None):
+    """
+    Completes the pending prompt ``prompt_id``, streaming its response if it
+    was submitted with 'send_via_websocket'. Failures are logged and recorded
+    on the prompt.
+    """
+    claimed = Prompt.objects.filter(id=prompt_id, status=Prompt.STATUS_PENDING).update(
+        status=Prompt.STATUS_RUNNING)
+    if not claimed:
+        # Deleted, or already picked up
+        return
+    prompt = Prompt.objects.select_related('user', 'metadata').get(id=prompt_id)
+    metadata = getattr(prompt, 'metadata', None)
+
+    try:
+        complete_prompt(prompt, use_cache, stream=bool(metadata and metadata.sent_via_websocket), params=params)
+    except Exception:
+        logger.exception('Generating the response of prompt %s failed', prompt_id)
+
+
+def complete_prompt(prompt, use_cache=False, stream=False, params=None):
+    """
+    Generates the response and embedding of the stored ``prompt`` and saves
+    them, marking the prompt completed. If generation raises, the prompt is
+    marked failed and the error re-raised. Either way the outcome is pushed
+    to the user's WebSocket group; with ``stream`` the response is pushed
+    piece by piece while it is generated.
+    """
+    # Resolved once, so the stored model is the one the vector was made with
+    embedding_model = EmbeddingModel.active_name()
+    try:
+        result = generate_prompt_result(
+            prompt.text, prompt.user, use_cache, _chunk_sender(prompt) if stream else None, params, embedding_model)
+    except Exception as exc:
+        _fail_prompt(prompt, exc)
+        raise
+    return _store_result(prompt, embedding_model, *result)
+
+
+async def acomplete_prompt(prompt, use_cache=False, stream=False, params=None):
+    """Async counterpart of ``complete_prompt``, see ``agenerate_prompt_result``."""
+    embedding_model = await sync_to_async(EmbeddingModel.active_name)()
+    try:
+        result = await agenerate_prompt_result(
+            prompt.text, prompt.user, use_cache, _chunk_sender(prompt) if stream else None, params, embedding_model)
+    except Exception as exc:
+        await sync_to_async(_fail_prompt)(prompt, exc)
+        raise
+    return await sync_to_async(_store_result)(prompt, embedding_model, *result)
+
+
+def _chunk_sender(prompt):
+    def on_text(text):
+        send_prompt_event(prompt.user, 'chunk', {'prompt_id': prompt.id, 'text': text})
+    return on_text
+
+
+def _fail_prompt(prompt, exc):
+    prompt.status = Prompt.STATUS_FAILED
+    prompt.error = str(exc) or exc.__class__.__name__
+    prompt.save(update_fields=['status', 'error'])
+    send_prompt_event(prompt.user, 'error', job_message(prompt))
+
+
+def _store_result(prompt, embedding_model, response_text, embedding_vector, extra_info):
+    with PROMPT_STAGE_SECONDS.labels(stage='store').time(), transaction.atomic():
+        prompt.response = response_text
+        prompt.status = Prompt.STATUS_COMPLETED
+        prompt.save(update_fields=['response', 'status'])
+        PromptEmbedding.objects.create(
+            prompt=prompt,
+            vector=embedding_vector,
+            model_name=embedding_model
+        )
+        PromptMetadata.objects.filter(prompt=prompt).update(extra_info=extra_info)
+
+    send_prompt_event(prompt.user, 'done', job_message(prompt))
+    return prompt
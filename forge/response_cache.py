@@ -0,0 +1,78 @@
+"""
+Semantic cache of generated responses.
+
+Generating a response is by far the most expensive step of creating a prompt,
+and many prompts are paraphrases of earlier ones. When the cache is enabled
+the incoming prompt is embedded first and the nearest stored prompt embedded
+with the same model is looked up in the FAISS index. If it lies within
+``RESPONSE_CACHE_MAX_DISTANCE`` (cosine distance) its stored response is
+reused instead of running generation.
+
+The outcome is recorded on the new prompt's ``PromptMetadata.extra_info``
+under ``response_cache``: generation time on a miss, and the source prompt,
+its distance and the generation time saved on a hit.
+"""
+from django.conf import settings
+
+from .faiss_index import cosine_distance, prompt_index
+from .fields import to_vector
+from .metrics import RESPONSE_CACHE_REQUESTS, RESPONSE_CACHE_SAVED_SECONDS
+from .models import Prompt, PromptEmbedding
+
+EXTRA_INFO_KEY = 'response_cache'
+
+
+def find_cached_response(vector, model_name, user=None):
+    """
+    Returns ``(prompt, distance)`` for the stored prompt nearest to the
+    embedding ``vector`` within ``RESPONSE_CACHE_MAX_DISTANCE``, or None.
+    Only prompts embedded with ``model_name`` are considered, and only those
+    of ``user`` when ``RESPONSE_CACHE_PER_USER`` is set.
+    """
+    if settings.RESPONSE_CACHE_PER_USER and user is not None:
+        candidates = PromptEmbedding.objects.filter(model_name=model_name, prompt__user=user)
+    elif prompt_index.model_name == model_name:
+        # The index only holds embeddings by its model: search all of it
+        # rather than selecting nearly every prompt id
+        candidates = None
+    else:
+        # The active model changed since the prompt was embedded
+        candidates = PromptEmbedding.objects.filter(model_name=model_name)
+
+    query = to_vector(vector, normalize=True).reshape(1, -1)
+    result = prompt_index.search(query, 1, candidates=candidates)
+    if result is None or result[1][0][0] == -1:
+        return None
+
+    distance = float(cosine_distance(result[0][0][:1])[0])
+    if distance > settings.RESPONSE_CACHE_MAX_DISTANCE:
+        return None
+    prompt = Prompt.objects.select_related('metadata').filter(id=int(result[1][0][0])).first()
+    if prompt is None:
+        return None
+    return prompt, distance
+
+
+def generation_seconds(prompt):
+    """
+    Returns the time it took to generate the response of ``prompt``, following
+    cache hits back to the generated original, or None when it is unknown.
+    """
+    metadata = getattr(prompt, 'metadata', None)
+    info = ((metadata.extra_info if metadata else None) or {}).get(EXTRA_INFO_KEY) or {}
+    return info.get('generation_seconds', info.get('saved_seconds'))
+
+
+def record_hit(source, distance):
+    """Counts a cache hit on ``source`` and returns its ``extra_info`` entry."""
+    saved = generation_seconds(source)
+    RESPONSE_CACHE_REQUESTS.labels(result='hit').inc()
+    if saved is not None:
+        RESPONSE_CACHE_SAVED_SECONDS.inc(saved)
+    return {'hit': True, 'source_prompt': source.id, 'distance': round(distance, 6), 'saved_seconds': saved}
+
+
+def record_miss(seconds):
+    """Counts a cache miss and returns its ``extra_info`` entry."""
+    RESPONSE_CACHE_REQUESTS.labels(result='miss').inc()
+    return {'hit': False, 'generation_seconds': round(seconds, 3)}
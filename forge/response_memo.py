@@ -0,0 +1,57 @@
+"""
+Exact-match memo of deterministic responses.
+
+Responses generated greedily or from a fixed seed depend only on the model
+and its backend, the prompt and the generation parameters, so they are
+memoized under a hash of these in the ``responses`` cache alias, which all
+workers share. Repeated prompts, such as health probes and templated automated
+traffic, are then served without running the model. The cache backend bounds the memo and
+evicts old entries; randomly sampled responses are never memoized.
+"""
+import hashlib
+import json
+
+from django.core.cache import caches
+
+from .metrics import RESPONSE_MEMO_REQUESTS
+from .utils import GENERATION_MAX_LENGTH, GENERATION_MODEL_NAME, inference_backend, is_deterministic
+
+CACHE_ALIAS = 'responses'
+
+
+class ResponseMemo:
+    """
+    Memoizes the responses of deterministic generation requests.
+    """
+
+    def __init__(self, alias=CACHE_ALIAS):
+        self.alias = alias
+
+    @property
+    def cache(self):
+        return caches[self.alias]
+
+    def key(self, prompt, params):
+        parts = [GENERATION_MODEL_NAME, inference_backend(), GENERATION_MAX_LENGTH, params,
+                 hashlib.sha256(prompt.encode('utf-8')).hexdigest()]
+        digest = hashlib.sha256(json.dumps(parts, sort_keys=True).encode('utf-8')).hexdigest()
+        return f'response:{digest}'
+
+    def get(self, prompt, params):
+        """
+        Returns the memoized response to ``prompt`` generated with ``params``,
+        or None. Requests that are not deterministic always miss.
+        """
+        if not is_deterministic(params):
+            return None
+        response = self.cache.get(self.key(prompt, params))
+        RESPONSE_MEMO_REQUESTS.labels(result='miss' if response is None else 'hit').inc()
+        return response
+
+    def set(self, prompt, params, response):
+        """Memoizes ``response`` if ``params`` are deterministic."""
+        if is_deterministic(params):
+            self.cache.set(self.key(prompt, params), response)
+
+
+response_memo = ResponseMemo()
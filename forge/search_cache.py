@@ -0,0 +1,147 @@
+"""
+Shared cache of similarity search results.
+
+Results are cached per (normalized query, k, search parameters, filters) in
+the ``similar`` cache alias, which all workers share. Each entry is tagged with
+the index version it was computed at: the cache epoch and the position of the
+index, its watermark and the embeddings above it already searched (see
+``forge.faiss_index``).
+
+Embeddings created afterwards do not invalidate the entry. On the next hit
+only the embeddings above its watermark not searched yet that pass the
+entry's filters are compared with the query, merged into the cached ranking
+and the entry is rewritten with the new position. Its watermark is held back
+like the index's, so an embedding committed after a higher id is merged too.
+Deleted or modified embeddings bump the epoch, which invalidates every entry
+at once.
+"""
+import hashlib
+import json
+import uuid
+
+import faiss
+from django.conf import settings
+from django.core.cache import caches
+
+from .faiss_index import METRICS, advance_watermark, load_vectors, prompt_index, settled_before
+from .metrics import SIMILAR_CACHE_REQUESTS
+
+CACHE_ALIAS = 'similar'
+EPOCH_KEY = 'similar:epoch'
+
+
+def normalize_query(query):
+    """Collapses runs of whitespace so equivalent queries share an entry."""
+    return ' '.join(query.split())
+
+
+class SimilarResultsCache:
+    """
+    Caches the ranked ``(prompt_ids, distances)`` of similarity searches.
+    """
+
+    def __init__(self, alias=CACHE_ALIAS):
+        self.alias = alias
+
+    @property
+    def cache(self):
+        return caches[self.alias]
+
+    def epoch(self):
+        """
+        Returns the current cache epoch. A missing epoch (never set, or culled
+        by the backend) is replaced by a new one, so stale entries never match.
+        """
+        return self.cache.get_or_set(EPOCH_KEY, lambda: uuid.uuid4().hex, timeout=None)
+
+    def invalidate(self):
+        """Invalidates every cached result."""
+        self.cache.set(EPOCH_KEY, uuid.uuid4().hex, timeout=None)
+
+    def key(self, query, k, options):
+        candidates = options.get('candidates')
+        parts = [
+            # Queries are embedded by, and searched in the index of, the active model
+            prompt_index.model_name,
+            normalize_query(query), k, options.get('nprobe'), options.get('ef_search'),
+            # The SQL of the candidate queryset identifies its filters
+            None if candidates is None else str(candidates.query),
+        ]
+        digest = hashlib.sha256(json.dumps(parts).encode('utf-8')).hexdigest()
+        return f'similar:{digest}'
+
+    def search(self, query, k, options, embed):
+        """
+        Returns the ranked ``(prompt_ids, distances)`` of the ``k`` prompts most
+        similar to ``query``, searching ``prompt_index`` with ``options`` on a
+        miss. ``embed`` is called without arguments to get the query vector,
+        and only when the index has to be searched or refreshed results merged.
+        """
+        key = self.key(query, k, options)
+        epoch = self.epoch()
+        entry = self.cache.get(key)
+
+        if entry is not None and entry['epoch'] == epoch:
+            candidates = options.get('candidates')
+            if candidates is None:
+                candidates = prompt_index.embeddings()
+            recent = entry['recent']
+            settled = settled_before()
+            # Only embeddings not searched yet are merged, up to SIMILAR_CACHE_MERGE_MAX
+            limit = settings.SIMILAR_CACHE_MERGE_MAX + len(recent) + 1
+            above = list(candidates.filter(id__gt=entry['watermark']).values_list('id', 'created_at')[:limit])
+            added = [(embedding_id, created_at) for embedding_id, created_at in above if embedding_id not in recent]
+
+            if not added:
+                SIMILAR_CACHE_REQUESTS.labels(result='hit').inc()
+                return entry['ids'], entry['distances']
+            if len(above) < limit and len(added) <= settings.SIMILAR_CACHE_MERGE_MAX:
+                SIMILAR_CACHE_REQUESTS.labels(result='refresh').inc()
+                entry = self._merge(entry, candidates, added, k, embed(), settled)
+                self.cache.set(key, entry)
+                return entry['ids'], entry['distances']
+
+        SIMILAR_CACHE_REQUESTS.labels(result='miss').inc()
+        # Read before searching: embeddings created meanwhile are merged on the next hit
+        watermark, recent = prompt_index.position()
+        result = prompt_index.search(embed().reshape(1, -1), k, **options)
+
+        ids, distances = [], []
+        if result is not None:
+            found = result[1][0] != -1
+            ids = result[1][0][found].tolist()
+            distances = result[0][0][found].tolist()
+        self.cache.set(key, {'epoch': epoch, 'watermark': watermark, 'recent': recent,
+                             'ids': ids, 'distances': distances})
+        return ids, distances
+
+    def _merge(self, entry, candidates, added, k, vector, settled):
+        """
+        Ranks the embeddings of ``added``, ``(embedding_id, created_at)``
+        pairs of ``candidates``, against ``vector`` and merges them into
+        ``entry``, whose watermark moves past those created before ``settled``.
+        """
+        recent = dict(entry['recent'])
+        recent.update((embedding_id, created_at.timestamp()) for embedding_id, created_at in added)
+        watermark, recent = advance_watermark(entry['watermark'], recent, settled)
+        ranked = dict(zip(entry['ids'], entry['distances']))
+
+        prompt_ids, matrix = load_vectors(candidates.filter(id__in=[embedding_id for embedding_id, _ in added]))
+        if len(prompt_ids) and matrix.shape[1] == vector.shape[0]:
+            distances, positions = faiss.knn(vector.reshape(1, -1), matrix, min(k, len(prompt_ids)),
+                                             metric=METRICS[settings.FAISS_METRIC])
+            for distance, position in zip(distances[0], positions[0]):
+                ranked[int(prompt_ids[position])] = float(distance)
+
+        # Inner product scores similarity, L2 distance dissimilarity
+        pairs = sorted(ranked.items(), key=lambda pair: pair[1], reverse=settings.FAISS_METRIC == 'ip')[:k]
+        return {
+            'epoch': entry['epoch'],
+            'watermark': watermark,
+            'recent': recent,
+            'ids': [pair[0] for pair in pairs],
+            'distances': [pair[1] for pair in pairs],
+        }
+
+
+similar_results = SimilarResultsCache()
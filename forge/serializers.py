@@ -1,11 +1,25 @@
 from rest_framework import serializers
 from django.contrib.auth.models import User
+from .fields import to_vector
 from .models import Prompt, PromptMetadata, PromptEmbedding
 
 
+class VectorField(serializers.ListField):
+    """
+    List of floats backed by a float32 NumPy array. Arrays are converted in a
+    single ``tolist()`` call instead of serializing every element separately.
+    """
+    child = serializers.FloatField()
+
+    def to_representation(self, data):
+        return to_vector(data).tolist()
+
+    def to_internal_value(self, data):
+        return to_vector(super().to_internal_value(data))
+
+
 class PromptEmbeddingSerializer(serializers.ModelSerializer):
-    vector = serializers.ListField(
-        child=serializers.FloatField(),
+    vector = VectorField(
         help_text="Numerical embedding vector representing the prompt."
     )
 
@@ -13,6 +27,13 @@ class PromptEmbeddingSerializer(serializers.ModelSerializer):
         model = PromptEmbedding
         fields = ['model_name', 'vector']
 
+    def get_fields(self):
+        fields = super().get_fields()
+        # Raw vectors are large; callers may leave them out of the output
+        if not self.context.get('include_vector', True):
+            fields.pop('vector')
+        return fields
+
 
 class PromptMetadataSerializer(serializers.ModelSerializer):
     class Meta:
@@ -26,9 +47,9 @@ class PromptSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = Prompt
-        fields = ['id', 'user', 'text', 'response',
+        fields = ['id', 'user', 'text', 'response', 'status',
                   'created_at', 'metadata', 'embedding']
-        read_only_fields = ['user', 'created_at']
+        read_only_fields = ['user', 'status', 'created_at']
 
     def create(self, validated_data):
         metadata_data = validated_data.pop('metadata', None)
@@ -45,6 +66,18 @@ class PromptSerializer(serializers.ModelSerializer):
         return prompt
 
 
+class SimilarPromptSerializer(PromptSerializer):
+    """
+    A prompt found by a similarity search, with the cosine distance between
+    its embedding and the query. The distance is null for prompts that only
+    the full-text side of a hybrid search found.
+    """
+    distance = serializers.FloatField(read_only=True, default=None)
+
+    class Meta(PromptSerializer.Meta):
+        fields = PromptSerializer.Meta.fields + ['distance']
+
+
 class SignUpSerializer(serializers.ModelSerializer):
     password = serializers.CharField(write_only=True)
 
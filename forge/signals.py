@@ -0,0 +1,20 @@
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .models import PromptEmbedding
+from .search_cache import similar_results
+
+
+@receiver(post_save, sender=PromptEmbedding)
+def invalidate_similar_on_update(sender, instance, created, **kwargs):
+    """
+    New embeddings are merged into cached similarity results lazily; a changed
+    vector may reorder any of them, so every cached result is dropped.
+    """
+    if not created:
+        similar_results.invalidate()
+
+
+@receiver(post_delete, sender=PromptEmbedding)
+def invalidate_similar_on_delete(sender, instance, **kwargs):
+    similar_results.invalidate()
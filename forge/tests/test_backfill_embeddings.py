@@ -0,0 +1,135 @@
+import json
+import os
+import tempfile
+from io import StringIO
+from unittest.mock import patch
+
+import numpy as np
+from django.contrib.auth.models import User
+from django.core.management import CommandError, call_command
+from django.test import TestCase, override_settings
+
+from forge.faiss_index import ActivePromptIndex
+from forge.models import EmbeddingModel, Prompt, PromptEmbedding
+from forge.utils import EMBEDDING_MODEL_NAME
+
+
+def fake_encode(texts, batch_size=32, model_name=None):
+    if model_name == 'new-model':
+        return np.array([[len(text), 0.0, 1.0, 0.0] for text in texts], dtype='float32')
+    return np.array([[len(text), 1.0, 0.0] for text in texts], dtype='float32')
+
+
+@patch('forge.management.commands.backfill_embeddings.encode_texts', side_effect=fake_encode)
+class BackfillEmbeddingsCommandTest(TestCase):
+    """Test cases for the backfill_embeddings management command"""
+
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.checkpoint = os.path.join(tmpdir.name, 'backfill.json')
+
+        self.indexes = ActivePromptIndex()
+        for patcher in (patch('forge.faiss_index.INDEX_PATH', os.path.join(tmpdir.name, 'index.faiss')),
+                        patch('forge.management.commands.backfill_embeddings.prompt_index', self.indexes)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.manager = self.indexes.manager(EMBEDDING_MODEL_NAME)
+        self.addCleanup(setattr, EmbeddingModel, '_active', None)
+
+        user = User.objects.create_user(username='backfiller', password='testpass123')
+        self.prompts = [
+            Prompt.objects.create(user=user, text='x' * (i + 1), response='Response')
+            for i in range(5)
+        ]
+        PromptEmbedding.objects.create(prompt=self.prompts[0], vector=[0.0, 0.0, 1.0])
+        self.prompts[1].status = Prompt.STATUS_FAILED
+        self.prompts[1].save()
+        self.pending = Prompt.objects.create(user=user, text='pending', response='', status=Prompt.STATUS_PENDING)
+
+    def backfill(self, **options):
+        out = StringIO()
+        call_command('backfill_embeddings', checkpoint=self.checkpoint, stdout=out, **options)
+        return out.getvalue()
+
+    def test_embeds_prompts_without_embedding(self, mock_encode):
+        output = self.backfill(page_size=2, batch_size=1)
+
+        embedded = PromptEmbedding.objects.exclude(prompt=self.prompts[0])
+        self.assertEqual(sorted(embedded.values_list('prompt_id', flat=True)), [p.id for p in self.prompts[1:]])
+        self.assertEqual(set(embedded.values_list('model_name', flat=True)), {EMBEDDING_MODEL_NAME})
+        self.assertFalse(PromptEmbedding.objects.filter(prompt=self.pending).exists())
+        # Two pages of two prompts and one of one, encoded one text at a time
+        self.assertEqual(mock_encode.call_count, 4)
+        self.assertIn('prompts/s', output)
+        self.assertFalse(os.path.exists(self.checkpoint))
+
+        # The new embeddings are added to the index and published
+        self.assertEqual(self.manager.read_manifest()['ntotal'], 5)
+        self.assertIn('holds 5 vectors', output)
+
+    def test_batches_texts_of_similar_length(self, mock_encode):
+        Prompt.objects.filter(id=self.prompts[2].id).update(text='a much longer prompt than the others')
+        self.backfill(batch_size=2)
+
+        batches = [call.args[0] for call in mock_encode.call_args_list]
+        self.assertEqual(batches, [['xx', 'xxxx'], ['xxxxx', 'a much longer prompt than the others']])
+
+    def test_limit_checkpoints_and_resumes(self, mock_encode):
+        output = self.backfill(page_size=1, limit=2, skip_index=True)
+
+        self.assertIn('run again to resume', output)
+        self.assertEqual(PromptEmbedding.objects.count(), 3)
+        with open(self.checkpoint) as fh:
+            self.assertEqual(json.load(fh)['last_prompt_id'], self.prompts[2].id)
+        self.assertIsNone(self.manager.read_manifest())
+
+        # Prompts before the checkpoint are not scanned again
+        PromptEmbedding.objects.filter(prompt=self.prompts[1]).delete()
+        output = self.backfill()
+        self.assertIn(f'Resuming after prompt {self.prompts[2].id}', output)
+        self.assertFalse(PromptEmbedding.objects.filter(prompt=self.prompts[1]).exists())
+        self.assertEqual(PromptEmbedding.objects.count(), 4)
+
+        # Once finished, the next run starts over
+        self.backfill()
+        self.assertEqual(PromptEmbedding.objects.count(), 5)
+
+    def test_checkpoint_of_another_model_is_rejected(self, mock_encode):
+        with open(self.checkpoint, 'w') as fh:
+            json.dump({'last_prompt_id': 1, 'model_name': 'another-model'}, fh)
+
+        with self.assertRaises(CommandError):
+            self.backfill()
+        self.backfill(restart=True)
+        self.assertEqual(PromptEmbedding.objects.count(), 5)
+
+    @override_settings(EMBEDDING_MODEL_REFRESH_SECONDS=0)
+    @patch('forge.management.commands.backfill_embeddings.similar_results')
+    def test_reembeds_with_a_new_model_and_activates_it(self, mock_results, mock_encode):
+        self.backfill()
+        self.assertEqual(EmbeddingModel.active_name(), EMBEDDING_MODEL_NAME)
+
+        output = self.backfill(model='new-model', activate=True)
+
+        # Every prompt keeps its embedding by the previous model
+        self.assertEqual(PromptEmbedding.objects.filter(model_name=EMBEDDING_MODEL_NAME).count(), 5)
+        self.assertEqual(PromptEmbedding.objects.filter(model_name='new-model').count(), 5)
+        self.assertEqual(EmbeddingModel.active_name(), 'new-model')
+        mock_results.invalidate.assert_called_once_with()
+        self.assertIn(f'Activated new-model in place of {EMBEDDING_MODEL_NAME}', output)
+
+        # Each model has its own index; the prompt index now serves the new one
+        new_index = self.indexes.manager('new-model')
+        self.assertNotEqual(new_index.index_path, self.manager.index_path)
+        self.assertEqual(new_index.read_manifest()['ntotal'], 5)
+        self.assertEqual(self.manager.read_manifest()['ntotal'], 5)
+        self.assertIs(self.indexes.manager(), new_index)
+        self.assertEqual(self.indexes.load().d, 4)
+        self.assertEqual(Prompt.objects.with_embedding().get(id=self.prompts[0].id).embedding.model_name,
+                         'new-model')
+
+    def test_activate_requires_a_complete_backfill(self, mock_encode):
+        with self.assertRaises(CommandError):
+            self.backfill(model='new-model', activate=True, limit=1)
+        self.assertFalse(PromptEmbedding.objects.filter(model_name='new-model').exists())
@@ -0,0 +1,70 @@
+import threading
+
+from django.test import SimpleTestCase
+
+from forge.batching import MicroBatcher
+
+
+class MicroBatcherTest(SimpleTestCase):
+    """Test cases for the dynamic micro-batcher"""
+
+    def setUp(self):
+        self.batches = []
+
+    def double(self, items):
+        self.batches.append(list(items))
+        return [item * 2 for item in items]
+
+    def test_concurrent_items_share_a_batch(self):
+        batcher = MicroBatcher(self.double, max_batch_size=8, max_wait_ms=500)
+        futures = [batcher.submit(item) for item in range(4)]
+
+        self.assertEqual([future.result(timeout=5) for future in futures], [0, 2, 4, 6])
+        self.assertEqual(self.batches, [[0, 1, 2, 3]])
+
+    def test_batches_are_capped_at_max_size(self):
+        release = threading.Event()
+
+        def blocked(items):
+            release.wait(5)
+            return self.double(items)
+
+        batcher = MicroBatcher(blocked, max_batch_size=2, max_wait_ms=0)
+        first = batcher.submit(0)
+        futures = [batcher.submit(item) for item in range(1, 6)]
+        release.set()
+
+        self.assertEqual(first.result(timeout=5), 0)
+        self.assertEqual([future.result(timeout=5) for future in futures], [2, 4, 6, 8, 10])
+        self.assertTrue(all(len(batch) <= 2 for batch in self.batches))
+        self.assertEqual(sorted(item for batch in self.batches for item in batch), list(range(6)))
+
+    def test_call_returns_result_from_any_thread(self):
+        batcher = MicroBatcher(self.double, max_batch_size=4, max_wait_ms=50)
+        results = {}
+        threads = [threading.Thread(target=lambda n=n: results.__setitem__(n, batcher(n))) for n in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(5)
+
+        self.assertEqual(results, {0: 0, 1: 2, 2: 4, 3: 6})
+
+    def test_errors_reach_every_caller_of_the_batch(self):
+        def fail(items):
+            raise ValueError('model crashed')
+
+        batcher = MicroBatcher(fail, max_batch_size=4, max_wait_ms=200)
+        futures = [batcher.submit(item) for item in range(2)]
+        for future in futures:
+            with self.assertRaisesRegex(ValueError, 'model crashed'):
+                future.result(timeout=5)
+
+        # The batcher keeps serving after a failed batch
+        batcher.run_batch = self.double
+        self.assertEqual(batcher(3), 6)
+
+    def test_result_count_must_match(self):
+        batcher = MicroBatcher(lambda items: [], max_batch_size=4, max_wait_ms=0)
+        with self.assertRaises(RuntimeError):
+            batcher(1)
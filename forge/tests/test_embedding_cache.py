@@ -0,0 +1,148 @@
+import os
+import tempfile
+from unittest.mock import MagicMock, patch
+
+import numpy as np
+from django.test import SimpleTestCase, override_settings
+
+from forge.embedding_cache import EmbeddingCache
+
+
+class EmbeddingCacheFixturesMixin:
+    """Mixin to provide a cache backed by a temporary SQLite store"""
+
+    def setUp(self):
+        super().setUp()
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.path = os.path.join(tmpdir.name, 'embeddings.sqlite3')
+
+    def make_cache(self, memory_items=10, disk_max_bytes=1024 * 1024):
+        return EmbeddingCache(self.path, memory_items=memory_items, disk_max_bytes=disk_max_bytes)
+
+
+class EmbeddingCacheTest(EmbeddingCacheFixturesMixin, SimpleTestCase):
+    """Test cases for EmbeddingCache"""
+
+    def test_miss_then_memory_hit(self):
+        cache = self.make_cache()
+        self.assertIsNone(cache.get('model', 'fp32', 'text'))
+
+        cache.set('model', 'fp32', 'text', [1.0, 2.0])
+        vector = cache.get('model', 'fp32', 'text')
+
+        self.assertEqual(vector.dtype, np.float32)
+        self.assertEqual(vector.tolist(), [1.0, 2.0])
+        self.assertFalse(vector.flags.writeable)
+        self.assertEqual(cache.stats()['misses'], 1)
+        self.assertEqual(cache.stats()['memory_hits'], 1)
+
+    def test_keys_include_model_name(self):
+        cache = self.make_cache()
+        cache.set('model-a', 'fp32', 'text', [1.0])
+        self.assertIsNone(cache.get('model-b', 'fp32', 'text'))
+
+    def test_keys_include_backend(self):
+        cache = self.make_cache()
+        cache.set('model', 'fp32', 'text', [1.0])
+        self.assertIsNone(cache.get('model', 'int8', 'text'))
+
+    def test_shared_tier_is_visible_to_other_instances(self):
+        """Test a vector cached by one worker is a disk hit for another"""
+        self.make_cache().set('model', 'fp32', 'text', [0.5, 0.25])
+
+        other = self.make_cache()
+        self.assertEqual(other.get('model', 'fp32', 'text').tolist(), [0.5, 0.25])
+        self.assertEqual(other.stats()['disk_hits'], 1)
+
+        # Promoted to the in-process tier
+        other.get('model', 'fp32', 'text')
+        self.assertEqual(other.stats()['memory_hits'], 1)
+
+    def test_memory_tier_is_bounded(self):
+        cache = self.make_cache(memory_items=2, disk_max_bytes=0)
+        for text in ('a', 'b', 'c'):
+            cache.set('model', 'fp32', text, [1.0])
+
+        self.assertEqual(cache.stats()['memory_items'], 2)
+        self.assertIsNone(cache.get('model', 'fp32', 'a'))
+        self.assertIsNotNone(cache.get('model', 'fp32', 'c'))
+
+    @patch('forge.embedding_cache.ACCESS_REFRESH_SECONDS', 0)
+    def test_disk_tier_evicts_least_recently_used(self):
+        # Each entry is 400 bytes; the store holds at most two
+        cache = self.make_cache(memory_items=0, disk_max_bytes=1000)
+        vector = np.ones(100, dtype='float32')
+        cache.set('model', 'fp32', 'a', vector)
+        cache.set('model', 'fp32', 'b', vector)
+        cache.get('model', 'fp32', 'a')
+        cache.set('model', 'fp32', 'c', vector)
+
+        self.assertIsNotNone(cache.get('model', 'fp32', 'a'))
+        self.assertIsNone(cache.get('model', 'fp32', 'b'))
+        self.assertIsNotNone(cache.get('model', 'fp32', 'c'))
+
+    def test_recent_hits_do_not_write(self):
+        self.make_cache().set('model', 'fp32', 'text', [1.0])
+        cache = self.make_cache(memory_items=0)
+        cache.get('model', 'fp32', 'text')
+
+        statements = []
+        cache._connection().set_trace_callback(statements.append)
+        self.assertIsNotNone(cache.get('model', 'fp32', 'text'))
+        self.assertFalse([sql for sql in statements if sql.startswith('UPDATE')])
+
+    def test_get_many_preserves_order(self):
+        cache = self.make_cache()
+        cache.set_many('model', 'fp32', ['a', 'b'], np.array([[1.0], [2.0]]))
+
+        vectors = cache.get_many('model', 'fp32', ['b', 'x', 'a'])
+
+        self.assertEqual(vectors[0].tolist(), [2.0])
+        self.assertIsNone(vectors[1])
+        self.assertEqual(vectors[2].tolist(), [1.0])
+
+
+class GenerateEmbeddingsCacheTest(EmbeddingCacheFixturesMixin, SimpleTestCase):
+    """Test cases for the embedding cache in generate_embeddings"""
+
+    def setUp(self):
+        super().setUp()
+        self.model = MagicMock()
+        self.model.encode.side_effect = lambda texts, batch_size=32: np.array([[len(text), 1.0] for text in texts])
+        for patcher in (patch('forge.utils.get_embedding_model', return_value=self.model),
+                        patch('forge.utils.EmbeddingModel.active_name', return_value='active-model'),
+                        patch('forge.utils.embedding_cache', self.make_cache())):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_hot_texts_skip_the_model(self):
+        from forge.utils import generate_embedding, generate_embeddings
+
+        first = generate_embedding('hello')
+        second = generate_embedding('hello')
+
+        self.assertEqual(first.tolist(), second.tolist())
+        self.model.encode.assert_called_once_with(['hello'], batch_size=32)
+
+        matrix = generate_embeddings(['hello', 'hi', 'hi'])
+        self.assertEqual(matrix.tolist(), [[5.0, 1.0], [2.0, 1.0], [2.0, 1.0]])
+        # Only the missing text is encoded, once
+        self.model.encode.assert_called_with(['hi'], batch_size=32)
+
+    def test_vectors_are_cached_per_model(self):
+        from forge.utils import generate_embedding
+
+        generate_embedding('hello')
+        generate_embedding('hello', 'active-model')
+        self.assertEqual(self.model.encode.call_count, 1)
+        generate_embedding('hello', 'another-model')
+        self.assertEqual(self.model.encode.call_count, 2)
+
+    def test_vectors_are_cached_per_backend(self):
+        from forge.utils import generate_embedding
+
+        generate_embedding('hello')
+        with override_settings(INFERENCE_BACKEND='int8'):
+            generate_embedding('hello')
+        self.assertEqual(self.model.encode.call_count, 2)
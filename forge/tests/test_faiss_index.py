@@ -0,0 +1,567 @@
+import os
+import tempfile
+import threading
+from datetime import datetime, timezone as dt_timezone
+from unittest.mock import patch
+
+import faiss
+import numpy as np
+from io import StringIO
+from django.contrib.auth.models import User
+from django.core.management import CommandError, call_command
+from django.test import TestCase, override_settings
+from django.utils import timezone
+
+from forge.faiss_index import (
+    PromptIndexManager, atomic_write, base_index, build_index, process_memory, recall_at_k, rerank,
+    search_parameters,
+)
+from forge.models import Prompt, PromptEmbedding
+
+
+# Creation time of fake embeddings, long settled
+SETTLED = datetime(2024, 1, 1, tzinfo=dt_timezone.utc)
+
+
+def make_rows(start, count, dim=4, first_prompt_id=1, created_at=SETTLED):
+    """Builds fake delta-log rows of (embedding_id, prompt_id, vector, created_at)"""
+    rng = np.random.default_rng(start)
+    return [
+        (start + i, first_prompt_id + i, rng.random(dim).astype('float32').tolist(), created_at)
+        for i in range(count)
+    ]
+
+
+class IndexFixturesMixin:
+    """Mixin to provide an index manager backed by a temporary directory"""
+
+    def setUp(self):
+        super().setUp()
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.index_path = os.path.join(self.tmpdir.name, 'index.faiss')
+
+    def make_manager(self, rows, snapshot_every=10):
+        manager = PromptIndexManager(self.index_path, snapshot_every=snapshot_every)
+        manager.fetch_deltas = lambda: iter(
+            [row for row in rows if row[0] > manager.watermark and row[0] not in manager.recent])
+        self.addCleanup(manager.wait_for_publish)
+        return manager
+
+
+class PromptIndexManagerTest(IndexFixturesMixin, TestCase):
+    """Test cases for PromptIndexManager"""
+
+    def test_load_without_embeddings(self):
+        manager = self.make_manager([])
+        self.assertIsNone(manager.load())
+        self.assertIsNone(manager.read_manifest())
+
+    def test_first_load_publishes_snapshot(self):
+        rows = make_rows(1, 3)
+        manager = self.make_manager(rows)
+        index = manager.load()
+
+        self.assertEqual(index.ntotal, 3)
+        manifest = manager.read_manifest()
+        self.assertEqual(manifest['generation'], 1)
+        self.assertEqual(manifest['watermark'], 3)
+        self.assertTrue(os.path.exists(manager.snapshot_path(1)))
+
+    def test_search_returns_prompt_ids(self):
+        rows = make_rows(1, 5, first_prompt_id=100)
+        index = self.make_manager(rows).load()
+
+        query = np.asarray([rows[2][2]], dtype='float32')
+        distances, labels = index.search(query, 1)
+        self.assertEqual(labels[0][0], 102)
+        self.assertAlmostEqual(float(distances[0][0]), 0.0, places=5)
+
+    def test_deltas_are_applied_incrementally(self):
+        rows = make_rows(1, 3)
+        self.make_manager(rows).load()
+
+        rows += make_rows(4, 2, first_prompt_id=4)
+        manager = self.make_manager(rows)
+        with patch.object(manager, '_add_batch', wraps=manager._add_batch) as add_batch:
+            index = manager.load()
+
+        # Only the two new rows go through the delta path
+        add_batch.assert_called_once()
+        self.assertEqual(len(add_batch.call_args[0][0]), 2)
+        self.assertEqual(index.ntotal, 5)
+        # Below the snapshot threshold nothing new is published
+        self.assertEqual(manager.read_manifest()['generation'], 1)
+        self.assertEqual(manager.pending, 2)
+
+    def test_snapshot_published_after_threshold(self):
+        rows = make_rows(1, 3)
+        self.make_manager(rows).load()
+
+        rows += make_rows(4, 3, first_prompt_id=4)
+        manager = self.make_manager(rows, snapshot_every=3)
+        manager.load()
+
+        manifest = manager.read_manifest()
+        self.assertEqual(manifest['generation'], 2)
+        self.assertEqual(manifest['watermark'], 6)
+        self.assertEqual(manager.pending, 0)
+
+    def test_old_snapshots_are_pruned(self):
+        rows = []
+        for generation in range(1, 5):
+            rows += make_rows(generation, 1, first_prompt_id=generation)
+            self.make_manager(rows, snapshot_every=1).load()
+
+        manager = self.make_manager(rows)
+        self.assertEqual(manager.read_manifest()['generation'], 4)
+        self.assertFalse(os.path.exists(manager.snapshot_path(2)))
+        self.assertTrue(os.path.exists(manager.snapshot_path(3)))
+
+    def test_mismatched_dimensions_are_skipped(self):
+        rows = make_rows(1, 2) + make_rows(3, 1, dim=8, first_prompt_id=3)
+        manager = self.make_manager(rows)
+        index = manager.load()
+
+        self.assertEqual(index.ntotal, 2)
+        self.assertEqual(manager.watermark, 3)
+
+    def test_late_commits_below_the_watermark_are_applied(self):
+        # Embedding 2 commits after embedding 3, which was just created
+        rows = make_rows(1, 1) + make_rows(3, 1, first_prompt_id=3, created_at=timezone.now())
+        manager = self.make_manager(rows)
+        manager.load()
+        self.assertEqual(manager.watermark, 1)
+        self.assertEqual(list(manager.recent), [3])
+        self.assertEqual(manager.read_manifest()['recent'][0][0], 3)
+
+        rows += make_rows(2, 1, first_prompt_id=2)
+        self.assertEqual(manager.get().ntotal, 3)
+        # Embedding 3 is not added twice, by this worker or one loading the snapshot
+        self.assertEqual(manager.get().ntotal, 3)
+        manager.publish()
+        self.assertEqual(self.make_manager(rows).load().ntotal, 3)
+
+        with override_settings(FAISS_DELTA_SETTLE_SECONDS=0):
+            manager.get()
+        self.assertEqual(manager.watermark, 3)
+        self.assertEqual(manager.recent, {})
+
+    def test_recent_embeddings_are_read_from_the_database_once(self):
+        user = User.objects.create_user(username='alice', password='testpass123')
+        rng = np.random.default_rng(0)
+
+        def create_embedding(i):
+            prompt = Prompt.objects.create(user=user, text=f'Prompt {i}', response='Response')
+            PromptEmbedding.objects.create(prompt=prompt, vector=rng.random(4))
+
+        for i in range(3):
+            create_embedding(i)
+        manager = PromptIndexManager(self.index_path)
+        self.assertEqual(manager.load().ntotal, 3)
+        # Just created, so they stay above the watermark
+        self.assertEqual(manager.watermark, 0)
+        self.assertEqual(len(manager.recent), 3)
+
+        create_embedding(3)
+        self.assertEqual(manager.get().ntotal, 4)
+        self.assertEqual(manager.get().ntotal, 4)
+
+    def test_publish_skipped_while_locked(self):
+        from filelock import FileLock
+
+        manager = self.make_manager(make_rows(1, 2))
+        with FileLock(manager.lock_path):
+            manager.load()
+        self.assertIsNone(manager.read_manifest())
+
+
+class ResidentIndexTest(IndexFixturesMixin, TestCase):
+    """Test cases for the process-resident index and version invalidation"""
+
+    def test_get_keeps_index_in_memory(self):
+        manager = self.make_manager(make_rows(1, 3))
+        index = manager.get()
+
+        with patch('forge.faiss_index.faiss.read_index') as read_index:
+            self.assertIs(manager.get(), index)
+        read_index.assert_not_called()
+
+    def test_get_applies_new_embeddings_without_reloading(self):
+        rows = make_rows(1, 3)
+        manager = self.make_manager(rows)
+        index = manager.get()
+
+        rows += make_rows(4, 1, first_prompt_id=4)
+        with patch('forge.faiss_index.faiss.read_index') as read_index:
+            self.assertIs(manager.get(), index)
+        read_index.assert_not_called()
+        self.assertEqual(index.ntotal, 4)
+
+    def test_get_reloads_when_another_worker_publishes(self):
+        rows = make_rows(1, 3)
+        worker_a = self.make_manager(rows)
+        worker_b = self.make_manager(rows)
+        worker_a.get()
+        worker_a.wait_for_publish()
+        worker_b.get()
+
+        rows += make_rows(4, 10, first_prompt_id=4)
+        worker_b.get()
+        worker_b.wait_for_publish()
+        self.assertEqual(worker_b.generation, 2)
+
+        worker_a.fetch_deltas = lambda: iter([])
+        index = worker_a.get()
+        self.assertEqual(worker_a.generation, 2)
+        self.assertEqual(index.ntotal, 13)
+
+    def test_search_on_empty_index(self):
+        manager = self.make_manager([])
+        self.assertIsNone(manager.search(np.zeros((1, 4), dtype='float32'), 5))
+
+    def test_search_caps_k_at_index_size(self):
+        manager = self.make_manager(make_rows(1, 2))
+        distances, labels = manager.search(np.zeros((1, 4), dtype='float32'), 5)
+        self.assertEqual(labels.shape, (1, 2))
+
+
+class MappedSnapshotTest(IndexFixturesMixin, TestCase):
+    """Test cases for memory-mapped snapshots with an in-memory delta"""
+
+    def test_deltas_do_not_touch_the_snapshot(self):
+        rows = make_rows(1, 3)
+        manager = self.make_manager(rows)
+        manager.get()
+        manager.wait_for_publish()
+        base = manager.base
+
+        rows += make_rows(4, 2, first_prompt_id=4)
+        index = manager.get()
+
+        self.assertEqual(base.ntotal, 3)
+        self.assertEqual(manager.delta.ntotal, 2)
+        self.assertEqual(index.ntotal, 5)
+        distances, labels = index.search(np.asarray([rows[4][2]], dtype='float32'), 1)
+        self.assertEqual(labels[0][0], 5)
+
+    def test_publish_maps_the_new_snapshot(self):
+        rows = make_rows(1, 3)
+        manager = self.make_manager(rows, snapshot_every=2)
+        manager.get()
+        manager.wait_for_publish()
+
+        rows += make_rows(4, 2, first_prompt_id=4)
+        manager.get()
+        manager.wait_for_publish()
+
+        self.assertEqual(manager.generation, 2)
+        self.assertIsNone(manager.delta)
+        self.assertEqual(manager.base.ntotal, 5)
+        self.assertEqual(manager.delta_rows, [])
+
+    def test_stale_snapshot_is_not_republished(self):
+        """Test a worker behind another one's snapshot leaves publishing to the next reload"""
+        rows = make_rows(1, 3)
+        worker_a = self.make_manager(rows, snapshot_every=1)
+        worker_b = self.make_manager(rows)
+        worker_a.get()
+        worker_a.wait_for_publish()
+        worker_b.get()
+
+        rows += make_rows(4, 1, first_prompt_id=4)
+        worker_a.get()
+        worker_a.wait_for_publish()
+        rows += make_rows(5, 1, first_prompt_id=5)
+        worker_b.apply_deltas()
+
+        self.assertFalse(worker_b.publish())
+        self.assertEqual(worker_b.get().ntotal, 5)
+        self.assertEqual(worker_b.generation, 2)
+
+    def test_searches_go_on_while_a_snapshot_is_written(self):
+        rows = make_rows(1, 3)
+        manager = self.make_manager(rows)
+        writing, release = threading.Event(), threading.Event()
+        write_index = faiss.write_index
+
+        def slow_write(index, path):
+            writing.set()
+            release.wait(5)
+            write_index(index, path)
+
+        with patch('forge.faiss_index.faiss.write_index', side_effect=slow_write):
+            manager.get()
+            self.assertTrue(writing.wait(5))
+            rows += make_rows(4, 1, first_prompt_id=4)
+            self.assertEqual(manager.get().ntotal, 4)
+            self.assertTrue(manager.publisher.is_alive())
+            release.set()
+            manager.wait_for_publish()
+
+        self.assertEqual(manager.generation, 1)
+        # The embedding added while writing is applied on top of the new snapshot
+        self.assertEqual(manager.get().ntotal, 4)
+
+    def test_publish_without_a_readable_manifest(self):
+        """Test a worker whose manifest disappeared leaves publishing to the next reload"""
+        for content in (None, '{"generation": '):
+            with self.subTest(content=content):
+                rows = make_rows(1, 3)
+                manager = self.make_manager(rows)
+                manager.load()
+                if content is None:
+                    os.unlink(manager.manifest_path)
+                else:
+                    with open(manager.manifest_path, 'w') as fh:
+                        fh.write(content)
+
+                rows += make_rows(4, 1, first_prompt_id=4)
+                manager.apply_deltas()
+                self.assertIsNone(manager.read_manifest())
+                self.assertFalse(manager.publish())
+
+    @override_settings(FAISS_INDEX_TYPE='ivf_flat', FAISS_IVF_NLIST=4)
+    def test_ivf_snapshot_is_mapped(self):
+        rows = make_rows(1, 50)
+        manager = self.make_manager(rows)
+        trained = build_index(4, 'ivf_flat')
+        trained.train(np.random.default_rng(0).random((200, 4)).astype('float32'))
+        manager.save_trained(trained)
+        manager.get()
+        manager.wait_for_publish()
+
+        rows += make_rows(51, 5, first_prompt_id=51)
+        reader = self.make_manager(rows)
+        index = reader.get()
+
+        self.assertIsInstance(base_index(reader.delta), faiss.IndexIVFFlat)
+        self.assertEqual(index.ntotal, 55)
+        distances, labels = reader.search(np.asarray([rows[52][2]], dtype='float32'), 1, nprobe=4)
+        self.assertEqual(labels[0][0], 53)
+
+    @override_settings(FAISS_MMAP=False)
+    def test_snapshot_can_be_loaded_as_private_copy(self):
+        rows = make_rows(1, 3)
+        self.make_manager(rows).load()
+        index = self.make_manager(rows).get()
+        self.assertEqual(index.ntotal, 3)
+
+    def test_process_memory(self):
+        memory = process_memory()
+        if memory is None:
+            self.skipTest('/proc is not available')
+        self.assertGreater(memory['rss'], 0)
+
+    def test_index_memory_command(self):
+        manager = self.make_manager(make_rows(1, 20))
+        manager.load()
+        out = StringIO()
+        with patch('forge.management.commands.index_memory.prompt_index', manager):
+            call_command('index_memory', workers=2, queries=2, stdout=out)
+
+        self.assertIn('Private copy', out.getvalue())
+        self.assertIn('Memory-mapped', out.getvalue())
+
+
+@override_settings(FAISS_IVF_NLIST=4, FAISS_PQ_M=2, FAISS_PQ_NBITS=4, FAISS_HNSW_M=8)
+class IndexFactoryTest(IndexFixturesMixin, TestCase):
+    """Test cases for the configurable index types"""
+
+    def test_build_index_types(self):
+        expected = {
+            'flat': faiss.IndexFlat,
+            'ivf_flat': faiss.IndexIVFFlat,
+            'ivf_pq': faiss.IndexIVFPQ,
+            'hnsw': faiss.IndexHNSWFlat,
+        }
+        for index_type, cls in expected.items():
+            with self.subTest(index_type=index_type):
+                # Keep the wrapper alive: the inner index is owned by it
+                index = build_index(8, index_type)
+                self.assertIsInstance(base_index(index), cls)
+
+    def test_build_index_unknown_type(self):
+        with self.assertRaises(ValueError):
+            build_index(8, 'lsh')
+
+    def test_search_parameters(self):
+        ivf, hnsw, flat = (build_index(8, t) for t in ('ivf_flat', 'hnsw', 'flat'))
+        self.assertEqual(search_parameters(ivf, nprobe=3).nprobe, 3)
+        self.assertEqual(search_parameters(hnsw, ef_search=99).efSearch, 99)
+        self.assertIsNone(search_parameters(flat))
+
+    @override_settings(FAISS_NPROBE=7)
+    def test_search_parameters_defaults(self):
+        index = build_index(8, 'ivf_flat')
+        self.assertEqual(search_parameters(index).nprobe, 7)
+
+    @override_settings(FAISS_INDEX_TYPE='ivf_flat')
+    def test_untrained_type_falls_back_to_flat(self):
+        index = self.make_manager(make_rows(1, 3)).load()
+        self.assertIsInstance(base_index(index), faiss.IndexFlat)
+
+    @override_settings(FAISS_INDEX_TYPE='ivf_flat')
+    def test_trained_template_is_used(self):
+        manager = self.make_manager(make_rows(1, 50))
+        trained = build_index(4, 'ivf_flat')
+        trained.train(np.random.default_rng(0).random((200, 4)).astype('float32'))
+        manager.save_trained(trained)
+
+        index = manager.load()
+        self.assertIsInstance(base_index(index), faiss.IndexIVFFlat)
+        self.assertEqual(index.ntotal, 50)
+        distances, labels = manager.search(np.zeros((1, 4), dtype='float32'), 3, nprobe=4)
+        self.assertEqual(labels.shape, (1, 3))
+
+    def test_build_compressed_index_types(self):
+        for index_type, cls in (('pca_ivf_pq', faiss.IndexIVFPQ), ('pca_ivf_sq8', faiss.IndexIVFScalarQuantizer)):
+            with self.subTest(index_type=index_type), override_settings(FAISS_PCA_DIM=4):
+                index = build_index(8, index_type)
+                self.assertIsInstance(faiss.downcast_index(index), faiss.IndexPreTransform)
+                self.assertIsInstance(base_index(index), cls)
+
+    def test_rerank_orders_by_exact_distance(self):
+        stored = np.array([[0.0, 1.0], [1.0, 0.0], [0.6, 0.8]], dtype='float32')
+        labels = np.array([[10, 11, 12, -1]])
+        distances, ranked = rerank(np.array([[1.0, 0.0]], dtype='float32'), labels,
+                                   np.array([10, 11, 12]), stored, 2)
+        self.assertEqual(ranked.tolist(), [[11, 12]])
+        self.assertAlmostEqual(float(distances[0][0]), 0.0)
+
+    def test_recall_at_k(self):
+        exact = np.array([[1, 2], [3, 4]])
+        approx = np.array([[2, 1], [3, -1]])
+        self.assertEqual(recall_at_k(exact, approx), 0.75)
+
+
+class FilteredSearchTest(IndexFixturesMixin, TestCase):
+    """Test cases for searches restricted to a subset of prompts"""
+
+    def setUp(self):
+        super().setUp()
+        self.alice = User.objects.create_user(username='alice', password='testpass123')
+        self.bob = User.objects.create_user(username='bob', password='testpass123')
+        rng = np.random.default_rng(1)
+        self.vectors = {}
+        for i in range(40):
+            user = self.alice if i < 4 else self.bob
+            prompt = Prompt.objects.create(user=user, text=f'Prompt {i}', response='Response')
+            embedding = PromptEmbedding.objects.create(prompt=prompt, vector=rng.random(4))
+            self.vectors[prompt.id] = embedding.vector
+        self.alice_ids = set(Prompt.objects.filter(user=self.alice).values_list('id', flat=True))
+        self.manager = PromptIndexManager(self.index_path)
+        self.addCleanup(self.manager.wait_for_publish)
+        self.query = np.asarray([self.vectors[max(self.vectors)]], dtype='float32')
+
+    def search(self, k=3):
+        candidates = PromptEmbedding.objects.filter(prompt__user=self.alice)
+        return self.manager.search(self.query, k, candidates=candidates)
+
+    def test_exact_path_returns_k_matching_prompts(self):
+        distances, labels = self.search()
+        self.assertEqual(len(labels[0]), 3)
+        self.assertTrue(set(labels[0].tolist()) <= self.alice_ids)
+
+    @override_settings(FAISS_EXACT_FILTER_MAX=0)
+    def test_selector_path_returns_k_matching_prompts(self):
+        distances, labels = self.search()
+        self.assertEqual(len(labels[0]), 3)
+        self.assertTrue(set(labels[0].tolist()) <= self.alice_ids)
+
+    @override_settings(FAISS_EXACT_FILTER_MAX=0, FAISS_INDEX_TYPE='ivf_flat', FAISS_IVF_NLIST=8, FAISS_NPROBE=1)
+    def test_selector_path_widens_approximate_search(self):
+        trained = build_index(4, 'ivf_flat')
+        trained.train(np.vstack(list(self.vectors.values())))
+        self.manager.save_trained(trained)
+
+        distances, labels = self.search(k=4)
+        self.assertEqual(set(labels[0].tolist()), self.alice_ids)
+
+    @override_settings(FAISS_INDEX_TYPE='pca_ivf_pq', FAISS_PCA_DIM=2, FAISS_IVF_NLIST=2,
+                       FAISS_PQ_M=1, FAISS_PQ_NBITS=4, FAISS_RERANK_FACTOR=4)
+    def test_compressed_results_are_reranked(self):
+        trained = build_index(4, 'pca_ivf_pq')
+        trained.train(np.random.default_rng(0).random((400, 4)).astype('float32'))
+        self.manager.save_trained(trained)
+
+        with patch.object(self.manager, '_rerank', wraps=self.manager._rerank) as rerank_:
+            distances, labels = self.manager.search(self.query, 3, nprobe=2)
+
+        # Candidates are fetched beyond k, then ranked by their exact distance
+        self.assertEqual(rerank_.call_args[0][2].shape, (1, 12))
+        self.assertEqual(labels.shape, (1, 3))
+        self.assertEqual(labels[0][0], max(self.vectors))
+        self.assertAlmostEqual(float(distances[0][0]), 0.0, places=5)
+        self.assertTrue(np.all(np.diff(distances[0]) >= 0))
+
+    def test_paths_agree(self):
+        exact = self.search()
+        with override_settings(FAISS_EXACT_FILTER_MAX=0):
+            indexed = self.search()
+        self.assertEqual(exact[1].tolist(), indexed[1].tolist())
+
+    def test_no_matching_prompts(self):
+        candidates = PromptEmbedding.objects.filter(model_name='unknown')
+        self.assertIsNone(self.manager.search(self.query, 3, candidates=candidates))
+
+
+@override_settings(FAISS_IVF_NLIST=2)
+class TrainPromptIndexCommandTest(IndexFixturesMixin, TestCase):
+    """Test cases for the train_prompt_index management command"""
+
+    def setUp(self):
+        super().setUp()
+        user = User.objects.create_user(username='trainer', password='testpass123')
+        rng = np.random.default_rng(0)
+        for i in range(60):
+            prompt = Prompt.objects.create(user=user, text=f'Prompt {i}', response='Response')
+            PromptEmbedding.objects.create(prompt=prompt, vector=rng.random(4))
+
+        self.manager = PromptIndexManager(self.index_path)
+        self.addCleanup(self.manager.wait_for_publish)
+        patcher = patch('forge.management.commands.train_prompt_index.prompt_index', self.manager)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_reports_recall(self):
+        out = StringIO()
+        call_command('train_prompt_index', index_type='ivf_flat', queries=10, k=5, nprobe=2, stdout=out)
+
+        self.assertIn('recall@5: 1.0000', out.getvalue())
+        self.assertTrue(os.path.exists(self.manager.trained_path('ivf_flat')))
+
+    @override_settings(FAISS_INDEX_TYPE='ivf_flat')
+    def test_publish(self):
+        call_command('train_prompt_index', queries=10, publish=True, stdout=StringIO())
+
+        manifest = self.manager.read_manifest()
+        self.assertEqual(manifest['index_type'], 'IndexIVFFlat')
+        self.assertEqual(manifest['ntotal'], 60)
+
+    def test_requires_embeddings(self):
+        PromptEmbedding.objects.all().delete()
+        with self.assertRaises(CommandError):
+            call_command('train_prompt_index', stdout=StringIO())
+
+
+class AtomicWriteTest(TestCase):
+    """Test cases for atomic_write"""
+
+    def test_failed_write_leaves_target_untouched(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'data.bin')
+            with open(path, 'w') as fh:
+                fh.write('original')
+
+            def failing_writer(tmp_path):
+                with open(tmp_path, 'w') as fh:
+                    fh.write('partial')
+                raise RuntimeError('disk full')
+
+            with self.assertRaises(RuntimeError):
+                atomic_write(path, failing_writer)
+
+            with open(path) as fh:
+                self.assertEqual(fh.read(), 'original')
+            self.assertEqual(os.listdir(tmpdir), ['data.bin'])
@@ -0,0 +1,54 @@
+from unittest.mock import MagicMock, patch
+
+from django.contrib.auth.models import User
+from django.db import OperationalError
+from django.test import TestCase
+
+from forge.hybrid_search import hybrid_search, lexical_search, reciprocal_rank_fusion
+from forge.models import Prompt, PromptEmbedding
+
+
+class ReciprocalRankFusionTest(TestCase):
+    """Test cases for reciprocal_rank_fusion"""
+
+    def test_items_in_both_rankings_come_first(self):
+        self.assertEqual(reciprocal_rank_fusion([[1, 2, 3], [3, 4]]), [3, 1, 2, 4])
+
+    def test_ties_keep_first_seen_order(self):
+        self.assertEqual(reciprocal_rank_fusion([[1], [2]]), [1, 2])
+
+    def test_empty_rankings(self):
+        self.assertEqual(reciprocal_rank_fusion([[], []]), [])
+
+
+class HybridSearchTest(TestCase):
+    """Test cases for hybrid_search and its full-text fallback"""
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='searcher', password='testpass123')
+        self.other = User.objects.create_user(username='other', password='testpass123')
+        self.order = Prompt.objects.create(user=self.user, text='Where is order ORD-1234?', response='Shipped')
+        self.refund = Prompt.objects.create(user=self.user, text='How do refunds work?', response='Refunds take a week')
+        self.foreign = Prompt.objects.create(user=self.other, text='ORD-1234 again', response='Shipped')
+        for prompt in (self.order, self.refund, self.foreign):
+            PromptEmbedding.objects.create(prompt=prompt, vector=[1.0, 0.0])
+
+    def test_lexical_search_matches_text_and_response(self):
+        self.assertEqual(set(lexical_search('ord-1234', 10)), {self.order.id, self.foreign.id})
+        self.assertEqual(lexical_search('a week', 10), [self.refund.id])
+
+    def test_lexical_search_respects_candidates(self):
+        candidates = PromptEmbedding.objects.filter(prompt__user=self.user)
+        self.assertEqual(lexical_search('ORD-1234', 10, candidates), [self.order.id])
+
+    def test_exact_identifier_is_promoted(self):
+        ids = hybrid_search('ORD-1234', 2, lambda limit: [self.refund.id, self.order.id],
+                            PromptEmbedding.objects.filter(prompt__user=self.user))
+        self.assertEqual(ids, [self.order.id, self.refund.id])
+
+    @patch('forge.hybrid_search._lexical_task', side_effect=OperationalError('canceling statement'))
+    @patch('forge.hybrid_search.connection', MagicMock(vendor='postgresql'))
+    def test_vector_results_returned_when_full_text_search_fails(self, lexical_task):
+        ids = hybrid_search('ORD-1234', 2, lambda limit: [self.refund.id, self.order.id])
+        self.assertEqual(ids, [self.refund.id, self.order.id])
+        lexical_task.assert_called_once()
@@ -0,0 +1,134 @@
+import os
+import tempfile
+import threading
+from unittest.mock import MagicMock, patch
+
+import numpy as np
+from django.test import SimpleTestCase
+
+from forge import utils
+from forge.inference import InferenceClient, InferenceError, InferenceServer, pack_strings, unpack_strings
+
+
+def fake_generate(prompt, params):
+    if prompt == 'fail':
+        raise RuntimeError('model exploded')
+    return f'{prompt} -> {params["do_sample"]}'
+
+
+def fake_stream(prompt, on_text, params):
+    for piece in ('one ', 'two'):
+        on_text(piece)
+    return prompt + ' one two'
+
+
+def fake_embed(texts, model_name):
+    return np.array([[len(text), i, len(model_name)] for i, text in enumerate(texts)], dtype='float32').reshape(-1, 3)
+
+
+class InferenceServerTest(SimpleTestCase):
+    """Test cases for the inference server and its client"""
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'inference.sock')
+        self.server = self.start_server()
+        self.client = InferenceClient(self.path, timeout=5)
+        self.addCleanup(self.client.close)
+
+    def start_server(self, generate=fake_generate):
+        server = InferenceServer(self.path, generate=generate, stream=fake_stream, embed=fake_embed)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        return server
+
+    def test_strings_round_trip(self):
+        strings = ['', 'plain', 'ünïcode ✓', 'x' * 1000]
+        self.assertEqual(unpack_strings(pack_strings(strings)), strings)
+
+    def test_generate(self):
+        self.assertEqual(self.client.generate('hello', {'do_sample': False}), 'hello -> False')
+
+    def test_stream_delivers_chunks_before_the_result(self):
+        chunks = []
+        self.assertEqual(self.client.stream('hi', chunks.append, {'do_sample': True}), 'hi one two')
+        self.assertEqual(chunks, ['one ', 'two'])
+
+    def test_embed(self):
+        vectors = self.client.embed(['a', 'abc'], 'model')
+        self.assertEqual(vectors.dtype, np.float32)
+        np.testing.assert_array_equal(vectors, [[1, 0, 5], [3, 1, 5]])
+        self.assertEqual(self.client.embed([], 'model').shape, (0, 3))
+
+    def test_server_errors_are_raised(self):
+        with self.assertRaisesMessage(InferenceError, 'model exploded'):
+            self.client.generate('fail', {'do_sample': True})
+        # The connection is still usable afterwards
+        self.assertEqual(self.client.generate('ok', {'do_sample': True}), 'ok -> True')
+
+    def test_connection_is_reused(self):
+        self.client.generate('one', {'do_sample': True})
+        sock = self.client._local.sock
+        self.client.embed(['two'], 'model')
+        self.assertIs(self.client._local.sock, sock)
+
+    def test_reconnects_after_server_restart(self):
+        self.client.generate('before', {'do_sample': True})
+        self.server.shutdown()
+        self.server.server_close()
+        os.unlink(self.path)
+        self.start_server()
+        self.assertEqual(self.client.generate('after', {'do_sample': True}), 'after -> True')
+
+    def test_unreachable_server(self):
+        client = InferenceClient(self.path + '.missing', timeout=1)
+        with self.assertRaises(InferenceError):
+            client.generate('hello', {'do_sample': True})
+
+    def test_timeout(self):
+        release = threading.Event()
+        self.addCleanup(release.set)
+
+        def slow_generate(prompt, params):
+            release.wait(5)
+            return prompt
+
+        self.path += '.slow'
+        self.start_server(generate=slow_generate)
+        client = InferenceClient(self.path, timeout=0.2)
+        self.addCleanup(client.close)
+        with self.assertRaisesMessage(InferenceError, 'timed out'):
+            client.generate('hello', {'do_sample': True})
+
+
+class InferenceRoutingTest(SimpleTestCase):
+    """Test cases for sending model calls to the inference server"""
+
+    def setUp(self):
+        self.client = MagicMock()
+        patcher = patch('forge.utils.inference_client', self.client)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @patch('forge.utils.load_models')
+    def test_model_calls_use_the_server(self, mock_load):
+        params = utils.generation_params(deterministic=True)
+        self.client.generate.return_value = 'generated'
+        self.assertEqual(utils.generate_response('hello', params), 'generated')
+        self.client.generate.assert_called_once_with('hello', params)
+
+        on_text = MagicMock()
+        self.client.stream.return_value = 'streamed'
+        self.assertEqual(utils.stream_response('hello', on_text, params), 'streamed')
+        self.client.stream.assert_called_once_with('hello', on_text, params)
+
+        self.client.embed.return_value = np.ones((1, 3), dtype='float32')
+        with patch('forge.utils.embedding_cache.get_many', return_value=[None]), \
+                patch('forge.utils.embedding_cache.set_many'):
+            np.testing.assert_array_equal(utils.generate_embedding('text', 'model'), [1, 1, 1])
+        self.client.embed.assert_called_once_with(['text'], 'model')
+
+        utils.preload_models()
+        mock_load.assert_not_called()
@@ -9,3 +9,43 @@ class JwtAuthMiddlewareTest(TestCase):
     def setUp(self):
         from forge.middleware.jwt_auth import JwtAuthMiddleware
         self.middleware = JwtAuthMiddleware(MagicMock())
+
+
+class AsyncWhiteNoiseMiddlewareTest(TestCase):
+    """Test cases for the async-capable static file middleware"""
+
+    def setUp(self):
+        import tempfile
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        with open(f'{tmpdir.name}/robots.txt', 'w') as fh:
+            fh.write('User-agent: *\n')
+        self.settings_override = self.settings(WHITENOISE_ROOT=tmpdir.name, WHITENOISE_AUTOREFRESH=False)
+        self.settings_override.enable()
+        self.addCleanup(self.settings_override.disable)
+
+    def test_async_requests_stay_async(self):
+        from asgiref.sync import async_to_sync, iscoroutinefunction
+        from django.http import HttpResponse
+        from django.test import RequestFactory
+        from forge.middleware.static_files import AsyncWhiteNoiseMiddleware
+
+        async def view(request):
+            return HttpResponse('view')
+
+        middleware = AsyncWhiteNoiseMiddleware(view)
+        self.assertTrue(iscoroutinefunction(middleware))
+
+        static = async_to_sync(middleware)(RequestFactory().get('/robots.txt'))
+        self.assertEqual(b''.join(static.streaming_content), b'User-agent: *\n')
+        self.assertEqual(async_to_sync(middleware)(RequestFactory().get('/prompts/')).content, b'view')
+
+    def test_sync_requests_stay_sync(self):
+        from asgiref.sync import iscoroutinefunction
+        from django.test import RequestFactory
+        from forge.middleware.static_files import AsyncWhiteNoiseMiddleware
+
+        view = MagicMock(return_value='response')
+        middleware = AsyncWhiteNoiseMiddleware(view)
+        self.assertFalse(iscoroutinefunction(middleware))
+        self.assertEqual(middleware(RequestFactory().get('/prompts/')), 'response')
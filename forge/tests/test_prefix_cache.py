@@ -0,0 +1,124 @@
+from unittest.mock import MagicMock, patch
+
+import torch
+from django.test import SimpleTestCase
+
+from forge import utils
+from forge.prefix_cache import PrefixCache, PrefixEntry
+
+PREAMBLE = 'You are a helpful assistant.\nAnswer briefly.\n'
+
+
+class PrefixCacheTest(SimpleTestCase):
+    """Test cases for detecting and caching shared prompt prefixes"""
+
+    def test_frequent_line_prefixes_are_detected(self):
+        cache = PrefixCache(max_entries=4, frequent_after=2)
+
+        self.assertIsNone(cache.find_prefix(PREAMBLE + 'What is FAISS?'))
+        self.assertEqual(cache.find_prefix(PREAMBLE + 'What is Django?'), PREAMBLE)
+        # A prompt ending with a newline leaves nothing after its last line
+        self.assertEqual(cache.find_prefix(PREAMBLE), 'You are a helpful assistant.\n')
+
+    def test_longest_registered_prefix_wins(self):
+        cache = PrefixCache(max_entries=4, frequent_after=0, prefixes=['You are', PREAMBLE])
+
+        self.assertEqual(cache.find_prefix(PREAMBLE + 'Hi'), PREAMBLE)
+        self.assertEqual(cache.find_prefix('You are here'), 'You are')
+        self.assertIsNone(cache.find_prefix('You are'))
+        self.assertIsNone(cache.find_prefix('Something else'))
+
+    def test_entries_are_built_once_and_evicted_least_recently_used(self):
+        cache = PrefixCache(max_entries=2, frequent_after=0)
+        build = MagicMock(side_effect=lambda prefix: PrefixEntry([len(prefix)], None))
+
+        first = cache.get('a', build)
+        self.assertIs(cache.get('a', build), first)
+        cache.get('bb', build)
+        cache.get('a', build)
+        cache.get('ccc', build)
+        self.assertEqual(build.call_count, 3)
+        cache.get('a', build)
+        cache.get('bb', build)
+        self.assertEqual(build.call_count, 4)
+
+    def test_short_prefixes_are_skipped(self):
+        cache = PrefixCache(max_entries=2, frequent_after=0, prefixes=['short '])
+        build = MagicMock(return_value=None)
+
+        self.assertIsNone(cache.get(cache.find_prefix('short prompt'), build))
+        self.assertIsNone(cache.find_prefix('short prompt'))
+        build.assert_called_once_with('short ')
+
+    def test_skipped_prefixes_fall_back_to_shorter_ones(self):
+        cache = PrefixCache(max_entries=2, frequent_after=0, prefixes=['You are', PREAMBLE])
+        build = MagicMock(side_effect=lambda prefix: None if prefix == PREAMBLE else PrefixEntry([1], None))
+
+        self.assertIsNone(cache.get(cache.find_prefix(PREAMBLE + 'Hi'), build))
+        self.assertEqual(cache.find_prefix(PREAMBLE + 'Hi'), 'You are')
+
+    def test_disabled_cache_finds_nothing(self):
+        cache = PrefixCache(max_entries=0, frequent_after=1, prefixes=[PREAMBLE])
+        self.assertIsNone(cache.find_prefix(PREAMBLE + 'Hi'))
+
+
+class PrefixGenerationTest(SimpleTestCase):
+    """Test cases for generating from a cached prefix"""
+
+    def setUp(self):
+        self.generator = MagicMock()
+        # One token per character
+        self.generator.tokenizer.side_effect = lambda text: {'input_ids': [ord(char) for char in text]}
+        self.generator.tokenizer.pad_token_id = 0
+        self.generator.tokenizer.decode.side_effect = lambda ids, **kwargs: ''.join(map(chr, ids))
+        self.past_key_values = MagicMock()
+
+        def generate(input_ids, max_new_tokens, **kwargs):
+            return torch.cat([input_ids, torch.full((len(input_ids), max_new_tokens), ord('?'))], dim=1)
+        self.generator.model.generate.side_effect = generate
+
+        self.prefix_cache = PrefixCache(max_entries=2, frequent_after=0, prefixes=[PREAMBLE])
+        entry = PrefixEntry([ord(char) for char in PREAMBLE], self.past_key_values)
+        for patcher in (patch('forge.utils.get_generator', return_value=self.generator),
+                        patch('forge.utils.prefix_cache', self.prefix_cache),
+                        patch('forge.utils._build_prefix_entry', return_value=entry)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_prompts_sharing_a_prefix_only_run_their_suffix(self):
+        prompts = [PREAMBLE + 'Hi', 'No preamble', PREAMBLE + 'Hello']
+        with patch('forge.utils.copy.deepcopy', side_effect=lambda value: value):
+            responses = utils.generate_responses(prompts, do_sample=False)
+
+        budget = utils.GENERATION_MAX_LENGTH - len(PREAMBLE)
+        self.assertEqual(responses, [PREAMBLE + 'Hi' + '?' * (budget - 2),
+                                     'No preamble' + '?' * (utils.GENERATION_MAX_LENGTH - 11),
+                                     PREAMBLE + 'Hello' + '?' * (budget - 5)])
+        prefixed, rest = self.generator.model.generate.call_args_list
+        # The prompt without the prefix is generated from its whole text
+        self.assertEqual(rest.kwargs['input_ids'].tolist(), [[ord(char) for char in 'No preamble']])
+        self.assertNotIn('past_key_values', rest.kwargs)
+
+        kwargs = prefixed.kwargs
+        self.assertIs(kwargs['past_key_values'], self.past_key_values)
+        self.past_key_values.batch_repeat_interleave.assert_called_once_with(2)
+        # Shorter suffixes are padded between the prefix and the suffix
+        prefix_length = len(PREAMBLE)
+        self.assertEqual(kwargs['attention_mask'][0, prefix_length:].tolist(), [0, 0, 0, 1, 1])
+        self.assertEqual(kwargs['input_ids'][0, prefix_length:].tolist(), [0, 0, 0, ord('H'), ord('i')])
+        self.assertTrue(kwargs['attention_mask'][:, :prefix_length].all())
+
+    def test_cached_entry_is_not_modified(self):
+        utils.generate_responses([PREAMBLE + 'Hi'], do_sample=False)
+        passed = self.generator.model.generate.call_args.kwargs['past_key_values']
+        self.assertIsNot(passed, self.past_key_values)
+
+    def test_each_prompt_keeps_its_own_length_budget(self):
+        long_prompt = 'x' * 140
+        responses = utils.generate_responses(['Hi', long_prompt, 'y' * 200], do_sample=False)
+
+        # Padding to the longest prompt does not shorten the others
+        self.assertEqual(self.generator.model.generate.call_args.kwargs['max_new_tokens'],
+                         utils.GENERATION_MAX_LENGTH - 2)
+        self.assertEqual(responses, ['Hi' + '?' * (utils.GENERATION_MAX_LENGTH - 2),
+                                     long_prompt + '?' * (utils.GENERATION_MAX_LENGTH - 140), 'y' * 200 + '?'])
@@ -0,0 +1,222 @@
+import threading
+from datetime import timedelta
+from io import StringIO
+from unittest.mock import patch
+
+import numpy as np
+from django.contrib.auth.models import User
+from django.core.cache import caches
+from django.core.management import CommandError, call_command
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+
+from forge.models import Prompt, PromptEmbedding, PromptMetadata
+from forge.prompt_jobs import INTERRUPTED_JOB_ERROR, generate_prompt_result, process_prompt, reap_stale_jobs
+from forge.utils import _generate_batch, generation_params
+
+
+@patch('forge.prompt_jobs.send_prompt_event')
+@patch('forge.prompt_jobs.generate_embedding', return_value=np.array([0.0, 3.0, 4.0], dtype='float32'))
+class ProcessPromptTest(TestCase):
+    """Test cases for background prompt jobs"""
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='testuser', password='testpass123')
+        self.prompt = Prompt.objects.create(user=self.user, text='Tell me a story', response='',
+                                            status=Prompt.STATUS_PENDING)
+        PromptMetadata.objects.create(prompt=self.prompt, model_used='GPT-2')
+
+    @patch('forge.prompt_jobs.generate_response', return_value='Once upon a time')
+    def test_completes_prompt_and_notifies_user(self, mock_generate, mock_embedding, mock_send):
+        process_prompt(self.prompt.id)
+
+        self.prompt.refresh_from_db()
+        self.assertEqual(self.prompt.status, Prompt.STATUS_COMPLETED)
+        self.assertEqual(self.prompt.response, 'Once upon a time')
+        np.testing.assert_allclose(PromptEmbedding.objects.get(prompt=self.prompt).vector, [0.0, 0.6, 0.8], rtol=1e-6)
+        mock_send.assert_called_once_with(self.user, 'done', {
+            'prompt_id': self.prompt.id, 'status': 'completed',
+            'prompt': 'Tell me a story', 'response': 'Once upon a time',
+        })
+
+    @patch('forge.prompt_jobs.generate_response', side_effect=RuntimeError('out of memory'))
+    def test_failed_generation_marks_prompt_failed(self, mock_generate, mock_embedding, mock_send):
+        with self.assertLogs('forge.prompt_jobs', level='ERROR'):
+            process_prompt(self.prompt.id)
+
+        self.prompt.refresh_from_db()
+        self.assertEqual(self.prompt.status, Prompt.STATUS_FAILED)
+        self.assertEqual(self.prompt.error, 'out of memory')
+        self.assertFalse(PromptEmbedding.objects.exists())
+        self.assertEqual(mock_send.call_args.args[1:], (
+            'error', {'prompt_id': self.prompt.id, 'status': 'failed',
+                      'prompt': 'Tell me a story', 'error': 'out of memory'}))
+
+    @patch('forge.prompt_jobs.generate_response')
+    def test_streams_response_when_sent_via_websocket(self, mock_generate, mock_embedding, mock_send):
+        PromptMetadata.objects.filter(prompt=self.prompt).update(sent_via_websocket=True)
+
+        def stream(text, on_text, params):
+            for piece in (' Once', ' upon', ' a time'):
+                on_text(piece)
+            return text + ' Once upon a time'
+
+        with patch('forge.prompt_jobs.stream_response', side_effect=stream):
+            process_prompt(self.prompt.id)
+
+        mock_generate.assert_not_called()
+        events = [(call.args[1], call.args[2].get('text')) for call in mock_send.call_args_list]
+        self.assertEqual(events, [('chunk', ' Once'), ('chunk', ' upon'), ('chunk', ' a time'), ('done', None)])
+        self.prompt.refresh_from_db()
+        self.assertEqual(self.prompt.response, 'Tell me a story Once upon a time')
+
+    @patch('forge.prompt_jobs.generate_response')
+    def test_prompt_is_processed_once(self, mock_generate, mock_embedding, mock_send):
+        Prompt.objects.filter(id=self.prompt.id).update(status=Prompt.STATUS_RUNNING)
+        process_prompt(self.prompt.id)
+
+        mock_generate.assert_not_called()
+        mock_send.assert_not_called()
+
+
+@patch('forge.prompt_jobs.send_prompt_event')
+class ReapStaleJobsTest(TestCase):
+    """Test cases for prompts whose jobs were lost"""
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='testuser', password='testpass123')
+        self.prompts = {}
+        for status, age in ((Prompt.STATUS_PENDING, 3600), (Prompt.STATUS_RUNNING, 3600),
+                            (Prompt.STATUS_COMPLETED, 3600), (Prompt.STATUS_PENDING, 60)):
+            prompt = Prompt.objects.create(user=self.user, text=f'{status} {age}', response='', status=status)
+            Prompt.objects.filter(id=prompt.id).update(created_at=timezone.now() - timedelta(seconds=age))
+            self.prompts[status, age] = prompt
+
+    def status(self, status, age):
+        prompt = Prompt.objects.get(id=self.prompts[status, age].id)
+        return prompt.status, prompt.error
+
+    def test_fails_stale_pending_and_running_prompts(self, mock_send):
+        self.assertEqual(reap_stale_jobs(max_age=600), 2)
+
+        for key in ((Prompt.STATUS_PENDING, 3600), (Prompt.STATUS_RUNNING, 3600)):
+            self.assertEqual(self.status(*key), (Prompt.STATUS_FAILED, INTERRUPTED_JOB_ERROR))
+        self.assertEqual(self.status(Prompt.STATUS_COMPLETED, 3600), (Prompt.STATUS_COMPLETED, ''))
+        self.assertEqual(self.status(Prompt.STATUS_PENDING, 60), (Prompt.STATUS_PENDING, ''))
+        self.assertEqual(sorted(call.args[2]['prompt_id'] for call in mock_send.call_args_list), sorted(
+            self.prompts[key].id for key in ((Prompt.STATUS_PENDING, 3600), (Prompt.STATUS_RUNNING, 3600))))
+        self.assertEqual({call.args[1] for call in mock_send.call_args_list}, {'error'})
+        self.assertEqual(mock_send.call_args.args[2]['status'], 'failed')
+
+        # Already failed prompts are left alone
+        mock_send.reset_mock()
+        self.assertEqual(reap_stale_jobs(max_age=600), 0)
+        mock_send.assert_not_called()
+
+    @override_settings(PROMPT_JOB_STALE_SECONDS=30)
+    def test_command_uses_the_configured_age(self, mock_send):
+        out = StringIO()
+        call_command('reap_prompt_jobs', stdout=out)
+
+        self.assertIn('Marked 3 interrupted prompt job(s) failed.', out.getvalue())
+        self.assertEqual(self.status(Prompt.STATUS_PENDING, 60)[0], Prompt.STATUS_FAILED)
+        self.assertEqual(self.status(Prompt.STATUS_COMPLETED, 3600)[0], Prompt.STATUS_COMPLETED)
+
+    def test_command_rejects_a_negative_age(self, mock_send):
+        with self.assertRaises(CommandError):
+            call_command('reap_prompt_jobs', max_age=-1, stdout=StringIO())
+
+
+@patch('forge.prompt_jobs.generate_embedding', return_value=np.array([1.0, 0.0, 0.0], dtype='float32'))
+@patch('forge.prompt_jobs.generate_response', side_effect=lambda text, params: text + ' generated')
+class ResponseMemoTest(TestCase):
+    """Test cases for memoized deterministic responses"""
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='testuser', password='testpass123')
+        caches['responses'].clear()
+
+    def test_deterministic_responses_are_memoized(self, mock_generate, mock_embedding):
+        for params in (generation_params(deterministic=True), generation_params(seed=7)):
+            with self.subTest(params=params):
+                mock_generate.reset_mock()
+                first = generate_prompt_result('health check', self.user, params=params)
+                second = generate_prompt_result('health check', self.user, params=params)
+
+                mock_generate.assert_called_once_with('health check', params)
+                self.assertEqual(second[0], first[0])
+                self.assertEqual(first[2], {'generation': params})
+                self.assertEqual(second[2], {'generation': {**params, 'memoized': True}})
+
+    def test_memo_is_keyed_by_prompt_and_params(self, mock_generate, mock_embedding):
+        generate_prompt_result('health check', self.user, params=generation_params(seed=1))
+        generate_prompt_result('health check', self.user, params=generation_params(seed=2))
+        generate_prompt_result('health probe', self.user, params=generation_params(seed=1))
+        self.assertEqual(mock_generate.call_count, 3)
+
+    def test_sampled_responses_are_not_memoized(self, mock_generate, mock_embedding):
+        for _ in range(2):
+            _, _, extra_info = generate_prompt_result('tell me a joke', self.user)
+            self.assertIsNone(extra_info)
+        self.assertEqual(mock_generate.call_count, 2)
+
+
+class PromptStagesTest(TestCase):
+    """Test cases for the concurrent stages of generating a prompt result"""
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='testuser', password='testpass123')
+
+    def test_embedding_runs_while_the_response_is_generated(self):
+        embedding_started = threading.Event()
+        generation_started = threading.Event()
+
+        def embed(text, model_name):
+            embedding_started.set()
+            # Only returns once generation runs at the same time
+            self.assertTrue(generation_started.wait(5))
+            return np.array([1.0, 0.0, 0.0], dtype='float32')
+
+        def generate(text, params):
+            generation_started.set()
+            self.assertTrue(embedding_started.wait(5))
+            return text + ' generated'
+
+        with patch('forge.prompt_jobs.generate_embedding', side_effect=embed), \
+                patch('forge.prompt_jobs.generate_response', side_effect=generate):
+            response, vector, _ = generate_prompt_result('in parallel', self.user, embedding_model='model')
+
+        self.assertEqual(response, 'in parallel generated')
+        self.assertEqual(vector.tolist(), [1.0, 0.0, 0.0])
+
+    @patch('forge.prompt_jobs.generate_response', side_effect=RuntimeError('out of memory'))
+    @patch('forge.prompt_jobs.generate_embedding', side_effect=RuntimeError('embedding failed'))
+    def test_generation_errors_are_raised_before_embedding_errors(self, mock_embedding, mock_generate):
+        with self.assertRaisesMessage(RuntimeError, 'out of memory'):
+            generate_prompt_result('failing', self.user, embedding_model='model')
+
+
+class GenerationBatchTest(SimpleTestCase):
+    """Test cases for grouping micro-batched generation requests"""
+
+    @patch('forge.utils.generate_responses', side_effect=lambda prompts, **params: [
+        f'{prompt}|{params}' for prompt in prompts])
+    def test_requests_are_grouped_by_params(self, mock_generate):
+        greedy, seeded = generation_params(deterministic=True), generation_params(seed=3)
+        results = _generate_batch([('a', generation_params()), ('b', greedy), ('c', generation_params()),
+                                   ('d', seeded), ('e', greedy), ('f', seeded)])
+
+        self.assertEqual([result.split('|')[0] for result in results], list('abcdef'))
+        batches = sorted(call.args[0] for call in mock_generate.call_args_list)
+        # Greedy and seeded prompts run one at a time
+        self.assertEqual(batches, [['a', 'c'], ['b'], ['d'], ['e'], ['f']])
+
+    @patch('forge.utils.generate_responses', side_effect=lambda prompts, **params: [
+        f'{prompt} in a batch of {len(prompts)}' for prompt in prompts])
+    def test_deterministic_responses_do_not_depend_on_the_batch(self, mock_generate):
+        for params in (generation_params(deterministic=True), generation_params(seed=3)):
+            with self.subTest(params=params):
+                alone = _generate_batch([('hello', params)])
+                mixed = _generate_batch([('a', generation_params()), ('hello', params), ('b', params),
+                                         ('c', generation_params())])
+                self.assertEqual(mixed[1], alone[0])
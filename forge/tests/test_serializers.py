@@ -1,3 +1,4 @@
+import numpy as np
 from django.test import TestCase
 from django.contrib.auth.models import User
 from unittest.mock import MagicMock
@@ -46,6 +47,24 @@ class PromptEmbeddingSerializerTest(TestCase):
         serializer = PromptEmbeddingSerializer(data=data)
         self.assertTrue(serializer.is_valid())
 
+    def test_embedding_serializer_invalid_vector(self):
+        """Test embedding serializer rejects non-numeric vectors"""
+        data = {
+            'model_name': 'text-embedding-3-small',
+            'vector': ['a', 'b']
+        }
+        serializer = PromptEmbeddingSerializer(data=data)
+        self.assertFalse(serializer.is_valid())
+        self.assertIn('vector', serializer.errors)
+
+    def test_embedding_serializer_numpy_vector(self):
+        """Test float32 vectors are serialized as plain floats"""
+        embedding = MagicMock(model_name='all-MiniLM-L6-v2',
+                              vector=np.array([0.5, 0.25], dtype='<f4'))
+        data = PromptEmbeddingSerializer(embedding).data
+        self.assertEqual(data['vector'], [0.5, 0.25])
+        self.assertIsInstance(data['vector'][0], float)
+
 
 class PromptMetadataSerializerTest(TestCase):
     """Test cases for PromptMetadataSerializer"""
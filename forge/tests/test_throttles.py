@@ -1,6 +1,6 @@
 from django.test import TestCase
 from unittest.mock import patch, MagicMock
-from forge.throttles import CustomBurstRateThrottle, CustomSustainedRateThrottle
+from forge.throttles import CustomBurstRateThrottle, CustomSustainedRateThrottle, StatusPollRateThrottle
 
 
 class ThrottlesTest(TestCase):
@@ -18,6 +18,12 @@ class ThrottlesTest(TestCase):
         """Test sustained throttle scope"""
         self.assertEqual(self.sustained_throttle.scope, 'sustained')
 
+    def test_status_poll_throttle_rate(self):
+        """Test status polling has its own, more generous rate"""
+        throttle = StatusPollRateThrottle()
+        self.assertEqual(throttle.scope, 'status_poll')
+        self.assertEqual((throttle.num_requests, throttle.duration), (120, 60))
+
     @patch('rest_framework.throttling.UserRateThrottle.allow_request')
     def test_burst_throttle_allow_request(self, mock_allow):
         """Test burst throttle allow_request method"""
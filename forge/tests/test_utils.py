@@ -0,0 +1,166 @@
+import threading
+from unittest.mock import MagicMock, patch
+
+import torch
+from django.test import SimpleTestCase, override_settings
+from transformers.pytorch_utils import Conv1D
+
+from forge import utils
+
+
+class ModelLoadingTest(SimpleTestCase):
+    """Test cases for lazy and preloaded model loading"""
+
+    def setUp(self):
+        for patcher in (patch('forge.utils._generator', None),
+                        patch('forge.utils._embedding_models', {}),
+                        patch('forge.utils.EmbeddingModel.active_name', return_value=utils.EMBEDDING_MODEL_NAME)):
+            self.active_name = patcher.start()
+            self.addCleanup(patcher.stop)
+
+    @patch('forge.utils.SentenceTransformer')
+    @patch('forge.utils.pipeline')
+    def test_models_load_once_on_first_use(self, mock_pipeline, mock_sentence_transformer):
+        self.assertIs(utils.get_generator(), mock_pipeline.return_value)
+        self.assertIs(utils.get_embedding_model(), mock_sentence_transformer.return_value)
+        utils.load_models()
+
+        mock_pipeline.assert_called_once_with('text-generation', model=utils.GENERATION_MODEL_NAME)
+        mock_sentence_transformer.assert_called_once_with(utils.EMBEDDING_MODEL_NAME)
+        tokenizer = mock_pipeline.return_value.tokenizer
+        self.assertEqual(tokenizer.pad_token_id, tokenizer.eos_token_id)
+        self.assertEqual(tokenizer.padding_side, 'left')
+
+    @patch('forge.utils.SentenceTransformer', side_effect=lambda name: MagicMock(name=name))
+    def test_models_switched_away_from_are_unloaded(self, mock_sentence_transformer):
+        active = utils.get_embedding_model()
+        new = utils.get_embedding_model('new-model')
+        # A model being backfilled is loaded next to the active one
+        self.assertIs(utils.get_embedding_model(), active)
+        self.assertIs(utils.get_embedding_model('new-model'), new)
+        self.assertEqual(mock_sentence_transformer.call_count, 2)
+
+        self.active_name.return_value = 'new-model'
+        self.assertIs(utils.get_embedding_model(), new)
+        utils.get_embedding_model('third-model')
+        self.assertEqual(set(utils._embedding_models), {'new-model', 'third-model'})
+
+    @patch('forge.utils.load_models')
+    def test_preload_moves_weights_to_shared_memory(self, mock_load):
+        generator, embedding_model = MagicMock(), MagicMock()
+        mock_load.return_value = (generator, embedding_model)
+        utils.preload_models()
+
+        generator.model.share_memory.assert_called_once_with()
+        embedding_model.share_memory.assert_called_once_with()
+        # Preloading must not start the torch thread pool in the master
+        generator.assert_not_called()
+        embedding_model.encode.assert_not_called()
+
+    @patch('forge.utils.torch.set_num_threads')
+    @patch('forge.utils.os.cpu_count', return_value=8)
+    def test_worker_threads_share_the_cores(self, mock_cpu_count, mock_set_num_threads):
+        self.assertEqual(utils.configure_worker_threads(4), 2)
+        mock_set_num_threads.assert_called_once_with(2)
+        self.assertEqual(utils.configure_worker_threads(16), 1)
+        with override_settings(TORCH_THREADS=3):
+            self.assertEqual(utils.configure_worker_threads(4), 3)
+
+
+class SeededGenerationTest(SimpleTestCase):
+    """Test cases for isolating seeded generations from concurrent sampling"""
+
+    def setUp(self):
+        self.generator = MagicMock()
+        self.generator.tokenizer.side_effect = lambda text: {'input_ids': [ord(char) for char in text]}
+        self.generator.tokenizer.decode.side_effect = lambda ids, **kwargs: ' '.join(str(i) for i in ids.tolist())
+        self.generator.model.generate.side_effect = self.sample
+        self.before_sampling = None
+        for patcher in (patch('forge.utils.get_generator', return_value=self.generator),
+                        patch('forge.utils._prefix_groups', return_value=[])):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def sample(self, input_ids, **kwargs):
+        if self.before_sampling:
+            self.before_sampling()
+        return torch.cat([input_ids, torch.randint(1000, (len(input_ids), 1))], dim=1)
+
+    def test_seeded_generations_leave_the_random_state(self):
+        torch.manual_seed(0)
+        first = utils.generate_responses(['a'], seed=5)
+        after = torch.rand(1)
+        torch.manual_seed(0)
+
+        self.assertEqual(utils.generate_responses(['a'], seed=5), first)
+        self.assertEqual(torch.rand(1), after)
+
+    def test_unseeded_sampling_waits_for_seeded_runs(self):
+        seeded, release = threading.Event(), threading.Event()
+        unseeded = []
+
+        def block():
+            seeded.set()
+            release.wait(5)
+        self.before_sampling = block
+        thread = threading.Thread(target=utils.generate_responses, args=(['a'],), kwargs={'seed': 1})
+        thread.start()
+        self.assertTrue(seeded.wait(5))
+
+        self.before_sampling = None
+        sampler = threading.Thread(target=lambda: unseeded.extend(utils.generate_responses(['b'])))
+        sampler.start()
+        # Greedy decoding does not draw from the random state
+        self.assertEqual(len(utils.generate_responses(['c'], do_sample=False)), 1)
+        sampler.join(0.2)
+        self.assertEqual(unseeded, [])
+
+        release.set()
+        thread.join(5)
+        sampler.join(5)
+        self.assertEqual(len(unseeded), 1)
+
+
+class InferenceBackendTest(SimpleTestCase):
+    """Test cases for the quantized inference backends"""
+
+    def setUp(self):
+        torch.manual_seed(0)
+        self.module = torch.nn.Sequential(Conv1D(32, 16), torch.nn.ReLU(), torch.nn.Linear(32, 8)).eval()
+        self.inputs = torch.randn(4, 16)
+        with torch.inference_mode():
+            self.expected = self.module(self.inputs)
+
+    def test_int8_quantizes_linear_and_conv1d_layers(self):
+        utils.apply_backend(self.module, 'int8')
+
+        self.assertFalse(any(isinstance(layer, (Conv1D, torch.nn.Linear)) for layer in self.module))
+        self.assertEqual(sum(isinstance(layer, torch.ao.nn.quantized.dynamic.Linear) for layer in self.module), 2)
+        with torch.inference_mode():
+            torch.testing.assert_close(self.module(self.inputs), self.expected, atol=0.05, rtol=0.05)
+
+    def test_bf16_casts_weights(self):
+        utils.apply_backend(self.module, 'bf16')
+
+        self.assertTrue(all(parameter.dtype == torch.bfloat16 for parameter in self.module.parameters()))
+        with torch.inference_mode():
+            output = self.module(self.inputs.to(torch.bfloat16)).float()
+        torch.testing.assert_close(output, self.expected, atol=0.05, rtol=0.05)
+
+    def test_backend_selection(self):
+        with override_settings(INFERENCE_BACKEND='int8'):
+            self.assertEqual(utils.inference_backend(), 'int8')
+            self.assertEqual(utils.generation_model_label(), 'GPT-2 (int8)')
+        with override_settings(INFERENCE_BACKEND='bf16'), patch('forge.utils.bf16_supported', return_value=False):
+            self.assertEqual(utils.inference_backend(), 'fp32')
+            self.assertEqual(utils.generation_model_label(), 'GPT-2')
+        with override_settings(INFERENCE_BACKEND='fp64'), self.assertRaises(ValueError):
+            utils.inference_backend()
+
+    def test_memo_keys_depend_on_the_backend(self):
+        from forge.response_memo import response_memo
+
+        params = utils.generation_params(deterministic=True)
+        with override_settings(INFERENCE_BACKEND='int8'):
+            int8_key = response_memo.key('hello', params)
+        self.assertNotEqual(response_memo.key('hello', params), int8_key)
@@ -1,5 +1,8 @@
+import asyncio
+import json
+
 from django.test import TestCase
-from unittest.mock import patch, MagicMock
+from unittest.mock import patch, AsyncMock, MagicMock
 
 
 class WebSocketUtilsTest(TestCase):
@@ -19,3 +22,21 @@ class PromptConsumerTest(TestCase):
         scope = {'user': MagicMock()}
         consumer = PromptConsumer(scope)
         mock_init.assert_called_once_with(scope)
+
+    @patch('forge.consumer.AsyncWebsocketConsumer.__init__', return_value=None)
+    def test_generation_events_are_forwarded(self, mock_init):
+        """Test streamed chunk, done and error events reach the client tagged by name"""
+        from forge.consumer import PromptConsumer
+        consumer = PromptConsumer({'user': MagicMock()})
+        consumer.send = AsyncMock()
+
+        asyncio.run(consumer.prompt_chunk({'type': 'prompt.chunk', 'message': {'prompt_id': 1, 'text': ' Paris'}}))
+        asyncio.run(consumer.prompt_done({'type': 'prompt.done', 'message': {'prompt_id': 1, 'status': 'completed'}}))
+        asyncio.run(consumer.prompt_error({'type': 'prompt.error', 'message': {'prompt_id': 2, 'error': 'boom'}}))
+
+        sent = [json.loads(call.kwargs['text_data']) for call in consumer.send.call_args_list]
+        self.assertEqual(sent, [
+            {'event': 'chunk', 'prompt_id': 1, 'text': ' Paris'},
+            {'event': 'done', 'prompt_id': 1, 'status': 'completed'},
+            {'event': 'error', 'prompt_id': 2, 'error': 'boom'},
+        ])
@@ -15,3 +15,11 @@ class CustomSustainedRateThrottle(UserRateThrottle):
     Used to limit overall usage over time.
     """
     scope = 'sustained'
+
+
+class StatusPollRateThrottle(UserRateThrottle):
+    """
+    Allows 120 status checks per minute per user.
+    Polling a job is cheap, so it does not count against the prompt limits.
+    """
+    scope = 'status_poll'
@@ -1,8 +1,10 @@
 from django.urls import path
-from .views import PromptCreateView, SimilarPromptsView
+from .views import PromptCreateView, PromptStatusView, SimilarPromptsBatchView, SimilarPromptsView
 
 
 urlpatterns = [
     path('prompts/', PromptCreateView.as_view(), name='create-prompt'),
+    path('prompts/<int:pk>/status/', PromptStatusView.as_view(), name='prompt-status'),
     path('prompts/similar/', SimilarPromptsView.as_view(), name='similar-prompts'),
+    path('prompts/similar/batch/', SimilarPromptsBatchView.as_view(), name='similar-prompts-batch'),
 ]
@@ -1,23 +1,530 @@
-from transformers import pipeline
+import asyncio
+import copy
+import functools
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+import numpy as np
+import torch
+from django.conf import settings
+from django.db import connections
+from transformers import DynamicCache, TextStreamer, pipeline
+from transformers.pytorch_utils import Conv1D
 from sentence_transformers import SentenceTransformer
 
-# Initialize the local model (can be GPT2, MPT, BLOOM, etc.)
-generator = pipeline("text-generation", model="gpt2")
-model = SentenceTransformer('all-MiniLM-L6-v2')
+from .batching import MicroBatcher
+from .embedding_cache import EmbeddingCache
+from .inference import InferenceClient
+from .metrics import PREFIX_CACHE_REUSED_TOKENS
+from .models import EmbeddingModel
+from .prefix_cache import PrefixCache, PrefixEntry, load_prefixes
+
+logger = logging.getLogger(__name__)
+
+# Embedding model used until another one is activated. The name of the
+# active model is recorded on PromptEmbedding rows and part of every
+# embedding cache key
+EMBEDDING_MODEL_NAME = settings.EMBEDDING_MODEL
+
+# Text generation model, part of every memoized response key
+GENERATION_MODEL_NAME = 'gpt2'
+GENERATION_MAX_LENGTH = 150
+# Name recorded in PromptMetadata.model_used, with the backend unless it is fp32
+GENERATION_MODEL_LABEL = 'GPT-2'
+
+# Numeric backends the models can run with on CPU
+INFERENCE_BACKENDS = ('fp32', 'int8', 'bf16')
+
+embedding_cache = EmbeddingCache()
+
+# Attention keys and values of shared prompt preambles
+prefix_cache = PrefixCache(prefixes=load_prefixes(settings.GENERATION_PREFIXES_PATH))
+
+# Model calls run concurrently with the work of the calling thread
+inference_executor = ThreadPoolExecutor(max_workers=settings.INFERENCE_EXECUTOR_WORKERS,
+                                        thread_name_prefix='inference')
+
+# Model calls go to the inference server when one is configured
+inference_client = (InferenceClient(settings.INFERENCE_SERVER_SOCKET, settings.INFERENCE_SERVER_TIMEOUT)
+                    if settings.INFERENCE_SERVER_SOCKET else None)
+
+# Generator and embedding models by name, loaded on first use or preloaded
+# before forking
+_generator = None
+_embedding_models = {}
+_models_lock = threading.Lock()
+
+
+@functools.cache
+def bf16_supported():
+    """Returns whether this CPU runs bfloat16 matrix multiplications natively."""
+    try:
+        return bool(torch.ops.mkldnn._is_mkldnn_bf16_supported())
+    except (AttributeError, RuntimeError):
+        return False
+
+
+def inference_backend():
+    """
+    Returns the backend the models run with: ``INFERENCE_BACKEND``, or fp32
+    when bf16 is selected on a CPU without native bfloat16 support.
+    """
+    backend = settings.INFERENCE_BACKEND
+    if backend not in INFERENCE_BACKENDS:
+        raise ValueError(f"Unknown inference backend '{backend}'")
+    if backend == 'bf16' and not bf16_supported():
+        return 'fp32'
+    return backend
+
+
+def generation_model_label(backend=None):
+    """Returns the ``PromptMetadata.model_used`` of responses generated with ``backend``."""
+    backend = backend or inference_backend()
+    return GENERATION_MODEL_LABEL if backend == 'fp32' else f'{GENERATION_MODEL_LABEL} ({backend})'
+
+
+def apply_backend(module, backend):
+    """
+    Converts the torch ``module`` in place to run with ``backend``: int8
+    replaces its linear layers with dynamically quantized ones, which keep
+    int8 weights and quantize activations on the fly; bf16 casts its weights.
+    """
+    if backend == 'int8':
+        _conv1d_to_linear(module)
+        torch.ao.quantization.quantize_dynamic(module, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+    elif backend == 'bf16':
+        module.to(torch.bfloat16)
+    return module
+
+
+def _conv1d_to_linear(module):
+    # GPT-2 implements its projections as Conv1D, a linear layer with a
+    # transposed weight, which dynamic quantization does not cover
+    for name, child in module.named_children():
+        if isinstance(child, Conv1D):
+            linear = torch.nn.Linear(*child.weight.shape, bias=child.bias is not None, device='meta')
+            linear.weight = torch.nn.Parameter(child.weight.detach().t().contiguous(), requires_grad=False)
+            if child.bias is not None:
+                linear.bias = torch.nn.Parameter(child.bias.detach(), requires_grad=False)
+            setattr(module, name, linear)
+        else:
+            _conv1d_to_linear(child)
+
+
+def load_generator(backend):
+    """Loads a new text generation pipeline running with ``backend``."""
+    # Initialize the local model (can be GPT2, MPT, BLOOM, etc.)
+    generator = pipeline("text-generation", model=GENERATION_MODEL_NAME)
+    # GPT-2 has no padding token; batched prompts are padded on the left with
+    # end-of-text so generation continues right after each prompt
+    generator.tokenizer.pad_token_id = generator.tokenizer.eos_token_id
+    generator.tokenizer.padding_side = 'left'
+    apply_backend(generator.model, backend)
+    return generator
+
+
+def load_embedding_model(name, backend):
+    """Loads a new sentence embedding model ``name`` running with ``backend``."""
+    return apply_backend(SentenceTransformer(name), backend)
+
+
+def load_backend_models(backend, embedding_model_name=None):
+    """
+    Loads a new ``(generator, embedding_model)`` pair running with
+    ``backend``, with the active embedding model unless another one is named.
+    """
+    embedding_model_name = embedding_model_name or EmbeddingModel.active_name()
+    return load_generator(backend), load_embedding_model(embedding_model_name, backend)
+
+
+def load_models():
+    """
+    Returns the ``(generator, embedding_model)`` of this process, loading
+    them with the ``inference_backend`` on first use. Processes forked after
+    ``preload_models`` share the models of their parent.
+    """
+    return get_generator(), get_embedding_model()
+
+
+def get_generator():
+    """Returns the text generation pipeline, loading it on first use."""
+    global _generator
+    if _generator is None:
+        with _models_lock:
+            if _generator is None:
+                backend = inference_backend()
+                if backend != settings.INFERENCE_BACKEND:
+                    logger.warning('This CPU does not support %s natively; running the models with %s',
+                                   settings.INFERENCE_BACKEND, backend)
+                _generator = load_generator(backend)
+    return _generator
+
+
+def get_embedding_model(name=None):
+    """
+    Returns the sentence embedding model ``name`` (default: the active
+    model), loading it on first use. Loading a model unloads the models
+    that are neither requested nor active anymore, e.g. the model switched
+    away from by a re-embedding.
+    """
+    name = name or EmbeddingModel.active_name()
+    model = _embedding_models.get(name)
+    if model is None:
+        with _models_lock:
+            model = _embedding_models.get(name)
+            if model is None:
+                model = load_embedding_model(name, inference_backend())
+                keep = {name, EmbeddingModel.active_name()}
+                for other in [other for other in _embedding_models if other not in keep]:
+                    del _embedding_models[other]
+                _embedding_models[name] = model
+    return model
+
+
+def preload_models():
+    """
+    Loads the models in a server's master process before workers are forked.
+    Weights are moved to shared memory, so every worker maps the same pages
+    instead of loading its own copy, and pages never become private even
+    if a worker touches them. Nothing is run through the models here: the
+    torch thread pool must only start in the workers. With an inference
+    server the workers hold no models, and nothing is loaded.
+    """
+    if inference_client is not None:
+        return
+    generator, embedding_model = load_models()
+    generator.model.share_memory()
+    embedding_model.share_memory()
+    # Reading the active embedding model opened a database connection,
+    # which forked workers must not share
+    connections.close_all()
+
+
+def configure_worker_threads(workers):
+    """
+    Sets the torch intra-op threads of a forked worker process to
+    ``TORCH_THREADS``, or by default to an equal share of the CPU cores among
+    ``workers`` processes, so workers do not oversubscribe the cores.
+    """
+    threads = settings.TORCH_THREADS or max(1, (os.cpu_count() or 1) // max(1, workers))
+    torch.set_num_threads(threads)
+    return threads
 
 
-def generate_response(prompt: str) -> str:
+class _SamplingLock:
     """
-    Generates a text completion based on the given prompt using a local model.
+    Lets unseeded generations sample concurrently while a seeded one samples
+    alone: all of them draw from the random state shared by the process, so
+    a concurrent draw would shift the seeded sequence. Seeded runs waiting
+    for the lock hold back new unseeded ones, which would starve them.
     """
-    result = generator(prompt, max_length=150, do_sample=True)
-    return result[0]['generated_text']
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._sampling = 0
+        self._seeded = False
+        self._waiting = 0
+
+    @contextmanager
+    def shared(self):
+        with self._condition:
+            self._condition.wait_for(lambda: not self._seeded and not self._waiting)
+            self._sampling += 1
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._sampling -= 1
+                self._condition.notify_all()
+
+    @contextmanager
+    def exclusive(self):
+        with self._condition:
+            self._waiting += 1
+            self._condition.wait_for(lambda: not self._seeded and not self._sampling)
+            self._waiting -= 1
+            self._seeded = True
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._seeded = False
+                self._condition.notify_all()
+
+
+_sampling_lock = _SamplingLock()
+
+
+@contextmanager
+def _sampling(do_sample, seed):
+    """
+    Holds the sampling lock for a generation. A seeded one samples from a
+    fork of the random state, which is restored afterwards so later
+    unseeded generations do not continue the seeded sequence.
+    """
+    if seed is not None:
+        with _sampling_lock.exclusive(), torch.random.fork_rng():
+            torch.manual_seed(seed)
+            yield
+    elif do_sample:
+        with _sampling_lock.shared():
+            yield
+    else:
+        yield
+
+
+def generation_params(deterministic=False, seed=None) -> dict:
+    """
+    Returns the sampling parameters of a generation request: random
+    sampling by default, greedy decoding when ``deterministic`` is set, or
+    sampling from a fixed ``seed``. The latter two are reproducible.
+    """
+    if seed is not None:
+        return {'do_sample': True, 'seed': seed}
+    if deterministic:
+        return {'do_sample': False}
+    return {'do_sample': True}
+
+
+def is_deterministic(params: dict) -> bool:
+    """Returns whether generating with ``params`` always gives the same response."""
+    return not params['do_sample'] or params.get('seed') is not None
+
+
+def generate_responses(prompts: list[str], do_sample=True, seed=None, **kwargs) -> list[str]:
+    """
+    Generates text completions for several prompts in one batched forward
+    pass. Each prompt gets the length budget it has on its own. Prompts
+    starting with a cached prefix are generated from its attention cache,
+    batched with the prompts sharing that prefix.
+    """
+    with _sampling(do_sample, seed):
+        generator = get_generator()
+        responses = [None] * len(prompts)
+        for entry, group in _prefix_groups(generator.tokenizer, prompts):
+            texts = _generate_padded(generator, [(prompts[i], input_ids) for i, input_ids in group], entry,
+                                     do_sample=do_sample, **kwargs)
+            for (i, _), text in zip(group, texts):
+                responses[i] = text
+
+        rest = [i for i, response in enumerate(responses) if response is None]
+        if rest:
+            texts = _generate_padded(generator, [(prompts[i], generator.tokenizer(prompts[i])['input_ids'])
+                                                 for i in rest], do_sample=do_sample, **kwargs)
+            for i, text in zip(rest, texts):
+                responses[i] = text
+    return responses
+
+
+def _build_prefix_entry(prefix):
+    """Runs ``prefix`` through the generation model and returns its ``PrefixEntry``."""
+    generator = get_generator()
+    input_ids = generator.tokenizer(prefix)['input_ids']
+    if len(input_ids) < settings.GENERATION_PREFIX_MIN_TOKENS:
+        return None
+    with torch.inference_mode():
+        output = generator.model(torch.tensor([input_ids]), past_key_values=DynamicCache(), use_cache=True)
+    return PrefixEntry(input_ids, output.past_key_values)
+
+
+def _prefix_groups(tokenizer, prompts):
+    """
+    Returns ``(entry, [(index, input_ids)])`` for each cached prefix that
+    some of ``prompts`` start with, listing the indexes and tokens of those
+    prompts.
+    """
+    groups = {}
+    for i, prompt in enumerate(prompts):
+        prefix = prefix_cache.find_prefix(prompt)
+        entry = prefix and prefix_cache.get(prefix, _build_prefix_entry)
+        if not entry:
+            continue
+        input_ids = tokenizer(prompt)['input_ids']
+        length = len(entry.input_ids)
+        # A token may span the end of the prefix, which the cache then does not match
+        if input_ids[:length] == entry.input_ids and length < len(input_ids) < GENERATION_MAX_LENGTH:
+            groups.setdefault(prefix, (entry, []))[1].append((i, input_ids))
+    return list(groups.values())
+
+
+def _generate_padded(generator, prompts, entry=None, do_sample=True, **kwargs):
+    """
+    Generates completions of ``(prompt, input_ids)`` pairs in one batch. With
+    the ``entry`` of a prefix they all start with, only the tokens after the
+    prefix are run through the model. Tokens are padded on the left, between
+    the prefix and the rest of each prompt; positions follow the attention
+    mask, so padding does not shift them.
+
+    Padding would count against a shared ``max_length``, so each prompt gets
+    its own budget of new tokens instead: the batch runs for the largest, and
+    each completion is cut to its own.
+    """
+    tokenizer = generator.tokenizer
+    prefix_ids, pad = (entry.input_ids if entry else []), tokenizer.pad_token_id
+    suffixes = [input_ids[len(prefix_ids):] for _, input_ids in prompts]
+    width = max(len(suffix) for suffix in suffixes)
+    input_ids = torch.tensor([prefix_ids + [pad] * (width - len(suffix)) + suffix for suffix in suffixes])
+    attention_mask = torch.tensor([[1] * len(prefix_ids) + [0] * (width - len(suffix)) + [1] * len(suffix)
+                                   for suffix in suffixes])
+    # As with max_length, a prompt at the limit still gets one new token
+    budgets = [max(1, GENERATION_MAX_LENGTH - len(ids)) for _, ids in prompts]
+    if entry:
+        # Generation appends to the cache it is given
+        past_key_values = copy.deepcopy(entry.past_key_values)
+        if len(suffixes) > 1:
+            past_key_values.batch_repeat_interleave(len(suffixes))
+        kwargs['past_key_values'] = past_key_values
+
+    with torch.inference_mode():
+        # The pipeline's generation defaults apply, as to prompts generated through it
+        output = generator.model.generate(
+            input_ids=input_ids, attention_mask=attention_mask, generation_config=generator.generation_config,
+            max_new_tokens=max(budgets), do_sample=do_sample, pad_token_id=pad, **kwargs)
+    if entry:
+        PREFIX_CACHE_REUSED_TOKENS.inc(len(prefix_ids) * len(suffixes))
+    start = input_ids.shape[1]
+    return [prompt + tokenizer.decode(row[start:start + budget], skip_special_tokens=True)
+            for (prompt, _), row, budget in zip(prompts, output, budgets)]
+
+
+def _generate_batch(requests: list[tuple[str, dict]]) -> list[str]:
+    """
+    Runs a micro-batch of ``(prompt, params)`` requests. Randomly sampled
+    prompts sharing sampling parameters are generated together. Greedy and
+    seeded prompts are generated one at a time: batched, their numerics
+    would depend on the other prompts, and their responses are memoized as
+    the response to the prompt.
+    """
+    groups = {}
+    for i, (_, params) in enumerate(requests):
+        key = (i,) if is_deterministic(params) else tuple(sorted(params.items()))
+        groups.setdefault(key, []).append(i)
+
+    results = [None] * len(requests)
+    for indexes in groups.values():
+        prompts = [requests[i][0] for i in indexes]
+        for i, text in zip(indexes, generate_responses(prompts, **requests[indexes[0]][1])):
+            results[i] = text
+    return results
+
+
+# Prompts generated concurrently are batched together
+response_batcher = MicroBatcher(
+    _generate_batch,
+    max_batch_size=settings.GENERATION_BATCH_MAX_SIZE,
+    max_wait_ms=settings.GENERATION_BATCH_MAX_WAIT_MS,
+    name='generation',
+)
+
+
+class _CallbackStreamer(TextStreamer):
+    """Passes each piece of decoded text to ``callback`` as soon as it is final."""
+
+    def __init__(self, tokenizer, callback):
+        super().__init__(tokenizer, skip_prompt=True)
+        self.callback = callback
+
+    def on_finalized_text(self, text, stream_end=False):
+        if text:
+            self.callback(text)
+
+
+def stream_local(prompt: str, on_text, params: dict) -> str:
+    """Generates and streams a completion with the model of this process."""
+    return generate_responses([prompt], **params, streamer=_CallbackStreamer(get_generator().tokenizer, on_text))[0]
+
+
+def generate_local(prompt: str, params: dict) -> str:
+    """Generates a completion with the model of this process, batched with concurrent prompts."""
+    return response_batcher((prompt, params))
+
+
+def encode_texts(texts: list[str], batch_size=32, model_name=None) -> np.ndarray:
+    """
+    Encodes texts with the embedding model ``model_name`` (default: the
+    active model) of this process into a float32 matrix, running
+    ``batch_size`` texts per forward pass.
+    """
+    embedding_model = get_embedding_model(model_name)
+    if not texts:
+        return np.empty((0, embedding_model.get_sentence_embedding_dimension()), dtype='float32')
+    return embedding_model.encode(texts, batch_size=batch_size).astype('float32', copy=False)
+
+
+def stream_response(prompt: str, on_text, params=None) -> str:
+    """
+    Generates a text completion like ``generate_response``, calling
+    ``on_text`` with each newly generated piece of text as it is decoded.
+    Streamed prompts are generated on their own rather than batched.
+    Returns the full generated text.
+    """
+    params = params or generation_params()
+    if inference_client is not None:
+        return inference_client.stream(prompt, on_text, params)
+    return stream_local(prompt, on_text, params)
+
+
+def generate_response(prompt: str, params=None) -> str:
+    """
+    Generates a text completion based on the given prompt using a local model,
+    with the sampling ``params`` of ``generation_params`` (default: random
+    sampling). Prompts submitted concurrently are run through the model as
+    one batch, by the inference server if one is configured.
+    """
+    params = params or generation_params()
+    if inference_client is not None:
+        return inference_client.generate(prompt, params)
+    return generate_local(prompt, params)
+
+
+def generate_embedding(text: str, model_name=None) -> np.ndarray:
+    """
+    Generates an embedding vector for the given text with the embedding
+    model ``model_name`` (default: the active model).
+    Returns a float32 NumPy array, stored as-is by PromptEmbedding.vector.
+    Cached vectors are returned without running the model.
+    """
+    return generate_embeddings([text], model_name)[0]
+
+
+def generate_embeddings(texts: list[str], model_name=None) -> np.ndarray:
+    """
+    Generates embedding vectors for several texts in batched forward passes,
+    with the embedding model ``model_name`` (default: the active model).
+    Returns a float32 matrix with one row per text. Only texts missing from
+    the embedding cache are encoded, by the inference server if one is
+    configured.
+    """
+    model_name = model_name or EmbeddingModel.active_name()
+    backend = inference_backend()
+    vectors = embedding_cache.get_many(model_name, backend, texts)
+    missing = [i for i, vector in enumerate(vectors) if vector is None]
+    if missing:
+        # Encode each distinct text once
+        missing_texts = list(dict.fromkeys(texts[i] for i in missing))
+        encoded = _encode(missing_texts, model_name)
+        embedding_cache.set_many(model_name, backend, missing_texts, encoded)
+        by_text = dict(zip(missing_texts, encoded))
+        for i in missing:
+            vectors[i] = by_text[texts[i]]
+    if not vectors:
+        return _encode([], model_name)
+    return np.vstack(vectors)
+
+
+def _encode(texts, model_name):
+    if inference_client is not None:
+        return inference_client.embed(texts, model_name)
+    return encode_texts(texts, model_name=model_name)
 
 
-def generate_embedding(text: str) -> list[float]:
+async def run_inference(function, *args):
     """
-    Generates an embedding vector for the given text.
-    Returns a list of floats compatible with ArrayField.
+    Runs the model call ``function(*args)`` on the inference executor and
+    returns its result, so async views wait for the model without blocking
+    the event loop or the thread their database access runs on.
     """
-    embedding = model.encode(text)
-    return embedding.tolist()  # Compatible with ArrayField
+    return await asyncio.get_running_loop().run_in_executor(inference_executor, function, *args)
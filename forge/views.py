@@ -1,144 +1,490 @@
-import os
-import faiss
-import numpy as np
+import asyncio
+from datetime import datetime, time
+
+from asgiref.sync import sync_to_async
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+from django.conf import settings
+from django.db import transaction
+from django.urls import reverse
+from rest_framework.exceptions import ValidationError
 from rest_framework.views import APIView
 from rest_framework import status, generics
 from rest_framework.response import Response
 from rest_framework.permissions import IsAuthenticated
 
-from prompt_forge import settings
-from forge.utils import generate_embedding, generate_response
-from forge.websocket_utils import send_to_websocket
-from .models import Prompt, PromptEmbedding, PromptMetadata
-from .serializers import PromptSerializer, SignUpSerializer
-from .throttles import CustomBurstRateThrottle, CustomSustainedRateThrottle
+from forge.faiss_index import cosine_distance, prompt_index
+from forge.fields import normalize_rows, to_vector
+from forge.hybrid_search import candidate_limit, hybrid_search
+from forge.metrics import PROMPT_STAGE_SECONDS
+from forge.prompt_jobs import JobQueueFull, acomplete_prompt, agenerate_prompt_result, submit as submit_prompt_job
+from forge.search_cache import normalize_query, similar_results
+from forge.utils import (
+    generate_embedding, generate_embeddings, generation_model_label, generation_params, run_inference,
+)
+from .models import EmbeddingModel, Prompt, PromptEmbedding, PromptMetadata
+from .serializers import PromptSerializer, SignUpSerializer, SimilarPromptSerializer
+from .throttles import CustomBurstRateThrottle, CustomSustainedRateThrottle, StatusPollRateThrottle
+
+
+def parse_positive_int(value):
+    """
+    Parses an optional positive integer query parameter.
+    Returns None when the parameter is missing and raises ValueError when invalid.
+    """
+    if value in (None, ''):
+        return None
+    number = int(value)
+    if number < 1:
+        raise ValueError(value)
+    return number
+
+
+def parse_non_negative_int(value):
+    """
+    Parses an optional non-negative integer query parameter.
+    Returns None when the parameter is missing and raises ValueError when invalid.
+    """
+    if value in (None, ''):
+        return None
+    number = int(value)
+    if number < 0:
+        raise ValueError(value)
+    return number
+
+
+def parse_flag(value):
+    """Returns whether an optional boolean query parameter is set."""
+    return str(value or '').lower() in ('1', 'true', 'yes')
+
+
+def parse_timestamp(value, param):
+    """
+    Parses an ISO 8601 date or datetime into an aware datetime.
+    Raises ValueError carrying the parameter name when invalid.
+    """
+    try:
+        parsed = parse_datetime(value)
+        if parsed is None:
+            day = parse_date(value)
+            parsed = datetime.combine(day, time.min) if day else None
+    except ValueError:
+        parsed = None
+    if parsed is None:
+        raise ValueError(param)
+    if timezone.is_naive(parsed):
+        parsed = timezone.make_aware(parsed)
+    return parsed
+
+
+def parse_search_filters(params, user):
+    """
+    Translates the optional 'mine', 'created_after', 'created_before' and
+    'model' query parameters into PromptEmbedding lookups.
+    Raises ValueError for malformed values.
+    """
+    filters = {}
+    if parse_flag(params.get('mine')):
+        filters['prompt__user'] = user.id
+    for param, lookup in (('created_after', 'prompt__created_at__gte'),
+                          ('created_before', 'prompt__created_at__lt')):
+        value = params.get(param)
+        if value:
+            filters[lookup] = parse_timestamp(str(value), param)
+    if params.get('model'):
+        filters['model_name'] = str(params['model'])
+    return filters
+
 
-# Path to the FAISS index file stored on disk
-INDEX_PATH = os.path.join(settings.BASE_DIR, 'faiss_prompt_index.faiss')
+def fetch_ranked_prompts(ranked, include_vector=False):
+    """
+    Fetches the prompts of ``ranked``, a list of ``(prompt_id, distance)``
+    pairs, in that order and with ``distance`` set on each prompt. Metadata
+    and embeddings by the active model are joined into the same query; the
+    embedding vector is only loaded when ``include_vector`` is set.
+    """
+    prompts = Prompt.objects.select_related('metadata').with_embedding(include_vector)
+    found = prompts.in_bulk([prompt_id for prompt_id, _ in ranked])
+    ordered = []
+    for prompt_id, distance in ranked:
+        if prompt_id in found:
+            prompt = found[prompt_id]
+            prompt.distance = distance
+            ordered.append(prompt)
+    return ordered
+
+
+def embed_query(query, model_name):
+    """Returns the embedding of the search ``query`` by ``model_name``, unit length like the stored vectors."""
+    return to_vector(generate_embedding(query, model_name), normalize=True)
+
+
+class QueryEmbeddingNeeded(Exception):
+    """Raised by a search that has to embed its query by ``model_name`` first."""
+
+    def __init__(self, model_name):
+        super().__init__(model_name)
+        self.model_name = model_name
+
+
+class AsyncAPIView(APIView):
+    """
+    APIView whose handlers are coroutines, for views waiting on the models.
+    Authentication, permissions and throttling run through sync_to_async
+    like any other database access, then the handler is awaited: while a
+    handler waits for the inference executor, the worker's event loop serves
+    other requests.
+    """
+
+    async def dispatch(self, request, *args, **kwargs):
+        # APIView.dispatch, awaiting the checks and the handler
+        self.args = args
+        self.kwargs = kwargs
+        request = self.initialize_request(request, *args, **kwargs)
+        self.request = request
+        self.headers = self.default_response_headers
+
+        try:
+            await sync_to_async(self.initial)(request, *args, **kwargs)
+
+            if request.method.lower() in self.http_method_names:
+                handler = getattr(self, request.method.lower(), self.http_method_not_allowed)
+            else:
+                handler = self.http_method_not_allowed
+
+            response = handler(request, *args, **kwargs)
+            if asyncio.iscoroutine(response):
+                response = await response
 
+        except Exception as exc:
+            response = self.handle_exception(exc)
 
-class PromptCreateView(APIView):
+        self.response = self.finalize_response(request, response, *args, **kwargs)
+        return self.response
+
+
+class PromptCreateView(AsyncAPIView):
     """
     Handles prompt creation requests.
     - Authenticated users only.
     - Applies custom burst and sustained throttling.
-    - Optionally sends response through WebSocket if 'send_via_websocket=True'.
+    - Optionally streams the response through WebSocket while it is generated
+      if 'send_via_websocket=True'.
+    - With 'use_cache' (default: RESPONSE_CACHE_ENABLED) the response of a
+      near-duplicate stored prompt is reused instead of generating one.
+    - With 'deterministic=True' the response is decoded greedily, and with
+      'seed' sampled from that seed; such responses are memoized, so repeated
+      prompts skip the model.
+    - With 'async=True' the prompt is stored pending and 202 Accepted returned
+      at once; a background job generates the response and pushes it to the
+      user's WebSocket group, and its progress is served by PromptStatusView.
+    - The view is async: the embedding and the response are computed on the
+      inference executor, so a slow generation does not hold up the other
+      requests of the worker.
     """
     permission_classes = [IsAuthenticated]
     throttle_classes = [CustomBurstRateThrottle, CustomSustainedRateThrottle]
 
-    def post(self, request):
+    async def post(self, request):
         text = request.data.get('prompt')
         send_ws = request.data.get('send_via_websocket', False)
+        use_cache = parse_flag(request.data.get('use_cache', settings.RESPONSE_CACHE_ENABLED))
 
         if not text:
             return Response({'error': 'prompt is required'}, status=status.HTTP_400_BAD_REQUEST)
 
-        # Generate model response (e.g. from OpenAI or internal LLM)
-        response_text = generate_response(text)
-
-        # Create Prompt instance
-        prompt = Prompt.objects.create(
-            user=request.user,
-            text=text,
-            response=response_text
-        )
-
-        # Generate embedding (vector)
-        embedding_vector = generate_embedding(text)
-
-        # Create embedding record
-        PromptEmbedding.objects.create(
-            prompt=prompt,
-            vector=embedding_vector,
-            model_name="all-MiniLM-L6-v2"
-        )
-
-        # Create metadata
-        PromptMetadata.objects.create(
-            prompt=prompt,
-            sent_via_websocket=send_ws,
-            model_used="GPT-2"
-        )
-
-        # Optionally send via WebSocket
+        try:
+            seed = parse_non_negative_int(request.data.get('seed'))
+            if seed is not None and seed >= 2 ** 32:
+                raise ValueError(seed)
+        except (TypeError, ValueError):
+            return Response({'error': '"seed" must be an integer between 0 and 2**32 - 1'},
+                            status=status.HTTP_400_BAD_REQUEST)
+        params = generation_params(parse_flag(request.data.get('deterministic')), seed)
+
+        if parse_flag(request.data.get('async')):
+            return await sync_to_async(self.post_async)(request, text, send_ws, use_cache, params)
+
         if send_ws:
-            send_to_websocket(request.user, {
-                'prompt': text,
-                'response': response_text,
-                'embedding_length': len(embedding_vector)
-            })
+            # Stream the response to the user's WebSocket group while it is generated
+            prompt = await sync_to_async(self.create_prompt)(request.user, text, send_ws, Prompt.STATUS_RUNNING)
+            await acomplete_prompt(prompt, use_cache, stream=True, params=params)
+            data = await sync_to_async(self.serialize_prompt)(prompt.id)
+            return Response(data, status=status.HTTP_201_CREATED)
+
+        embedding_model = await sync_to_async(EmbeddingModel.active_name)()
+        response_text, embedding_vector, extra_info = await agenerate_prompt_result(
+            text, request.user, use_cache, params=params, embedding_model=embedding_model)
 
-        serializer = PromptSerializer(prompt)
-        return Response(serializer.data, status=status.HTTP_201_CREATED)
+        data = await sync_to_async(self.store_prompt)(
+            request.user, text, send_ws, response_text, embedding_vector, embedding_model, extra_info)
+        return Response(data, status=status.HTTP_201_CREATED)
 
+    def store_prompt(self, user, text, send_ws, response_text, embedding_vector, embedding_model, extra_info):
+        # The prompt, its embedding and metadata are stored together
+        with PROMPT_STAGE_SECONDS.labels(stage='store').time(), transaction.atomic():
+            prompt = Prompt.objects.create(
+                user=user,
+                text=text,
+                response=response_text
+            )
+            PromptEmbedding.objects.create(
+                prompt=prompt,
+                vector=embedding_vector,
+                model_name=embedding_model
+            )
+            PromptMetadata.objects.create(
+                prompt=prompt,
+                sent_via_websocket=send_ws,
+                model_used=generation_model_label(),
+                extra_info=extra_info
+            )
+        return PromptSerializer(prompt).data
 
-class SimilarPromptsView(APIView):
+    def serialize_prompt(self, prompt_id):
+        prompt = Prompt.objects.select_related('metadata').with_embedding().get(id=prompt_id)
+        return PromptSerializer(prompt).data
+
+    def post_async(self, request, text, send_ws, use_cache, params):
+        prompt = self.create_prompt(request.user, text, send_ws, Prompt.STATUS_PENDING)
+        try:
+            submit_prompt_job(prompt, use_cache, params)
+        except JobQueueFull:
+            prompt.delete()
+            return Response({'error': 'too many prompts are being processed, retry later'},
+                            status=status.HTTP_503_SERVICE_UNAVAILABLE, headers={'Retry-After': '5'})
+
+        status_url = reverse('prompt-status', kwargs={'pk': prompt.id})
+        return Response({'id': prompt.id, 'status': prompt.status, 'status_url': status_url},
+                        status=status.HTTP_202_ACCEPTED, headers={'Location': status_url})
+
+    def create_prompt(self, user, text, send_ws, prompt_status):
+        # Store the prompt without a response; complete_prompt fills in the
+        # response and embedding
+        with transaction.atomic():
+            prompt = Prompt.objects.create(
+                user=user,
+                text=text,
+                response='',
+                status=prompt_status
+            )
+            PromptMetadata.objects.create(
+                prompt=prompt,
+                sent_via_websocket=send_ws,
+                model_used=generation_model_label()
+            )
+        return prompt
+
+
+class PromptStatusView(APIView):
+    """
+    Reports the progress of a prompt submitted asynchronously, with the
+    prompt itself once its response has been generated.
+    - Users only see their own prompts.
+    """
+    permission_classes = [IsAuthenticated]
+    throttle_classes = [StatusPollRateThrottle]
+
+    def get(self, request, pk):
+        prompt = (Prompt.objects.select_related('metadata').with_embedding()
+                  .filter(pk=pk, user=request.user).first())
+        if prompt is None:
+            return Response({'error': 'prompt not found'}, status=status.HTTP_404_NOT_FOUND)
+
+        data = {'id': prompt.id, 'status': prompt.status}
+        if prompt.status == Prompt.STATUS_COMPLETED:
+            data['prompt'] = PromptSerializer(prompt).data
+        elif prompt.status == Prompt.STATUS_FAILED:
+            data['error'] = prompt.error
+        return Response(data)
+
+
+class SimilaritySearchMixin:
     """
-    Returns prompts similar to the query using FAISS vector similarity.
-    Index is persisted on disk to avoid rebuilding every request.
+    Parameter handling shared by the similarity search views.
+    - Optional 'nprobe' (IVF) and 'ef_search' (HNSW) tune recall vs latency.
+    - Optional 'mine', 'created_after', 'created_before' and 'model' filters
+      are applied inside the index search rather than to its results.
+    - Optional 'k', 'offset' and 'max_distance' select the page of results;
+      'include_vector' adds the raw embedding vector to each result.
     """
     permission_classes = [IsAuthenticated]
     throttle_classes = [CustomBurstRateThrottle, CustomSustainedRateThrottle]
+    default_k = 5
 
-    def get_faiss_index(self):
+    def get_result_options(self, params):
         """
-        Loads FAISS index from disk if it exists, otherwise rebuilds it.
-        Returns the index and a list of prompt IDs corresponding to each vector.
+        Returns ``(k, offset, max_distance, include_vector)`` described by
+        ``params``. Raises ValidationError when a parameter is malformed.
         """
-        embeddings_qs = PromptEmbedding.objects.select_related('prompt').all()
-        if not embeddings_qs.exists():
-            return None, []
-
-        ids = []
-        vectors = []
-
-        for emb in embeddings_qs:
-            vectors.append(np.array(emb.vector, dtype='float32'))
-            ids.append(emb.prompt.id)
-
-        vectors = np.stack(vectors)
-        dim = vectors.shape[1]
-
-        # Load existing index from disk if available
-        if os.path.exists(INDEX_PATH):
-            index = faiss.read_index(INDEX_PATH)
-            # If the index size does not match the current number of embeddings, rebuild it
-            if index.ntotal != len(vectors):
-                index = faiss.IndexFlatL2(dim)
-                index.add(vectors)
-                faiss.write_index(index, INDEX_PATH)
+        try:
+            k = parse_positive_int(params.get('k')) or self.default_k
+            offset = parse_non_negative_int(params.get('offset')) or 0
+        except (TypeError, ValueError):
+            raise ValidationError({'error': '"k" must be a positive and "offset" a non-negative integer'})
+        if offset + k > settings.SIMILAR_MAX_RESULTS:
+            raise ValidationError({'error': f'"offset" + "k" must not exceed {settings.SIMILAR_MAX_RESULTS}'})
+
+        max_distance = params.get('max_distance')
+        if max_distance in (None, ''):
+            max_distance = None
         else:
-            # Create and persist the index for the first time
-            index = faiss.IndexFlatL2(dim)
-            index.add(vectors)
-            faiss.write_index(index, INDEX_PATH)
+            try:
+                max_distance = float(max_distance)
+                if not 0 <= max_distance <= 2:
+                    raise ValueError(max_distance)
+            except (TypeError, ValueError):
+                raise ValidationError({'error': '"max_distance" must be a cosine distance between 0 and 2'})
+
+        return k, offset, max_distance, parse_flag(params.get('include_vector'))
+
+    def get_search_options(self, params):
+        """
+        Returns the keyword arguments for ``prompt_index.search`` described by
+        ``params``. Raises ValidationError when a parameter is malformed.
+        """
+        try:
+            nprobe = parse_positive_int(params.get('nprobe'))
+            ef_search = parse_positive_int(params.get('ef_search'))
+        except (TypeError, ValueError):
+            raise ValidationError({'error': '"nprobe" and "ef_search" must be positive integers'})
+
+        try:
+            filters = parse_search_filters(params, self.request.user)
+        except ValueError as exc:
+            raise ValidationError({'error': f'"{exc}" must be an ISO 8601 date or datetime'})
+
+        # The index only holds embeddings by the active model
+        candidates = prompt_index.embeddings().filter(**filters) if filters else None
+        return {'nprobe': nprobe, 'ef_search': ef_search, 'candidates': candidates}
+
 
-        return index, ids
+class SimilarPromptsView(SimilaritySearchMixin, AsyncAPIView):
+    """
+    Returns prompts similar to the query using FAISS vector similarity,
+    best match first, each with its cosine distance to the query.
+    The index stays resident in each worker and is only reloaded when a
+    newer snapshot has been published. Results are cached across workers and
+    refreshed with prompts created since they were computed.
+    - 'mode=hybrid' fuses the results with a full-text search of the prompts.
+    - The view is async: the query is only embedded, on the inference
+      executor, when the cached results do not answer it.
+    """
+    modes = ('vector', 'hybrid')
 
-    def get(self, request):
-        query = request.query_params.get('q', '').strip()
+    async def get(self, request):
+        query = normalize_query(request.query_params.get('q', ''))
         if not query:
             return Response({'error': 'query parameter "q" is required'}, status=status.HTTP_400_BAD_REQUEST)
 
-        # Generate the embedding for the input query
-        query_vector = np.array(generate_embedding(query), dtype='float32')
+        mode = request.query_params.get('mode', 'vector')
+        if mode not in self.modes:
+            return Response({'error': f'"mode" must be one of: {", ".join(self.modes)}'},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        options = await sync_to_async(self.get_search_options)(request.query_params)
+        result_options = self.get_result_options(request.query_params)
+
+        # Searched without the query embedding first: cached results need none
+        try:
+            data = await sync_to_async(self.search)(query, mode, options, *result_options)
+        except QueryEmbeddingNeeded as needed:
+            vector = await run_inference(embed_query, query, needed.model_name)
+            data = await sync_to_async(self.search)(query, mode, options, *result_options, vector)
+        return Response(data)
+
+    def search(self, query, mode, options, k, offset, max_distance, include_vector, query_vector=None):
+        """
+        Returns the serialized page of prompts similar to ``query``. Raises
+        QueryEmbeddingNeeded if the search needs ``query_vector`` and it is
+        not given.
+        """
+        def embed():
+            if query_vector is None:
+                raise QueryEmbeddingNeeded(prompt_index.model_name)
+            return query_vector
+
+        # Most similar prompts within max_distance, from the shared result
+        # cache or the worker's index
+        distances = {}
+
+        def vector_search(limit):
+            ids, scores = similar_results.search(query, limit, options, embed)
+            for prompt_id, distance in zip(ids, cosine_distance(scores).tolist()):
+                if max_distance is None or distance <= max_distance:
+                    distances[prompt_id] = distance
+            return [prompt_id for prompt_id in ids if prompt_id in distances]
+
+        if mode == 'hybrid':
+            if query_vector is None:
+                # Answered from the cache, or QueryEmbeddingNeeded is raised before the
+                # full-text query is submitted, which the retry would submit again
+                cached_ids = vector_search(candidate_limit(offset + k))
+                similar_ids = hybrid_search(query, offset + k, lambda limit: cached_ids, options['candidates'])
+            else:
+                similar_ids = hybrid_search(query, offset + k, vector_search, options['candidates'])
+        else:
+            similar_ids = vector_search(offset + k)
+
+        # Retrieve and serialize the requested page of prompts, best match first
+        ranked = [(prompt_id, distances.get(prompt_id)) for prompt_id in similar_ids[offset:offset + k]]
+        serializer = SimilarPromptSerializer(fetch_ranked_prompts(ranked, include_vector), many=True,
+                                             context={'include_vector': include_vector})
+        return serializer.data
+
+
+class SimilarPromptsBatchView(SimilaritySearchMixin, AsyncAPIView):
+    """
+    Runs several similarity searches in one request.
+    - All queries are embedded in a single batched forward pass, on the
+      inference executor.
+    - The index is searched once with the whole query matrix.
+    - Matching prompts of every query are fetched with a single query.
+    Filters and tuning parameters apply to every query in the batch.
+    """
+
+    async def post(self, request):
+        queries = request.data.get('queries')
+        if (not isinstance(queries, list) or not queries
+                or not all(isinstance(query, str) and query.strip() for query in queries)):
+            return Response({'error': '"queries" must be a non-empty list of strings'},
+                            status=status.HTTP_400_BAD_REQUEST)
+        if len(queries) > settings.SIMILAR_BATCH_MAX_QUERIES:
+            return Response({'error': f'at most {settings.SIMILAR_BATCH_MAX_QUERIES} queries are allowed'},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        options = await sync_to_async(self.get_search_options)(request.data)
+        result_options = self.get_result_options(request.data)
+        queries = [query.strip() for query in queries]
+
+        query_vectors = normalize_rows(await run_inference(generate_embeddings, queries))
+        data = await sync_to_async(self.search)(queries, query_vectors, options, *result_options)
+        return Response(data)
+
+    def search(self, queries, query_vectors, options, k, offset, max_distance, include_vector):
+        """Returns the serialized results of each of ``queries``, embedded as ``query_vectors``."""
+        result = prompt_index.search(query_vectors, offset + k, **options)
+        if result is None:
+            return [{'query': query, 'results': []} for query in queries]
 
-        # Load or rebuild FAISS index
-        index, ids = self.get_faiss_index()
-        if not index:
-            return Response([], status=status.HTTP_200_OK)
+        distances, labels = result
+        rankings = []
+        for row_distances, row_labels in zip(cosine_distance(distances).tolist(), labels.tolist()):
+            ranked = [(label, distance) for label, distance in zip(row_labels, row_distances)
+                      if label != -1 and (max_distance is None or distance <= max_distance)]
+            rankings.append(ranked[offset:offset + k])
 
-        # Perform similarity search (top 5 most similar prompts)
-        k = min(5, len(ids))
-        distances, indices = index.search(
-            np.expand_dims(query_vector, axis=0), k)
-        similar_ids = [ids[i] for i in indices[0]]
+        # Fetch the prompts of all queries at once
+        all_ids = {prompt_id for ranked in rankings for prompt_id, _ in ranked}
+        prompts = fetch_ranked_prompts([(prompt_id, None) for prompt_id in all_ids], include_vector)
+        serializer = SimilarPromptSerializer(prompts, many=True, context={'include_vector': include_vector})
+        serialized = {item['id']: item for item in serializer.data}
 
-        # Retrieve and serialize the matching prompts
-        similar_prompts = Prompt.objects.filter(id__in=similar_ids)
-        serializer = PromptSerializer(similar_prompts, many=True)
-        return Response(serializer.data)
+        return [
+            {'query': query, 'results': [dict(serialized[prompt_id], distance=distance)
+                                         for prompt_id, distance in ranked if prompt_id in serialized]}
+            for query, ranked in zip(queries, rankings)
+        ]
 
 
 class SignUpView(generics.CreateAPIView):
@@ -17,3 +17,20 @@ def send_to_websocket(user, message: dict):
             "message": message
         }
     )
+
+
+def send_prompt_event(user, event, message: dict):
+    """
+    Sends a prompt generation event ('chunk', 'done' or 'error') to the user
+    via WebSocket. PromptConsumer forwards it tagged with its event name.
+    """
+    channel_layer = get_channel_layer()
+    group_name = f"user_{user.id}"
+
+    async_to_sync(channel_layer.group_send)(
+        group_name,
+        {
+            "type": f"prompt.{event}",
+            "message": message
+        }
+    )
@@ -0,0 +1,44 @@
+"""
+Gunicorn configuration, read automatically from the working directory.
+
+With GUNICORN_PRELOAD (the default) the application is imported and both
+models are loaded once in the master process before the workers are forked.
+The weights are moved to shared memory first, so each worker maps the same
+pages instead of loading its own copy: worker count is bounded by CPU rather
+than RAM, and restarting a worker does not reload the models from disk. Each
+worker then sizes its torch thread pool to its share of the CPU cores.
+
+Without preloading every worker loads its own models on first use.
+"""
+import gc
+import os
+
+from decouple import config
+
+bind = config('GUNICORN_BIND', default='0.0.0.0:8000')
+workers = config('WEB_CONCURRENCY', default=2, cast=int)
+worker_class = 'uvicorn.workers.UvicornWorker'
+preload_app = config('GUNICORN_PRELOAD', default=True, cast=bool)
+
+# Tokenizer thread pools do not survive fork; workers tokenize on their own threads
+os.environ.setdefault('TOKENIZERS_PARALLELISM', 'false')
+
+
+def when_ready(server):
+    if not preload_app:
+        return
+    from forge.utils import preload_models
+
+    preload_models()
+    # Exclude everything loaded so far from garbage collection, so collections
+    # in the workers do not write to the inherited pages and copy them
+    gc.collect()
+    gc.freeze()
+    server.log.info('Models preloaded; workers will share their weights')
+
+
+def post_fork(server, worker):
+    from forge.utils import configure_worker_threads
+
+    threads = configure_worker_threads(server.cfg.workers)
+    server.log.info('Worker %s uses %s torch threads', worker.pid, threads)
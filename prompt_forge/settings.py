@@ -52,7 +52,8 @@ INSTALLED_APPS = [
 MIDDLEWARE = [
     'django_prometheus.middleware.PrometheusBeforeMiddleware',
     'django.middleware.security.SecurityMiddleware',
-    "whitenoise.middleware.WhiteNoiseMiddleware",
+    # WhiteNoise, able to pass async requests on to async views
+    'forge.middleware.static_files.AsyncWhiteNoiseMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -142,6 +143,7 @@ REST_FRAMEWORK = {
     'DEFAULT_THROTTLE_RATES': {
         'burst': '1/second',
         'sustained': '10/minute',
+        'status_poll': '120/minute',
     }
 }
 
@@ -181,3 +183,148 @@ STATICFILES_STORAGE = "whitenoise.storage.CompressedManifestStaticFilesStorage"
 # https://docs.djangoproject.com/en/5.2/ref/settings/#default-auto-field
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
+
+# FAISS similarity index
+# Snapshots and their manifest are written next to this path
+FAISS_INDEX_PATH = config(
+    'FAISS_INDEX_PATH', default=os.path.join(BASE_DIR, 'faiss_prompt_index.faiss'))
+# Publish a new snapshot once this many embeddings were added on top of the last one
+FAISS_SNAPSHOT_EVERY = config('FAISS_SNAPSHOT_EVERY', default=1000, cast=int)
+# Longest time between inserting an embedding and committing it. Embeddings
+# this recent may still be preceded by uncommitted lower ids, so the delta
+# log is read again from before them
+FAISS_DELTA_SETTLE_SECONDS = config('FAISS_DELTA_SETTLE_SECONDS', default=60, cast=float)
+# Index type: flat (exact), ivf_flat, ivf_pq, hnsw, pca_ivf_pq or pca_ivf_sq8.
+# IVF types are trained with 'manage.py train_prompt_index' and fall back to flat until then.
+FAISS_INDEX_TYPE = config('FAISS_INDEX_TYPE', default='flat')
+FAISS_IVF_NLIST = config('FAISS_IVF_NLIST', default=1024, cast=int)
+FAISS_PQ_M = config('FAISS_PQ_M', default=48, cast=int)
+FAISS_PQ_NBITS = config('FAISS_PQ_NBITS', default=8, cast=int)
+FAISS_HNSW_M = config('FAISS_HNSW_M', default=32, cast=int)
+# Compressed profiles (pca_ivf_pq, pca_ivf_sq8) reduce vectors to this many
+# dimensions first; FAISS_PQ_M must divide it
+FAISS_PCA_DIM = config('FAISS_PCA_DIM', default=96, cast=int)
+# Searches on quantized indexes fetch k times this many candidates and re-rank
+# them with the exact vectors stored in PromptEmbedding
+FAISS_RERANK_FACTOR = config('FAISS_RERANK_FACTOR', default=4, cast=int)
+# Default search-time parameters, overridable per request
+FAISS_NPROBE = config('FAISS_NPROBE', default=16, cast=int)
+FAISS_EF_SEARCH = config('FAISS_EF_SEARCH', default=64, cast=int)
+# Distance metric: l2 or ip (inner product). Stored vectors are unit length,
+# so both rank by cosine similarity; ip returns the cosine itself as the score.
+FAISS_METRIC = config('FAISS_METRIC', default='l2')
+# Open snapshots memory-mapped and read-only so all workers on a host share them
+FAISS_MMAP = config('FAISS_MMAP', default=True, cast=bool)
+# Filtered searches with at most this many matching prompts compare against all
+# of them exactly instead of searching the index with an ID selector
+FAISS_EXACT_FILTER_MAX = config('FAISS_EXACT_FILTER_MAX', default=2000, cast=int)
+
+# Hybrid similarity search (mode=hybrid): latency budget shared by the vector and
+# full-text searches, candidates taken from each per result, and threads running
+# full-text queries alongside the vector search
+SIMILAR_HYBRID_BUDGET_MS = config('SIMILAR_HYBRID_BUDGET_MS', default=200, cast=int)
+SIMILAR_HYBRID_CANDIDATE_FACTOR = config('SIMILAR_HYBRID_CANDIDATE_FACTOR', default=4, cast=int)
+SIMILAR_HYBRID_WORKERS = config('SIMILAR_HYBRID_WORKERS', default=4, cast=int)
+
+# Torch intra-op threads per server worker process; 0 shares the CPU cores
+# equally among the workers
+TORCH_THREADS = config('TORCH_THREADS', default=0, cast=int)
+
+# Numeric backend of the generation and embedding models on CPU: fp32, int8
+# (dynamic quantization of linear layers) or bf16 (falls back to fp32 on CPUs
+# without native bfloat16 support). The inference server and the web workers
+# must use the same backend
+INFERENCE_BACKEND = config('INFERENCE_BACKEND', default='fp32')
+
+# Out-of-process inference (manage.py run_inference_server): when set, web
+# workers send model calls to the server on this Unix socket instead of
+# loading the models themselves; each call gives up after the timeout in seconds
+INFERENCE_SERVER_SOCKET = config('INFERENCE_SERVER_SOCKET', default='')
+INFERENCE_SERVER_TIMEOUT = config('INFERENCE_SERVER_TIMEOUT', default=60, cast=float)
+
+# Text generation micro-batching: concurrent prompts arriving within
+# GENERATION_BATCH_MAX_WAIT_MS of the first are generated as one batch of up to
+# GENERATION_BATCH_MAX_SIZE prompts
+GENERATION_BATCH_MAX_SIZE = config('GENERATION_BATCH_MAX_SIZE', default=8, cast=int)
+GENERATION_BATCH_MAX_WAIT_MS = config('GENERATION_BATCH_MAX_WAIT_MS', default=10, cast=int)
+
+# Prefix key/value cache: the attention cache of prompt preambles is computed
+# once and generation starts from it. Preambles are registered in a JSON list
+# at GENERATION_PREFIXES_PATH or detected as line-ending prefixes seen in
+# GENERATION_PREFIX_FREQUENT_AFTER prompts (0 disables detection). A cache
+# size of 0 disables the cache
+GENERATION_PREFIX_CACHE_SIZE = config('GENERATION_PREFIX_CACHE_SIZE', default=8, cast=int)
+GENERATION_PREFIX_MIN_TOKENS = config('GENERATION_PREFIX_MIN_TOKENS', default=32, cast=int)
+GENERATION_PREFIX_FREQUENT_AFTER = config('GENERATION_PREFIX_FREQUENT_AFTER', default=3, cast=int)
+GENERATION_PREFIXES_PATH = config('GENERATION_PREFIXES_PATH', default='')
+
+# Threads per process running model calls next to the request thread, such as
+# a prompt's embedding while its response is generated, and every model call
+# of the async prompt and search views. Enough threads to fill a generation
+# batch while embeddings are computed as well
+INFERENCE_EXECUTOR_WORKERS = config('INFERENCE_EXECUTOR_WORKERS', default=2 * GENERATION_BATCH_MAX_SIZE, cast=int)
+
+# Asynchronous prompt jobs ("async": true): threads per process generating
+# responses, and jobs that may wait for one before requests get a 503
+PROMPT_JOB_WORKERS = config('PROMPT_JOB_WORKERS', default=2, cast=int)
+PROMPT_JOB_QUEUE_SIZE = config('PROMPT_JOB_QUEUE_SIZE', default=32, cast=int)
+# Jobs only live in the process that accepted them: prompts still pending or
+# running this many seconds after they were created are marked failed by
+# "manage.py reap_prompt_jobs", which runs at startup
+PROMPT_JOB_STALE_SECONDS = config('PROMPT_JOB_STALE_SECONDS', default=900, cast=int)
+
+# Semantic response cache: reuse the response of the nearest stored prompt
+# within RESPONSE_CACHE_MAX_DISTANCE (cosine distance) instead of generating one.
+# Requests may opt in or out with "use_cache"; RESPONSE_CACHE_ENABLED is the default.
+RESPONSE_CACHE_ENABLED = config('RESPONSE_CACHE_ENABLED', default=False, cast=bool)
+RESPONSE_CACHE_MAX_DISTANCE = config('RESPONSE_CACHE_MAX_DISTANCE', default=0.05, cast=float)
+# Only reuse responses to the requesting user's own prompts
+RESPONSE_CACHE_PER_USER = config('RESPONSE_CACHE_PER_USER', default=False, cast=bool)
+
+# Largest result depth (offset + k) a similarity search may request
+SIMILAR_MAX_RESULTS = config('SIMILAR_MAX_RESULTS', default=100, cast=int)
+
+# Maximum number of queries accepted by POST /prompts/similar/batch/
+SIMILAR_BATCH_MAX_QUERIES = config('SIMILAR_BATCH_MAX_QUERIES', default=64, cast=int)
+
+# Embedding model of new prompts and queries until another one is activated
+# (manage.py backfill_embeddings --model NAME --activate). Workers pick up a
+# newly activated model within EMBEDDING_MODEL_REFRESH_SECONDS
+EMBEDDING_MODEL = config('EMBEDDING_MODEL', default='all-MiniLM-L6-v2')
+EMBEDDING_MODEL_REFRESH_SECONDS = config('EMBEDDING_MODEL_REFRESH_SECONDS', default=5, cast=float)
+
+# Embedding cache: an in-process LRU per worker in front of a SQLite store
+# shared by all workers on the host. An empty path disables the shared tier.
+EMBEDDING_CACHE_MEMORY_ITEMS = config('EMBEDDING_CACHE_MEMORY_ITEMS', default=4096, cast=int)
+EMBEDDING_CACHE_PATH = config(
+    'EMBEDDING_CACHE_PATH', default=os.path.join(BASE_DIR, 'embedding_cache.sqlite3'))
+EMBEDDING_CACHE_MAX_BYTES = config('EMBEDDING_CACHE_MAX_BYTES', default=256 * 1024 * 1024, cast=int)
+
+# Caches. The default cache holds throttle history; 'similar' holds similarity
+# search results and 'responses' memoized deterministic responses. Both must be
+# shared by all workers to be effective.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'similar': {
+        'BACKEND': config('SIMILAR_CACHE_BACKEND', default='django.core.cache.backends.filebased.FileBasedCache'),
+        'LOCATION': config('SIMILAR_CACHE_LOCATION', default=os.path.join(BASE_DIR, 'similar_cache')),
+        'TIMEOUT': config('SIMILAR_CACHE_TIMEOUT', default=300, cast=int),
+        'OPTIONS': {
+            'MAX_ENTRIES': config('SIMILAR_CACHE_MAX_ENTRIES', default=10000, cast=int),
+        },
+    },
+    'responses': {
+        'BACKEND': config('RESPONSE_MEMO_BACKEND', default='django.core.cache.backends.filebased.FileBasedCache'),
+        'LOCATION': config('RESPONSE_MEMO_LOCATION', default=os.path.join(BASE_DIR, 'response_memo')),
+        'TIMEOUT': config('RESPONSE_MEMO_TIMEOUT', default=86400, cast=int),
+        'OPTIONS': {
+            'MAX_ENTRIES': config('RESPONSE_MEMO_MAX_ENTRIES', default=10000, cast=int),
+        },
+    },
+}
+
+# Cached similarity results are refreshed by ranking the embeddings created since
+# they were computed; with more new matching embeddings than this they are recomputed
+SIMILAR_CACHE_MERGE_MAX = config('SIMILAR_CACHE_MERGE_MAX', default=1000, cast=int)
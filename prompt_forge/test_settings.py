@@ -0,0 +1,23 @@
+"""
+Django settings for the test suite.
+
+Cached results are kept in memory and the shared embedding cache is disabled,
+so test runs write nothing into the project directory.
+"""
+from .settings import *  # noqa: F401,F403
+from .settings import CACHES
+
+CACHES = {
+    **CACHES,
+    'similar': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'similar',
+    },
+    'responses': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'responses',
+    },
+}
+
+# Tests of the shared embedding tier give it a temporary file
+EMBEDDING_CACHE_PATH = ''